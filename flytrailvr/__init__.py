@@ -4,20 +4,98 @@ import lazy_loader
 __getattr__, __dir__, __all__ = lazy_loader.attach(
     __name__,
     submodules={
+        'closed_loop',
+        'harness',
+        'logic',
         'rdp_client',
+        'render',
+        'synthetic',
+        'video',
     },
     submod_attrs={
+        'closed_loop': [
+            'FlowrateSchedule',
+            'FrameLogger',
+            'LatencyMonitor',
+            'ReplayScheduler',
+            'SetpointDispatcher',
+            'StreamingHistogram',
+            'StripGeometry',
+            'config_value',
+            'parse_timestamps',
+            'read_log',
+        ],
+        'harness': [
+            'MockHardware',
+            'compare_setpoints',
+            'frames_from_log',
+            'load_config',
+            'load_logic',
+            'run_logic',
+            'run_session',
+        ],
+        'logic': [
+            'LogicTemplate',
+            'StripLogic',
+            'build_logic',
+            'catalog',
+            'get_template',
+            'identify_logic',
+            'reference_session',
+            'register',
+            'session_template',
+        ],
         'rdp_client': [
+            'ConcatReader',
+            'CorruptArchiveError',
+            'EncryptedReader',
+            'EncryptedWriter',
+            'SplitEncryptedWriter',
+            'decrypt_file',
+            'encrypt_file',
+            'extract_from_locked_file',
+            'list_locked_file',
+            'lock_folder_incremental',
+            'open_encrypted',
+            'read_manifest',
+            'read_state',
+            'restore_incremental',
             'unlock_and_unzip_file',
+            'verify_locked_file',
+            'verify_locked_folder',
+            'verify_manifest',
             'zip_and_lock_folder',
         ],
+        'render': [
+            'figure_hash',
+            'read_png_text',
+            'render_session',
+            'render_figures',
+        ],
+        'synthetic': [
+            'generate_log',
+            'generate_session',
+        ],
         'utils': [
             'extract_data',
             'process_important_variables',
             'config_to_title',
+            'rasterize_trajectory',
             'plot_trajectory'
         ],
+        'video': [
+            'GifWriter',
+            'PALETTE',
+            'TrajectoryRenderer',
+            'benchmark_video_scaling',
+            'concatenate_videos',
+            'export_previews',
+            'export_trajectory_animation',
+            'find_ffmpeg',
+            'open_video_writer',
+            'write_trajectory_video',
+        ],
     },
 )
 
-__all__ = ['rdp_client', 'unlock_and_unzip_file', 'zip_and_lock_folder', 'extract_data', 'process_important_variables', 'config_to_title', 'plot_trajectory']
+__all__ = ['closed_loop', 'harness', 'logic', 'rdp_client', 'render', 'synthetic', 'video', 'FlowrateSchedule', 'FrameLogger', 'LatencyMonitor', 'ReplayScheduler', 'SetpointDispatcher', 'StreamingHistogram', 'StripGeometry', 'config_value', 'parse_timestamps', 'read_log', 'MockHardware', 'compare_setpoints', 'frames_from_log', 'load_config', 'load_logic', 'run_logic', 'run_session', 'LogicTemplate', 'StripLogic', 'build_logic', 'catalog', 'get_template', 'identify_logic', 'reference_session', 'register', 'session_template', 'ConcatReader', 'CorruptArchiveError', 'EncryptedReader', 'EncryptedWriter', 'SplitEncryptedWriter', 'decrypt_file', 'encrypt_file', 'extract_from_locked_file', 'list_locked_file', 'lock_folder_incremental', 'open_encrypted', 'read_manifest', 'read_state', 'restore_incremental', 'unlock_and_unzip_file', 'verify_locked_file', 'verify_locked_folder', 'verify_manifest', 'zip_and_lock_folder', 'figure_hash', 'read_png_text', 'render_session', 'render_figures', 'generate_log', 'generate_session', 'extract_data', 'process_important_variables', 'config_to_title', 'rasterize_trajectory', 'plot_trajectory', 'GifWriter', 'PALETTE', 'TrajectoryRenderer', 'benchmark_video_scaling', 'concatenate_videos', 'export_previews', 'export_trajectory_animation', 'find_ffmpeg', 'open_video_writer', 'write_trajectory_video']
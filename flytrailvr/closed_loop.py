@@ -0,0 +1,803 @@
+# Description: Precomputed closed-loop helpers for the experiment_logic of the rig
+
+import json
+import bisect
+import math
+import time
+import threading
+import numpy as np
+import pandas as pd
+
+def config_value(config, key, default=None):
+    """
+    Read a value from a config dictionary (as returned by extract_data) or a config module (cl.config)
+    """
+    if isinstance(config, dict):
+        return config.get(key, default)
+    return getattr(config, key, default)
+
+class StripGeometry:
+    """
+    Geometry of the (tilted, optionally periodic) strip of a session
+
+    All trigonometry is done once in the constructor and cached as plain floats, so that
+    classify only does a few float operations per frame (no NumPy scalars).
+
+    Positions are relative to the onset position (x_temp, y_temp in experiment_logic).
+
+    Parameters
+    ----------
+    strip_width : float
+        Width of the strip (mm)
+    strip_angle : float
+        Angle of the strip from the vertical (degrees, cannot be 90)
+    strip_direction : str
+        'left' or 'right'
+    periodic_boundary : bool
+        Wrap x into [-period_width/2, period_width/2)
+    period_width : float
+        Width of the period (mm)
+    y_limit : float
+        Absolute edge of the arena, the fly is never in the strip beyond it (mm)
+    """
+    def __init__(self, strip_width, strip_angle=0, strip_direction='right', periodic_boundary=False, period_width=None, y_limit=100000):
+        assert strip_direction in ['left', 'right'], "strip_direction must be 'left' or 'right'."
+        assert abs(strip_angle) % 180 != 90, "strip_angle cannot be 90."
+        assert not periodic_boundary or period_width, "period_width is required with periodic_boundary."
+
+        self.strip_width = float(strip_width)
+        self.strip_angle = float(strip_angle)
+        self.strip_direction = strip_direction
+        self.periodic_boundary = bool(periodic_boundary)
+        self.period_width = float(period_width) if period_width else None
+        self.y_limit = float(y_limit)
+
+        # cached constants (same expressions as the session experiment_logic)
+        slope = float(np.tan(np.deg2rad(self.strip_angle)))
+        self._slope = -slope if strip_direction == 'left' else slope
+        self._thresh = float((self.strip_width/2)/np.sin(np.deg2rad(90-self.strip_angle)))
+        self._period = self.period_width if self.periodic_boundary else 0.0
+        self._boundary = self._period/2
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the geometry from a config dictionary or module
+        """
+        return cls(
+            config_value(config, 'strip_width'),
+            config_value(config, 'strip_angle', 0),
+            config_value(config, 'strip_direction', 'right'),
+            config_value(config, 'periodic_boundary', False),
+            config_value(config, 'period_width'),
+        )
+
+    @property
+    def strip_thresh(self):
+        return self._thresh
+
+    def wrap(self, x):
+        """
+        Apply the periodic boundary to a relative x position
+        """
+        if self._period:
+            return (x + self._boundary) % self._period - self._boundary
+        return x
+
+    def classify(self, x, y):
+        """
+        Classify a single relative position
+
+        Parameters
+        ----------
+        x, y : float
+            Position relative to the onset position (mm)
+
+        Returns
+        -------
+        instrip : bool
+            True if the fly is in the strip (and within y_limit)
+        adapted_center : float
+            Center of the strip at y
+        strip_thresh : float
+            Distance from the center to the edge of the strip along x
+        """
+        if self._period:
+            x = (x + self._boundary) % self._period - self._boundary
+        center = self._slope*y
+        instrip = abs(x - center) <= self._thresh and -self.y_limit < y < self.y_limit
+        return instrip, center, self._thresh
+
+    def classify_array(self, x, y):
+        """
+        Classify arrays of relative positions
+
+        Parameters
+        ----------
+        x, y : array_like
+            Positions relative to the onset position (mm)
+
+        Returns
+        -------
+        instrip : numpy.ndarray
+            Boolean array
+        adapted_center : numpy.ndarray
+            Center of the strip at each y
+        strip_thresh : float
+            Distance from the center to the edge of the strip along x
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if self._period:
+            x = (x + self._boundary) % self._period - self._boundary
+        center = self._slope*y
+        instrip = (np.abs(x - center) <= self._thresh) & (np.abs(y) < self.y_limit)
+        return instrip, center, self._thresh
+
+    def __repr__(self):
+        return (f'StripGeometry(strip_width={self.strip_width}, strip_angle={self.strip_angle}, '
+                f'strip_direction={self.strip_direction!r}, periodic_boundary={self.periodic_boundary}, '
+                f'period_width={self.period_width})')
+
+class FrameLogger:
+    """
+    Non-blocking per-frame logger for experiment_logic
+
+    log() stores a record (a tuple of values matching fields) in a preallocated ring buffer
+    and returns immediately. A background thread drains the buffer, writes every record to
+    a file and prints a summary of the latest record to the console at most every
+    console_interval seconds, so the closed loop never blocks on the terminal or the disk.
+
+    The buffer has a single producer (the frame callback) and a single consumer (the
+    background thread) that only exchange the head and tail counters, so no lock is taken.
+    If the consumer falls behind by a full buffer, new records are dropped (and counted)
+    instead of blocking.
+
+    Parameters
+    ----------
+    path : str, optional
+        File to write the records to (comma-separated, with a header of fields)
+    fields : list
+        Names of the values of a record (the first one is the time)
+    capacity : int
+        Number of records in the ring buffer
+    console_interval : float
+        Minimum time between console summaries (seconds, None to disable them)
+    drain_interval : float
+        Time between drains of the buffer by the background thread (seconds)
+    console : callable
+        Function printing the summaries
+    """
+    def __init__(self, path=None, fields=('time', 'mode', 'x', 'y', 'instrip', 'air_sp', 'odor1_sp', 'odor2_sp', 'led1_sp', 'led2_sp'),
+                 capacity=8192, console_interval=1.0, drain_interval=0.05, console=print):
+        assert capacity > 0, "capacity must be positive."
+        self.path = path
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.console_interval = console_interval
+        self.drain_interval = drain_interval
+        self.console = console
+        self.batch_size = 256
+
+        self._buffer = [None]*capacity
+        self._head = 0 # written by the producer only
+        self._tail = 0 # written by the consumer only
+        self.dropped = 0
+        self.written = 0
+
+        self._file = None
+        self._last_summary = None
+        self._since_summary = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Open the file and start the background thread
+        """
+        if self.path is not None:
+            self._file = open(self.path, 'w', buffering=1 << 20)
+            self._file.write(','.join(self.fields) + '\n')
+        self._thread = threading.Thread(target=self._run, name='FrameLogger', daemon=True)
+        self._thread.start()
+        return self
+
+    def log(self, *record):
+        """
+        Queue a record (never blocks)
+
+        Returns False if the buffer is full and the record was dropped.
+        """
+        head = self._head
+        if head - self._tail >= self.capacity:
+            self.dropped += 1
+            return False
+        self._buffer[head % self.capacity] = record
+        self._head = head + 1
+        return True
+
+    def _drain(self):
+        # drain in small batches and yield the GIL in between so the producer is never held up
+        while self._tail != self._head:
+            self._drain_batch()
+            time.sleep(0)
+
+    def _drain_batch(self):
+        tail = self._tail
+        head = min(self._head, tail + self.batch_size)
+        records = [self._buffer[i % self.capacity] for i in range(tail, head)]
+        self._tail = head
+
+        if self._file is not None:
+            self._file.write(''.join(','.join(map(str, record)) + '\n' for record in records))
+        self.written += len(records)
+        self._since_summary += len(records)
+
+        # rate-limited summary of the latest record
+        if self.console_interval is not None:
+            now = time.monotonic()
+            if self._last_summary is None or now - self._last_summary >= self.console_interval:
+                self._last_summary = now
+                values = ' | '.join(f'{name}={_format_value(value)}' for name, value in zip(self.fields, records[-1]))
+                dropped = f' | dropped={self.dropped}' if self.dropped else ''
+                self.console(f'{values} | frames={self._since_summary}{dropped}')
+                self._since_summary = 0
+
+    def _run(self):
+        while not self._stop.wait(self.drain_interval):
+            self._drain()
+        self._drain()
+
+    def close(self):
+        """
+        Drain the remaining records, stop the thread and close the file
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        else:
+            self._drain()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _format_value(value):
+    if isinstance(value, float):
+        return f'{value:.2f}'
+    return str(value)
+
+class StreamingHistogram:
+    """
+    Histogram with logarithmic bins for streaming percentiles in constant memory
+
+    Values below min_value go to the first bin and values above max_value to the last one.
+    Percentiles are exact to the bin resolution (about 5% with 50 bins per decade); the
+    maximum, minimum and mean are exact.
+
+    Parameters
+    ----------
+    min_value, max_value : float
+        Range of the bins
+    bins_per_decade : int
+        Resolution of the bins
+    """
+    def __init__(self, min_value=100, max_value=1e11, bins_per_decade=50):
+        self.min_value = min_value
+        self.bins_per_decade = bins_per_decade
+        self._scale = bins_per_decade/math.log(10)
+        self._log_min = math.log(min_value)
+        self.counts = [0]*(int(math.ceil(math.log10(max_value/min_value)*bins_per_decade)) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        index = int((math.log(value) - self._log_min)*self._scale) if value > self.min_value else 0
+        self.counts[min(index, len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def quantile(self, q):
+        """
+        Value below which a fraction q of the values are (upper edge of the bin)
+        """
+        if not self.count:
+            return None
+        target, cumulative = q*self.count, 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count:
+                return min(self.min_value*10**((index + 1)/self.bins_per_decade), self.max)
+        return self.max
+
+    def summary(self, scale=1.0):
+        """
+        Count, mean, p50, p90, p99, p99.9 and max (divided by scale)
+        """
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total/self.count/scale,
+            'p50': self.quantile(0.5)/scale,
+            'p90': self.quantile(0.9)/scale,
+            'p99': self.quantile(0.99)/scale,
+            'p99.9': self.quantile(0.999)/scale,
+            'max': self.max/scale,
+        }
+
+class LatencyMonitor:
+    """
+    Latency and jitter instrumentation of the closed loop
+
+    Wrap the frame callback (monitor.wrap(experiment_logic)) or call start()/stop() around
+    it. Every call is timestamped with time.perf_counter_ns; the call durations and the
+    intervals between calls go into streaming histograms. A call is a deadline miss if it
+    takes longer than the FicTrac frame interval, and a frame is late if the interval to the
+    previous call exceeds late_factor frame intervals.
+
+    Parameters
+    ----------
+    fps : float, optional
+        FicTrac frame rate (default: estimated from the median interval between calls)
+    late_factor : float
+        Interval (in frame intervals) above which a frame is late
+    """
+    def __init__(self, fps=None, late_factor=1.5):
+        self.fps = fps
+        self.late_factor = late_factor
+        self.latency = StreamingHistogram()
+        self.interval = StreamingHistogram()
+        self.deadline_misses = 0
+        self.late_frames = 0
+        self.first_call = None
+        self._last_start = None
+        self._start = None
+        self._deadline = int(1e9/fps) if fps else None
+
+    def start(self):
+        now = time.perf_counter_ns()
+        if self._last_start is not None:
+            interval = now - self._last_start
+            self.interval.add(interval)
+            if self._deadline is not None and interval > self.late_factor*self._deadline:
+                self.late_frames += 1
+        else:
+            self.first_call = now
+        self._last_start = self._start = now
+
+    def stop(self):
+        duration = time.perf_counter_ns() - self._start
+        self.latency.add(duration)
+        if self._deadline is not None and duration > self._deadline:
+            self.deadline_misses += 1
+        return duration
+
+    def wrap(self, function):
+        """
+        Wrap a frame callback so that every call is timed
+        """
+        def timed(*args, **kwargs):
+            self.start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stop()
+        timed.__wrapped__ = function
+        timed.__name__ = getattr(function, '__name__', 'timed')
+        return timed
+
+    def frame_interval(self):
+        # frame interval in ns (from fps or the median interval between calls)
+        if self._deadline is not None:
+            return self._deadline
+        return self.interval.quantile(0.5)
+
+    def report(self):
+        """
+        Timing report as a dictionary (times in milliseconds)
+
+        Without fps, deadline misses and late frames are not counted online and are
+        estimated from the histograms against the median interval.
+        """
+        frame_interval = self.frame_interval()
+        misses, late = self.deadline_misses, self.late_frames
+        if self._deadline is None and frame_interval is not None:
+            misses = _count_above(self.latency, frame_interval)
+            late = _count_above(self.interval, self.late_factor*frame_interval)
+        elapsed = (self._last_start - self.first_call)/1e9 if self.first_call is not None else 0.0
+        return {
+            'frames': self.latency.count,
+            'elapsed_s': elapsed,
+            'fps': self.fps if self.fps else (1e9/frame_interval if frame_interval else None),
+            'measured_fps': (self.interval.count/elapsed) if elapsed > 0 else None,
+            'frame_interval_ms': frame_interval/1e6 if frame_interval else None,
+            'deadline_misses': misses,
+            'deadline_miss_rate': misses/self.latency.count if self.latency.count else None,
+            'late_frames': late,
+            'latency_ms': self.latency.summary(1e6),
+            'interval_ms': self.interval.summary(1e6),
+        }
+
+    def write_report(self, path):
+        """
+        Write the timing report as JSON
+
+        If path is a FicTrac log (.log), the report is written next to it as <log>.timing.json.
+        """
+        if path.endswith('.log'):
+            path = path[:-len('.log')] + '.timing.json'
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+    def format_report(self):
+        report = self.report()
+        if not report['frames']:
+            return 'No frames timed'
+        latency = report['latency_ms']
+        return (f"{report['frames']} frames at {report['measured_fps'] or 0:.1f} fps | latency p50 {latency['p50']:.3f} ms, "
+                f"p99 {latency['p99']:.3f} ms, max {latency['max']:.3f} ms | deadline misses {report['deadline_misses']} | "
+                f"late frames {report['late_frames']}")
+
+def _count_above(histogram, threshold):
+    # number of values in bins entirely above threshold
+    count = 0
+    for index, n in enumerate(histogram.counts):
+        if n and histogram.min_value*10**(index/histogram.bins_per_decade) >= threshold:
+            count += n
+    return count
+
+def parse_timestamps(values):
+    """
+    Parse log timestamps (%m/%d/%Y-%H:%M:%S.%f) into a datetime64[us] array
+
+    The fixed-width digits are decoded with array arithmetic, which is much faster than
+    strptime on long logs. Falls back to pandas for other formats.
+    """
+    values = np.asarray(values).astype(str)
+    raw = values.astype('S26').view(np.uint8).reshape(len(values), 26).astype(np.int64) - ord('0')
+    separators = raw[:, [2, 5, 10, 13, 16, 19]] + ord('0')
+    if len(values) == 0 or np.char.str_len(values).max() != 26 or not np.all(separators == np.frombuffer(b'//-::.', np.uint8)):
+        return pd.to_datetime(values, format='%m/%d/%Y-%H:%M:%S.%f').values
+
+    def field(start, stop):
+        return raw[:, start:stop] @ 10**np.arange(stop - start - 1, -1, -1)
+
+    months = (field(6, 10) - 1970)*12 + field(0, 2) - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]') + (field(3, 5) - 1).astype('timedelta64[D]')
+    microseconds = ((field(11, 13)*60 + field(14, 16))*60 + field(17, 19))*1_000_000 + field(20, 26)
+    return days.astype('datetime64[us]') + microseconds.astype('timedelta64[us]')
+
+def read_log(path):
+    """
+    Read a FicTrac/rig log ('timestamp -- col,col,...' lines) into a dataframe
+
+    Faster than extract_data for large logs (C parser) and parses instrip as a boolean.
+    Adds a column t with the time in seconds since the first line.
+    """
+    df = pd.read_csv(path, sep=',', low_memory=False)
+    first = df.columns[0]
+    assert ' -- ' in first, f"{path} is not a rig log."
+    timestamp, column = first.split(' -- ')
+    split = df[first].astype(str).str.split(' -- ', n=1, expand=True)
+    df.insert(0, timestamp, parse_timestamps(split[0].values))
+    df[first] = pd.to_numeric(split[1], errors='coerce')
+    df = df.rename(columns={first: column})
+    if 'instrip' in df and df['instrip'].dtype != bool:
+        df['instrip'] = df['instrip'].astype(str) == 'True'
+    df['t'] = (df[timestamp] - df[timestamp].iloc[0]).dt.total_seconds()
+    return df
+
+class ReplayScheduler:
+    """
+    Instant replay of a recorded setpoint timeline
+
+    The timeline is held in arrays and the setpoint of a frame is found by binary search,
+    so a frame never waits (no sleep in the frame callback) and stale entries are skipped
+    without popping them one by one. The setpoint of a frame is the recorded one nearest in
+    time, the next one is only played early if it is within tolerance (before the first entry,
+    the first setpoint is held).
+
+    The timing error of every frame (time minus the recorded time of the setpoint it got)
+    is tracked, as well as the number of recorded entries that were never played.
+
+    Parameters
+    ----------
+    times : array_like
+        Increasing recorded times (seconds, same clock as the replay time)
+    setpoints : array_like
+        Recorded setpoints (one row per time, e.g. air_sp, odor1_sp, odor2_sp)
+    tolerance : float
+        Time window around a recorded time in which its setpoint is played (seconds)
+    """
+    def __init__(self, times, setpoints, tolerance=0.05):
+        times = np.asarray(times, dtype=float)
+        setpoints = np.asarray(setpoints, dtype=float)
+        assert times.ndim == 1 and len(times) > 0, "times must be a non-empty 1D array."
+        assert len(setpoints) == len(times), "setpoints must have one row per time."
+        assert np.all(np.diff(times) >= 0), "times must be increasing."
+        self.times = times
+        self.setpoints = setpoints
+        self.tolerance = tolerance
+
+        # plain python copies for the per-frame lookup
+        self._times = times.tolist()
+        self._setpoints = [tuple(row) for row in setpoints.reshape(len(times), -1).tolist()]
+        self._end = self._times[-1] + tolerance
+        self.reset()
+
+    @classmethod
+    def from_log(cls, path, start_time=0.0, columns=('mfc1_stpt', 'mfc2_stpt', 'mfc3_stpt'), mode='live', tolerance=0.05):
+        """
+        Load the setpoint timeline of a rig log
+
+        Parameters
+        ----------
+        path : str
+            Log file
+        start_time : float
+            Entries before start_time (seconds since the first line) are dropped and the times
+            are shifted so that start_time is 0 (cfg.pre_onset_time if include_pre_air is False)
+        columns : tuple
+            Setpoint columns to replay
+        mode : str, optional
+            Only replay the lines of this mode
+        """
+        df = read_log(path)
+        if mode is not None and 'mode' in df:
+            df = df[df['mode'] == mode]
+        df = df[df['t'] >= start_time]
+        return cls(df['t'].values - start_time, df[list(columns)].values, tolerance)
+
+    def reset(self):
+        self.index = -1
+        self.frames = 0
+        self.skipped = 0
+        self.error = StreamingHistogram(min_value=1e-6, max_value=1e4)
+        self.max_error = 0.0
+        self._last_time = -math.inf
+
+    @property
+    def done(self):
+        return self.index >= len(self._times) - 1 and self._last_time > self._end
+
+    def setpoint(self, time):
+        """
+        Setpoint of the frame at time (None after the end of the timeline)
+        """
+        self._last_time = time
+        if time > self._end:
+            self.index = len(self._times) - 1
+            return None
+        # nearest recorded entry (the next one is only played early within tolerance)
+        times = self._times
+        index = bisect.bisect_right(times, time, lo=max(self.index, 0)) - 1
+        if index < 0:
+            index = 0
+        elif index + 1 < len(times) and times[index + 1] - time < min(time - times[index], self.tolerance):
+            index += 1
+        if index > self.index + 1:
+            self.skipped += index - self.index - 1
+        self.index = index
+
+        error = time - self._times[index]
+        self.frames += 1
+        self.error.add(abs(error) or 1e-9)
+        if abs(error) > abs(self.max_error):
+            self.max_error = error
+        return self._setpoints[index]
+
+    def setpoints_at(self, times):
+        """
+        Setpoints at an array of times (vectorized, for offline comparisons)
+
+        Rows after the end of the timeline are nan.
+        """
+        times = np.asarray(times, dtype=float)
+        index = np.clip(np.searchsorted(self.times, times, side='right') - 1, 0, None)
+        following = np.minimum(index + 1, len(self.times) - 1)
+        early = (self.times[following] - times) < np.minimum(times - self.times[index], self.tolerance)
+        index = np.where(early, following, index)
+        setpoints = self.setpoints.reshape(len(self.times), -1)[index]
+        setpoints[times > self._end] = np.nan
+        return setpoints
+
+    def report(self):
+        """
+        Replay timing report (errors in milliseconds)
+        """
+        summary = self.error.summary(1e-3)
+        return {
+            'frames': self.frames,
+            'entries': len(self._times),
+            'skipped_entries': self.skipped,
+            'max_error_ms': self.max_error*1e3,
+            'abs_error_ms': summary,
+        }
+
+class SetpointDispatcher:
+    """
+    Send only the setpoints that changed to the hardware
+
+    experiment_logic returns all setpoints every frame although they rarely change (most
+    frames are outside the strip). dispatch() compares every setpoint with the last value
+    written to its device and only writes the changed ones, plus a keep-alive refresh of
+    every device at least every keepalive seconds (so a lost write is eventually corrected).
+
+    Parameters
+    ----------
+    write : callable
+        write(t, channel, value) sends value to the device of channel (index in the setpoint
+        tuple) at frame time t
+    keepalive : float, optional
+        Maximum time between two writes to a device (seconds, None to never refresh)
+    tolerance : float
+        Changes smaller than tolerance are suppressed
+    """
+    def __init__(self, write, keepalive=1.0, tolerance=0.0):
+        self.write = write
+        self.keepalive = keepalive
+        self.tolerance = tolerance
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the sent state (the next dispatch writes every setpoint)
+        """
+        self._sent = []
+        self._sent_time = []
+        self.frames = 0
+        self.writes = 0
+        self.refreshes = 0
+        self.suppressed = 0
+
+    def dispatch(self, t, setpoints):
+        """
+        Write the changed (or stale) setpoints of the frame at time t
+
+        Returns the number of writes.
+        """
+        sent, sent_time = self._sent, self._sent_time
+        if len(sent) != len(setpoints):
+            self._sent = sent = [None]*len(setpoints)
+            self._sent_time = sent_time = [-math.inf]*len(setpoints)
+        self.frames += 1
+        writes = 0
+        for channel, value in enumerate(setpoints):
+            last = sent[channel]
+            if last is None or abs(value - last) > self.tolerance:
+                pass
+            elif self.keepalive is not None and t - sent_time[channel] >= self.keepalive:
+                self.refreshes += 1
+            else:
+                self.suppressed += 1
+                continue
+            self.write(t, channel, value)
+            sent[channel], sent_time[channel] = value, t
+            writes += 1
+        self.writes += writes
+        return writes
+
+    def report(self):
+        """
+        Frames, writes (including refreshes), refreshes, suppressed writes and the suppressed fraction
+        """
+        total = self.writes + self.suppressed
+        return {
+            'frames': self.frames,
+            'writes': self.writes,
+            'refreshes': self.refreshes,
+            'suppressed': self.suppressed,
+            'suppressed_fraction': self.suppressed/total if total else 0.0,
+        }
+
+class FlowrateSchedule:
+    """
+    Flowrate alternation schedule of a session
+
+    Built once from the config: flowrate_high and flowrate_low alternate every alternation_time
+    seconds after the onset (high first), and flowrate is used before the onset (and all
+    the time if the config has no alternation). The online lookup is O(1) on cached floats,
+    the offline timeline is vectorized.
+
+    Parameters
+    ----------
+    flowrate : float
+        Flowrate before the onset or without alternation (ml/min)
+    flowrate_high, flowrate_low : float, optional
+        Alternated flowrates (ml/min)
+    alternation_time : float, optional
+        Duration of each flowrate (seconds)
+    pre_onset_time : float
+        Time of the onset since the start of the session (seconds)
+    """
+    def __init__(self, flowrate, flowrate_high=None, flowrate_low=None, alternation_time=None, pre_onset_time=0.0):
+        self.flowrate = flowrate
+        self.alternated = bool(alternation_time) and flowrate_high is not None and flowrate_low is not None
+        self.flowrate_high = flowrate_high if self.alternated else flowrate
+        self.flowrate_low = flowrate_low if self.alternated else flowrate
+        self.alternation_time = float(alternation_time) if self.alternated else math.inf
+        self.pre_onset_time = float(pre_onset_time)
+
+        # cached setpoints (same expression as the session experiment_logic)
+        self._flowrates = (self.flowrate_high, self.flowrate_low)
+        self._air = (float(self.flowrate_high/1000.), float(self.flowrate_low/1000.))
+        self.pre_onset_air = float(flowrate/1000.)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build the schedule from a config dictionary or module
+        """
+        return cls(
+            config_value(config, 'flowrate'),
+            config_value(config, 'flowrate_high'),
+            config_value(config, 'flowrate_low'),
+            config_value(config, 'alternation_time'),
+            config_value(config, 'pre_onset_time', 0.0),
+        )
+
+    def phase(self, t):
+        """
+        0 for flowrate_high and 1 for flowrate_low at time t since the onset
+        """
+        return int(t//self.alternation_time) & 1
+
+    def flowrate_at(self, t):
+        """
+        Flowrate at time t since the onset (ml/min)
+        """
+        return self._flowrates[int(t//self.alternation_time) & 1]
+
+    def air_sp(self, t):
+        """
+        Total air setpoint at time t since the onset (l/min, split between air and odor in the strip)
+        """
+        return self._air[int(t//self.alternation_time) & 1]
+
+    def timeline(self, t, onset_time=None):
+        """
+        Expected flowrate (ml/min) at an array of times since the start of the session
+
+        Parameters
+        ----------
+        t : array_like
+            Times since the start of the session (seconds)
+        onset_time : float, optional
+            Time of the onset (default: pre_onset_time)
+        """
+        t = np.asarray(t, dtype=float)
+        onset_time = self.pre_onset_time if onset_time is None else onset_time
+        after = t - onset_time
+        phase = np.floor_divide(np.maximum(after, 0.0), self.alternation_time) % 2
+        flowrate = np.where(phase == 0, self.flowrate_high, self.flowrate_low).astype(float)
+        return np.where(after < 0, float(self.flowrate), flowrate)
+
+    def log_timeline(self, df):
+        """
+        Expected total flowrate (ml/min) of every frame of a rig log (see read_log)
+
+        The onset is the first frame at or after pre_onset_time and still gets flowrate, the
+        alternation starts at the next frame (as in experiment_logic). Compare with
+        1000*(mfc1_stpt + mfc2_stpt).
+        """
+        t = df['t'].values
+        after = np.nonzero(t >= self.pre_onset_time)[0]
+        if not len(after):
+            return self.timeline(t, np.inf)
+        flowrate = self.timeline(t, t[after[0]])
+        flowrate[after[0]] = self.flowrate
+        return flowrate
@@ -0,0 +1,443 @@
+# Description: Offline harness running session experiment_logic files without the rig
+
+import os
+import sys
+import math
+import time
+import types
+import argparse
+from collections import deque
+import numpy as np
+from .closed_loop import read_log
+
+# setpoints returned by experiment_logic and the log columns they are written to
+SETPOINTS = ['air_sp', 'odor1_sp', 'odor2_sp', 'led1_sp', 'led2_sp']
+SETPOINT_COLUMNS = ['mfc1_stpt', 'mfc2_stpt', 'mfc3_stpt', 'led1_stpt', 'led2_stpt']
+
+# FicTrac values of a frame (log columns without the ft_ prefix)
+FT_FIELDS = ['posx', 'posy', 'frame', 'error', 'roll', 'pitch', 'yaw', 'heading']
+
+class FTData:
+    """
+    Stand-in for cl.utilities.FTData (one FicTrac frame)
+    """
+    __slots__ = FT_FIELDS
+
+    def __init__(self, **values):
+        for field in FT_FIELDS:
+            setattr(self, field, values.get(field, 0.0))
+
+class SlidingWindow:
+    """
+    Stand-in for cl.utilities.SlidingWindow (running window of the latest values)
+    """
+    def __init__(self, window_len=120):
+        self.window_len = window_len
+        self.values = deque(maxlen=int(window_len))
+
+    def add(self, value):
+        self.values.append(value)
+
+    def mean(self):
+        return float(np.mean(self.values)) if self.values else np.nan
+
+class InstantReplayParse:
+    """
+    Stand-in for cl.utilities.InstantReplayParse
+
+    Reads the setpoint timeline of the latest log in log_dir (or of log_dir itself if it is
+    a log file) into the times and playback deques used by the replay experiment_logic.
+    """
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.times = deque()
+        self.playback = deque()
+
+    def _log_file(self):
+        if os.path.isfile(self.log_dir):
+            return self.log_dir
+        logs = sorted(file for file in os.listdir(self.log_dir) if file.endswith('.log'))
+        assert len(logs) > 0, f"No log file found in {self.log_dir}"
+        return os.path.join(self.log_dir, logs[-1])
+
+    def parse_from_time(self, start_time):
+        df = read_log(self._log_file())
+        df = df[df['t'] >= start_time]
+        self.times = deque((df['t'] - start_time).tolist())
+        self.playback = deque(map(tuple, df[['mfc1_stpt', 'mfc2_stpt', 'mfc3_stpt']].values.tolist()))
+
+    def parse(self):
+        self.parse_from_time(0.0)
+
+class MockHardware:
+    """
+    Stand-in for the MFCs and LEDs of the rig with latency modeling
+
+    send() receives the (air_sp, odor1_sp, odor2_sp, led1_sp, led2_sp) setpoints of a frame.
+    Every command reaches its device after a command latency (serial write and device
+    response, with optional gaussian jitter); the MFC flows then follow the new setpoint
+    with a first-order response of time constant mfc_tau, the LEDs switch immediately.
+    The delivered stimulus is recorded at every send (or sample) for latency analyses.
+
+    All times are in the clock of the frames (seconds), so the model runs faster than real time.
+
+    Parameters
+    ----------
+    command_latency : float
+        Delay between sending a setpoint and the device applying it (s)
+    latency_jitter : float
+        Standard deviation of the command latency (s)
+    mfc_tau : float
+        Time constant of the MFC flow response (s)
+    led_latency : float, optional
+        Command latency of the LEDs (default: command_latency)
+    seed : int
+        Seed of the latency jitter
+    """
+    def __init__(self, command_latency=0.01, latency_jitter=0.0, mfc_tau=0.3, led_latency=None, seed=0):
+        self.command_latency = command_latency
+        self.latency_jitter = latency_jitter
+        self.mfc_tau = mfc_tau
+        self.led_latency = command_latency if led_latency is None else led_latency
+        self.rng = np.random.default_rng(seed)
+        n = len(SETPOINTS)
+        self._tau = [mfc_tau]*3 + [0.0]*(n - 3)
+        self._latency = [command_latency]*3 + [self.led_latency]*(n - 3)
+        self._pending = [deque() for _ in range(n)] # (apply time, value)
+        self._level = [None]*n # delivered value at _time
+        self._target = [None]*n
+        self._sent = [None]*n # last value sent
+        self._time = [0.0]*n
+        self.commands = 0
+        self.times = []
+        self.delivered = []
+        self.changes = [] # (time, channel, previous value, new value)
+
+    def _advance(self, channel, t):
+        # apply the pending commands up to t and evolve the level to t
+        pending, tau = self._pending[channel], self._tau[channel]
+        while True:
+            if pending and pending[0][0] <= t:
+                until, value = pending.popleft()
+            else:
+                until, value = t, None
+            target, level = self._target[channel], self._level[channel]
+            if target is not None and level is not None and until > self._time[channel]:
+                if tau > 0:
+                    level = target + (level - target)*math.exp(-(until - self._time[channel])/tau)
+                else:
+                    level = target
+            self._level[channel], self._time[channel] = level, max(until, self._time[channel])
+            if value is None:
+                return
+            self._target[channel] = value
+            if self._level[channel] is None or tau == 0:
+                self._level[channel] = value
+
+    def write(self, t, channel, value):
+        """
+        Send a setpoint to a single device at time t (channel is an index in SETPOINTS)
+        """
+        value = float(value)
+        if value != self._sent[channel]:
+            if self._sent[channel] is not None:
+                self.changes.append((t, channel, self._sent[channel], value))
+            self._sent[channel] = value
+        latency = self._latency[channel]
+        if self.latency_jitter:
+            latency = max(latency + self.rng.normal(0, self.latency_jitter), 0.0)
+        # a device applies the commands in order
+        apply = t + latency
+        if self._pending[channel]:
+            apply = max(apply, self._pending[channel][-1][0])
+        self._pending[channel].append((apply, value))
+        self.commands += 1
+
+    def send(self, t, setpoints):
+        """
+        Send the setpoints of the frame at time t to all devices and record the delivered stimulus
+        """
+        for channel, value in enumerate(setpoints):
+            self.write(t, channel, value)
+        self.sample(t)
+
+    def sample(self, t):
+        """
+        Delivered stimulus at time t (recorded)
+        """
+        for channel in range(len(SETPOINTS)):
+            self._advance(channel, t)
+        delivered = [np.nan if level is None else level for level in self._level]
+        self.times.append(t)
+        self.delivered.append(delivered)
+        return delivered
+
+    def stimulus(self):
+        """
+        Recorded times and delivered stimulus (n x 5 array, SETPOINTS order)
+        """
+        return np.array(self.times), np.array(self.delivered, dtype=float).reshape(-1, len(SETPOINTS))
+
+    def step_latencies(self, threshold=0.9):
+        """
+        End-to-end latency of every setpoint change
+
+        The latency of a change is the time from sending it to the first recorded sample in
+        which the delivered value completed threshold of the step. Changes superseded by
+        another change of the same channel before that are counted as incomplete.
+
+        Returns
+        -------
+        report : dict
+            Per channel name: number of changes, incomplete changes and the latency
+            distribution (mean, p50, p90, max in ms) of the completed ones
+        """
+        times, delivered = self.stimulus()
+        report = {}
+        for channel, name in enumerate(SETPOINTS):
+            changes = [change for change in self.changes if change[1] == channel]
+            latencies, incomplete = [], 0
+            for i, (t, _, previous, value) in enumerate(changes):
+                end = changes[i + 1][0] if i + 1 < len(changes) else np.inf
+                start = np.searchsorted(times, t, side='left')
+                stop = np.searchsorted(times, end, side='left')
+                reached = np.nonzero(np.abs(delivered[start:stop, channel] - value) <= (1 - threshold)*abs(value - previous))[0]
+                if len(reached):
+                    latencies.append(times[start + reached[0]] - t)
+                else:
+                    incomplete += 1
+            latencies = np.array(latencies)*1e3
+            report[name] = {'changes': len(changes), 'incomplete': incomplete}
+            if len(latencies):
+                report[name].update({'mean_ms': float(latencies.mean()), 'p50_ms': float(np.percentile(latencies, 50)),
+                                     'p90_ms': float(np.percentile(latencies, 90)), 'max_ms': float(latencies.max())})
+        return report
+
+def load_config(path, **overrides):
+    """
+    Load a session config.py as a stand-in cl.config module
+    """
+    config = types.ModuleType('cl.config')
+    config.__file__ = path
+    with open(path) as f:
+        exec(compile(f.read(), path, 'exec'), config.__dict__)
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    return config
+
+def load_logic(path, config, quiet=True):
+    """
+    Load a fresh instance of an experiment_logic.py with stand-in cl modules
+
+    Parameters
+    ----------
+    path : str
+        experiment_logic.py file
+    config : module
+        Stand-in cl.config (see load_config)
+    quiet : bool
+        Replace print in the logic by a no-op
+
+    Returns
+    -------
+    module : module
+        The loaded logic (with its own global state). Calls to sleep are not executed but
+        summed in module.slept.
+    """
+    cl = types.ModuleType('cl')
+    utilities = types.ModuleType('cl.utilities')
+    utilities.FTData = FTData
+    utilities.SlidingWindow = SlidingWindow
+    utilities.InstantReplayParse = InstantReplayParse
+    cl.config, cl.utilities = config, utilities
+
+    # install the stand-ins only while the logic is imported
+    saved = {name: sys.modules.get(name) for name in ['cl', 'cl.config', 'cl.utilities']}
+    sys.modules.update({'cl': cl, 'cl.config': config, 'cl.utilities': utilities})
+    try:
+        # compiled from source (like load_config) so no __pycache__ is written in the session folder
+        module = types.ModuleType(f'experiment_logic_{id(config):x}')
+        module.__file__ = path
+        if quiet:
+            module.print = lambda *args, **kwargs: None
+        with open(path) as f:
+            exec(compile(f.read(), path, 'exec'), module.__dict__)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = value
+
+    # the harness runs faster than real time, so sleep only adds up the requested time
+    module.slept = 0.0
+    def sleep(seconds):
+        module.slept += max(seconds, 0.0)
+    module.sleep = sleep
+    return module
+
+def frames_from_log(df):
+    """
+    Time (seconds since the first frame) and FTData objects of a rig log dataframe (see read_log)
+    """
+    columns = [df['ft_' + field].values.tolist() if 'ft_' + field in df else [0.0]*len(df) for field in FT_FIELDS]
+    for t, values in zip(df['t'].values.tolist(), zip(*columns)):
+        yield t, FTData(**dict(zip(FT_FIELDS, values)))
+
+def run_logic(logic, frames, window_len=120, hardware=None, dispatcher=None, replay_at=None):
+    """
+    Run a loaded experiment_logic on a stream of frames as fast as possible
+
+    Parameters
+    ----------
+    logic : module
+        Loaded experiment_logic (see load_logic)
+    frames : iterable
+        (time, ft) pairs
+    hardware : MockHardware, optional
+        Hardware the setpoints of every frame are sent to
+    dispatcher : SetpointDispatcher, optional
+        Dispatcher the setpoints go through (its write should send to hardware)
+    replay_at : float, optional
+        Time at which the instant replay starts, as the rig runner does by setting live to
+        False (from then on frames are passed with their time since the first replay frame)
+
+    Returns
+    -------
+    result : dict
+        frames, seconds, fps, setpoints (n x 5 array, SETPOINTS order), instrip (boolean
+        array), mode (list) and slept (seconds of sleep requested by the logic)
+    """
+    sw = SlidingWindow(window_len)
+    experiment_logic = logic.experiment_logic
+    setpoints, instrip, mode = [], [], []
+    replay_start = None
+    start = time.perf_counter()
+    for t, ft in frames:
+        if replay_at is not None and replay_start is None and t >= replay_at:
+            logic.live = False
+            replay_start = t
+        if replay_start is not None:
+            t -= replay_start
+        *values, log_vals = experiment_logic(t, sw, ft)
+        setpoints.append(values)
+        if dispatcher is not None:
+            dispatcher.dispatch(t, values)
+            if hardware is not None:
+                hardware.sample(t)
+        elif hardware is not None:
+            hardware.send(t, values)
+        instrip.append(bool(log_vals.get('instrip', False)))
+        mode.append(log_vals.get('mode'))
+    seconds = time.perf_counter() - start
+    return {
+        'frames': len(setpoints),
+        'seconds': seconds,
+        'fps': len(setpoints)/seconds if seconds > 0 else np.inf,
+        'setpoints': np.array(setpoints, dtype=float).reshape(-1, len(SETPOINTS)),
+        'instrip': np.array(instrip, dtype=bool),
+        'mode': mode,
+        'slept': getattr(logic, 'slept', 0.0),
+    }
+
+def compare_setpoints(setpoints, df, atol=1e-6):
+    """
+    Compare setpoints (n x 5, SETPOINTS order) against the logged setpoint columns
+
+    Returns a dictionary with, per column, the fraction of matching frames and the
+    maximum absolute difference, and the overall fraction of frames matching on all columns.
+    """
+    logged = df[SETPOINT_COLUMNS].values.astype(float)
+    close = np.isclose(setpoints, logged, atol=atol, equal_nan=True)
+    report = {column: {'match': float(close[:, i].mean()), 'max_abs_diff': float(np.nanmax(np.abs(setpoints[:, i] - logged[:, i]), initial=0.0))}
+              for i, column in enumerate(SETPOINT_COLUMNS)}
+    report['all'] = float(close.all(axis=1).mean())
+    return report
+
+def run_session(folder, log=None, frames=None, logic_path=None, quiet=True, hardware=None, dispatcher=None, template=None, replay_at=None, **overrides):
+    """
+    Run the experiment_logic of a session on a recorded or synthetic FicTrac stream
+
+    Parameters
+    ----------
+    folder : str
+        Session folder (config.py and experiment_logic.py)
+    log : str, optional
+        Log to replay (default: the log of the session). The logged setpoints are compared
+        with the setpoints of the logic.
+    frames : iterable, optional
+        (time, ft) pairs to run instead of a log (no comparison)
+    logic_path : str, optional
+        experiment_logic.py to run instead of the one of the session
+    quiet : bool
+        Silence the prints of the logic
+    hardware : MockHardware, optional
+        Hardware the setpoints are sent to
+    dispatcher : SetpointDispatcher, optional
+        Dispatcher the setpoints go through
+    template : str or LogicTemplate, optional
+        Run a flytrailvr.logic template (name, content hash or template) instead of a file
+        (default for sessions with a reference file and no experiment_logic.py)
+    replay_at : float, optional
+        Time at which the instant replay starts (see run_logic)
+    **overrides
+        Config values to override
+
+    Returns
+    -------
+    result : dict
+        See run_logic, plus the session name and the comparison with the log
+    """
+    df = None
+    if frames is None:
+        if log is None:
+            logs = [file for file in os.listdir(folder) if file.endswith('.log')]
+            assert len(logs) == 1, f"{folder} must contain exactly one log file (or pass log or frames)."
+            log = os.path.join(folder, logs[0])
+        df = read_log(log)
+        frames = frames_from_log(df)
+
+    # instant replay reads the log of the session instead of the rig log folder
+    overrides.setdefault('log_dir', log if log is not None else folder)
+    config = load_config(os.path.join(folder, 'config.py'), **overrides)
+    if template is None and logic_path is None and not os.path.isfile(os.path.join(folder, 'experiment_logic.py')):
+        # session referencing a template instead of a copy
+        from .logic import session_template
+        template, _ = session_template(folder)
+    if template is not None:
+        from .logic import get_template
+        logic = (get_template(template) if isinstance(template, str) else template).build(config)
+    else:
+        logic = load_logic(logic_path or os.path.join(folder, 'experiment_logic.py'), config, quiet)
+
+    result = run_logic(logic, frames, getattr(config, 'window_len', 120), hardware, dispatcher, replay_at)
+    result['session'] = os.path.basename(os.path.normpath(folder))
+    if df is not None:
+        result['comparison'] = compare_setpoints(result['setpoints'], df)
+        result['instrip_match'] = float((result['instrip'] == df['instrip'].values).mean())
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Run session experiment_logic files offline on their logs.')
+    parser.add_argument('folders', nargs='+', type=str, help='Session folders (or folders of session folders).')
+    parser.add_argument('--logic', default=None, type=str, help='experiment_logic.py to run instead of the one of each session.')
+    parser.add_argument('--verbose', action='store_true', help='Show the prints of the logic.')
+    args = parser.parse_args()
+
+    sessions = []
+    for folder in args.folders:
+        if os.path.isfile(os.path.join(folder, 'config.py')):
+            sessions.append(folder)
+        else:
+            sessions += [os.path.join(folder, session) for session in sorted(os.listdir(folder)) if os.path.isfile(os.path.join(folder, session, 'config.py'))]
+
+    for folder in sessions:
+        if not any(file.endswith('.log') for file in os.listdir(folder)):
+            continue
+        result = run_session(folder, logic_path=args.logic, quiet=not args.verbose)
+        comparison = result['comparison']
+        columns = ', '.join(f"{column} {comparison[column]['match']*100:.1f}%" for column in SETPOINT_COLUMNS)
+        print(f"{result['session']}: {result['frames']} frames at {result['fps']:.0f} fps | setpoints match {comparison['all']*100:.1f}% ({columns}) | instrip match {result['instrip_match']*100:.1f}%")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+# Description: Shared, versioned experiment_logic templates for the rig
+
+import os
+import json
+import math
+import hashlib
+import argparse
+from .closed_loop import FlowrateSchedule, ReplayScheduler, StripGeometry, config_value
+
+# file referencing the template of a session (instead of a copy of experiment_logic.py)
+REFERENCE_FILE = 'experiment_logic.json'
+
+# y beyond which the fly is at the absolute edge of the arena and the onset is reset
+Y_LIMIT = 100000
+
+class StripLogic:
+    """
+    Parameterized experiment_logic of the strip experiments
+
+    Same decisions as the session experiment_logic.py files: clean air until pre_onset_time,
+    onset at the position of the first frame after it, then the stimulus in the (tilted,
+    periodic) strip and reset of the onset at the absolute edge of the arena. The geometry,
+    the flowrate schedule and the setpoint tuples are precomputed from the config, and
+    nothing is printed (pass a FrameLogger to record the frames).
+
+    Parameters
+    ----------
+    config : dict or module
+        Session config (cl.config on the rig)
+    stimulus : str
+        'led' (1 - led_intensity/100 on led1 in the strip) or 'odor' (percent_odor of the
+        flow on odor1 in the strip)
+    alternated : bool
+        Alternate the flowrate between flowrate_high and flowrate_low every alternation_time
+    replay : bool
+        Support instant replay (set live to False to replay the setpoint timeline of the
+        latest log in log_dir, see ReplayScheduler; the nearest recorded setpoint is played
+        instead of sleeping until the next one). Without it the logic stays live.
+    strip_led : float
+        led1 setpoint in the strip for the odor stimulus (1.0 is off)
+    logger : FrameLogger, optional
+        Logger receiving (time, mode, x, y, instrip, air_sp, odor1_sp, odor2_sp, led1_sp, led2_sp)
+    """
+    def __init__(self, config, stimulus='led', alternated=False, replay=False, strip_led=1.0, logger=None):
+        assert stimulus in ['led', 'odor'], "stimulus must be 'led' or 'odor'."
+        self.config = config
+        self.stimulus = stimulus
+        self.alternated = alternated
+        self.replay = replay
+        self.logger = logger
+
+        # the in-strip test is horizontal only, the absolute edge is checked separately
+        self.geometry = StripGeometry(
+            config_value(config, 'strip_width'),
+            config_value(config, 'strip_angle', 0),
+            config_value(config, 'strip_direction', 'right'),
+            config_value(config, 'periodic_boundary', False),
+            config_value(config, 'period_width'),
+            y_limit=math.inf,
+        )
+        flowrate = config_value(config, 'flowrate')
+        if alternated:
+            self.schedule = FlowrateSchedule.from_config(config)
+        else:
+            self.schedule = FlowrateSchedule(flowrate, pre_onset_time=config_value(config, 'pre_onset_time', 0.0))
+        self.pre_onset_time = config_value(config, 'pre_onset_time', 0.0)
+
+        # setpoint tuples of each flowrate phase (same expressions as experiment_logic.py)
+        self._pre = (flowrate/1000., 0.0, 0.0, 1.0, 0.0)
+        self._out, self._in = [], []
+        for target_flowrate in (self.schedule.flowrate_high, self.schedule.flowrate_low):
+            self._out.append((float(target_flowrate/1000.), 0.0, 0.0, 1.0, 0.0))
+            if stimulus == 'led':
+                self._in.append((float(target_flowrate/1000.), 0.0, 0.0, 1.0 - (config_value(config, 'led_intensity')/100.), 0.0))
+            else:
+                odor1_sp = (target_flowrate/1000.)*(config_value(config, 'percent_odor')/100)
+                self._in.append((float(target_flowrate/1000.) - odor1_sp, odor1_sp, 0.0, strip_led, 0.0))
+        self._edge = self._out if alternated else [self._pre, self._pre]
+
+        self.scheduler = None
+        self.state = {}
+        self.reset()
+
+    @property
+    def live(self):
+        return self.state['live']
+
+    @live.setter
+    def live(self, value):
+        self.state['live'] = value
+
+    @property
+    def pre(self):
+        return self.state['pre']
+
+    @pre.setter
+    def pre(self, value):
+        self.state['pre'] = value
+
+    def reset(self):
+        """
+        Restart the experiment (pre-onset, live)
+        """
+        self.pre = True
+        self.live = True
+        self.x0 = self.y0 = self.t0 = None
+        self.log_vals = {'instrip': False, 'adapted_center': math.nan, 'strip_thresh': math.nan}
+
+    def bind(self, namespace):
+        """
+        Keep live and pre in a namespace (the globals of an experiment_logic.py stub)
+
+        The rig runner starts the instant replay by setting the global live of the logic
+        module to False, and reads it back once the replay is over.
+        """
+        namespace['live'], namespace['pre'] = self.live, self.pre
+        self.state = namespace
+
+    def _replay_log(self):
+        log_dir = config_value(self.config, 'log_dir')
+        if os.path.isfile(log_dir):
+            return log_dir
+        logs = sorted(file for file in os.listdir(log_dir) if file.endswith('.log'))
+        assert len(logs) > 0, f"No log file found in {log_dir}"
+        return os.path.join(log_dir, logs[-1])
+
+    def experiment_logic(self, time, sw, ft):
+        """
+        Setpoints of a frame (same signature and return values as experiment_logic.py)
+        """
+        log_vals = self.log_vals
+        state = self.state
+        x = y = math.nan
+        if state['live'] or not self.replay:
+            if time < self.pre_onset_time and state['pre']:
+                setpoints = self._pre
+                log_vals['instrip'] = False
+                log_vals['adapted_center'] = math.nan
+                log_vals['strip_thresh'] = math.nan
+
+            elif state['pre']:
+                # onset
+                setpoints = self._pre
+                log_vals['instrip'] = False
+                log_vals['adapted_center'] = math.nan
+                log_vals['strip_thresh'] = math.nan
+                state['pre'] = False
+                self.x0, self.y0, self.t0 = ft.posx, ft.posy, time
+
+            else:
+                x, y = ft.posx - self.x0, ft.posy - self.y0
+                phase = self.schedule.phase(time - self.t0)
+                inside, adapted_center, strip_thresh = self.geometry.classify(x, y)
+                if not inside:
+                    log_vals['instrip'] = False
+                    setpoints = self._out[phase]
+                elif -Y_LIMIT < y < Y_LIMIT:
+                    log_vals['instrip'] = True
+                    setpoints = self._in[phase]
+                    log_vals['adapted_center'] = adapted_center
+                    log_vals['strip_thresh'] = strip_thresh
+                else:
+                    # absolute edge, reset the onset
+                    setpoints = self._edge[phase]
+                    state['pre'] = True
+                    log_vals['instrip'] = False
+                    log_vals['adapted_center'] = math.nan
+                    log_vals['strip_thresh'] = math.nan
+        else:
+            if self.scheduler is None:
+                start_time = 0.0 if config_value(self.config, 'include_pre_air', True) else self.pre_onset_time
+                self.scheduler = ReplayScheduler.from_log(self._replay_log(), start_time)
+            replayed = self.scheduler.setpoint(time)
+            if replayed is None:
+                # end of the replay
+                replayed = (0.0, 0.0, 0.0)
+                state['live'] = True
+                state['pre'] = True
+            setpoints = (replayed[0], replayed[1], replayed[2], 0.0, 0.0)
+
+        log_vals['mode'] = 'live' if state['live'] or not self.replay else 'replay'
+        if self.logger is not None:
+            self.logger.log(time, log_vals['mode'], x, y, log_vals['instrip'], *setpoints)
+        return (*setpoints, log_vals)
+
+class LogicTemplate:
+    """
+    Named, versioned parameter set of StripLogic
+
+    The content hash identifies the template (name, version and parameters) in REGISTRY.
+
+    Parameters
+    ----------
+    name : str
+        Name of the logic variant
+    version : int
+        Version of the template (bump it whenever the behaviour changes)
+    description : str
+        One line description
+    **params
+        Keyword arguments of StripLogic
+    """
+    def __init__(self, name, version, description='', **params):
+        self.name = name
+        self.version = version
+        self.description = description
+        self.params = params
+        content = json.dumps({'name': name, 'version': version, 'params': params}, sort_keys=True)
+        self.hash = hashlib.sha256(content.encode()).hexdigest()
+
+    def build(self, config, logger=None):
+        """
+        StripLogic of the template for a session config
+        """
+        return StripLogic(config, logger=logger, **self.params)
+
+    def reference(self):
+        """
+        Content of the reference file of a session using the template
+        """
+        return {'template': self.name, 'version': self.version, 'hash': self.hash}
+
+    def stub(self):
+        """
+        Source of an experiment_logic.py importing the template on the rig
+        """
+        return (f'# experiment_logic from the flytrailvr template {self.name} (version {self.version})\n'
+                f'import cl.config as cfg\n'
+                f'from flytrailvr.logic import build_logic\n\n'
+                f'logic = build_logic({self.name!r}, {self.version}, cfg)\n'
+                f'logic.bind(globals()) # live and pre are module globals, as in the copies\n'
+                f'experiment_logic = logic.experiment_logic\n')
+
+    def __repr__(self):
+        return f'LogicTemplate({self.name!r}, version={self.version}, hash={self.hash[:12]})'
+
+# registered templates by content hash
+REGISTRY = {}
+
+def register(template):
+    """
+    Add a template to the registry (a name and version can only be registered once)
+    """
+    for other in REGISTRY.values():
+        assert (other.name, other.version) != (template.name, template.version) or other.hash == template.hash, \
+            f"{template.name} version {template.version} is already registered with other parameters."
+    REGISTRY[template.hash] = template
+    return template
+
+def get_template(name, version=None):
+    """
+    Template by name (latest version if version is None) or by content hash
+    """
+    if name in REGISTRY:
+        return REGISTRY[name]
+    versions = [template for template in REGISTRY.values() if template.name == name and (version is None or template.version == version)]
+    assert len(versions) > 0, f"No template {name}" + (f" version {version}" if version is not None else '')
+    return max(versions, key=lambda template: template.version)
+
+def build_logic(name, version=None, config=None, logger=None):
+    """
+    StripLogic of a registered template for a session config
+    """
+    return get_template(name, version).build(config, logger)
+
+LED_STRIP = register(LogicTemplate('led_strip', 1, 'LED in the strip, constant flowrate', stimulus='led'))
+LED_STRIP_ALTERNATED = register(LogicTemplate('led_strip_alternated', 1, 'LED in the strip, alternated flowrate', stimulus='led', alternated=True))
+ODOR_STRIP_ALTERNATED = register(LogicTemplate('odor_strip_alternated', 1, 'Odor in the strip, alternated flowrate', stimulus='odor', alternated=True))
+ODOR_STRIP_REPLAY = register(LogicTemplate('odor_strip_replay', 1, 'Odor in the strip with instant replay', stimulus='odor', replay=True))
+ODOR_LED_STRIP_REPLAY = register(LogicTemplate('odor_led_strip_replay', 1, 'Odor and LED in the strip with instant replay', stimulus='odor', replay=True, strip_led=0.0))
+
+# md5 of the experiment_logic.py copies of the recorded sessions and their template
+LEGACY_LOGIC = {
+    '32b0ab31c8955dafcddb057a6f720ac6': LED_STRIP.hash,
+    'c6d5e5948fa995121408ec467d44a871': LED_STRIP_ALTERNATED.hash,
+    '44786e3fe84c8974ba1d233206f9e30f': ODOR_STRIP_ALTERNATED.hash,
+    '9436e4b880e30738d9b3e90f852d9698': ODOR_STRIP_REPLAY.hash,
+    '6098569dd67acd2d59e6402c2e87a5d2': ODOR_LED_STRIP_REPLAY.hash,
+}
+
+def identify_logic(path):
+    """
+    Template of an experiment_logic.py copy (None if the copy is not a known one)
+    """
+    with open(path, 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()
+    return REGISTRY.get(LEGACY_LOGIC.get(digest))
+
+def session_template(folder):
+    """
+    Template of a session (from its reference file, else from its experiment_logic.py copy)
+
+    Returns (template, source) where source is 'reference', 'copy' or None if unknown.
+    """
+    reference = os.path.join(folder, REFERENCE_FILE)
+    if os.path.isfile(reference):
+        with open(reference) as f:
+            content = json.load(f)
+        template = REGISTRY.get(content.get('hash')) or get_template(content['template'], content['version'])
+        return template, 'reference'
+    logic = os.path.join(folder, 'experiment_logic.py')
+    if os.path.isfile(logic):
+        template = identify_logic(logic)
+        if template is not None:
+            return template, 'copy'
+    return None, None
+
+def reference_session(folder, remove_copy=False):
+    """
+    Write the reference file of a session with a known experiment_logic.py copy
+
+    Parameters
+    ----------
+    folder : str
+        Session folder
+    remove_copy : bool
+        Remove the experiment_logic.py copy once referenced
+
+    Returns
+    -------
+    template : LogicTemplate
+        Template of the session (None if the copy is not a known one, nothing is written)
+    """
+    template, source = session_template(folder)
+    if template is None:
+        return None
+    if source == 'copy':
+        with open(os.path.join(folder, REFERENCE_FILE) + '.part', 'w') as f:
+            json.dump(template.reference(), f, indent=2)
+        os.replace(os.path.join(folder, REFERENCE_FILE) + '.part', os.path.join(folder, REFERENCE_FILE))
+    if remove_copy and os.path.isfile(os.path.join(folder, 'experiment_logic.py')) and identify_logic(os.path.join(folder, 'experiment_logic.py')) is template:
+        os.remove(os.path.join(folder, 'experiment_logic.py'))
+    return template
+
+def catalog(data_folder):
+    """
+    Logic template of every session of a data folder
+
+    Returns a dataframe with the session, template, version, hash and source ('reference',
+    'copy' or None), e.g. catalog(folder).groupby('template').size().
+    """
+    import pandas as pd
+    rows = []
+    for session in sorted(os.listdir(data_folder)):
+        folder = os.path.join(data_folder, session)
+        if not os.path.isdir(folder):
+            continue
+        template, source = session_template(folder)
+        rows.append({
+            'session': session,
+            'template': template.name if template is not None else None,
+            'version': template.version if template is not None else None,
+            'hash': template.hash if template is not None else None,
+            'source': source,
+        })
+    return pd.DataFrame(rows, columns=['session', 'template', 'version', 'hash', 'source'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Catalog and reference the experiment_logic templates of sessions.')
+    parser.add_argument('data_folder', type=str, help='Folder containing the session folders.')
+    parser.add_argument('--reference', action='store_true', help='Write a reference file to every session with a known experiment_logic.py copy.')
+    parser.add_argument('--remove_copy', action='store_true', help='Remove the experiment_logic.py copies once referenced.')
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.data_folder), "data_folder is not a folder"
+    if args.reference:
+        for session in sorted(os.listdir(args.data_folder)):
+            if os.path.isdir(os.path.join(args.data_folder, session)):
+                reference_session(os.path.join(args.data_folder, session), args.remove_copy)
+    df = catalog(args.data_folder)
+    print(df.groupby(['template', 'version'], dropna=False).agg(sessions=('session', 'size'), sources=('source', lambda x: ','.join(sorted(set(map(str, x)))))))
+    unknown = df[df['template'].isna()]
+    if len(unknown):
+        print(f'{len(unknown)} sessions without a known template: {", ".join(unknown["session"])}')
+
+if __name__ == "__main__":
+    main()
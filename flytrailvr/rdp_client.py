@@ -1,122 +1,1549 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 import zipfile
 import os
+import io
+import re
+import json
+import hashlib
+import base64
+import shutil
+import struct
+import zlib
+import time
+import bisect
 import argparse
-from split_file_reader import SplitFileReader
-from split_file_reader.split_file_writer import SplitFileWriter
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-def unlock_and_unzip_file(data2unzip, key_dir='key.key',multifile=False):
-    # check if key exists
+# STREAMING CONTAINER FORMAT (version 1)
+#
+# header : MAGIC (4 bytes) | version (1 byte) | chunk size (4 bytes) | stream id (16 bytes)
+# record : token length (4 bytes) | raw (base64-decoded) Fernet token
+#
+# Every token encrypts CHUNK_HEADER (stream id, chunk index, final flag) followed by
+# chunk_size bytes of data (less for the final chunk, which may be empty). Each chunk
+# is authenticated by Fernet and the header binds it to its stream and position, so
+# reordered, spliced or truncated archives fail to decrypt. All records but the last
+# have the same length, so any chunk can be located without reading the others.
+# Files not starting with MAGIC are legacy archives (a single base64 Fernet token).
+#
+# MANIFEST
+#
+# zip_and_lock_folder writes {first split}.manifest next to the archive (data.ezip.manifest
+# for data.ezip, data.ezip.000.manifest for data.ezip.000, data.ezip.001, ...). It is a streaming format
+# archive (same key) of a JSON document listing the splits in order with their file
+# names (relative to the manifest), encrypted sizes, sha256 of the encrypted bytes and
+# plaintext sizes, so splits are found without listing directories and missing or
+# corrupt splits are detected before anything is decrypted.
+#
+# The manifest also indexes the zip members (name, offset of the local header in the
+# zip stream, sizes, crc, compression, and the split and chunk holding the header), so
+# members are listed without decrypting any split and extracted by decrypting only the
+# chunks they occupy.
+#
+# INCREMENTAL ARCHIVES
+#
+# lock_folder_incremental packs a folder into numbered archives {folder}-0000.ezip (base),
+# {folder}-0001.ezip, ... (deltas) and keeps an encrypted state {folder}.ezstate mapping
+# every file to its size, mtime and sha256, and every sha256 ever archived to the archive
+# and member holding it. Each run only packs files whose content is not archived yet, and
+# restore_incremental rebuilds the tree of the last run from the base and the deltas.
+#
+# ZIP STREAM
+#
+# The zip stream is written by _ZipWriter (zip APPNOTE 6.3.x, stored and deflated members).
+# Members whose data is compressed ahead in worker processes have complete local headers;
+# members compressed while streaming are followed by a data descriptor holding their crc
+# and sizes, as the encrypted writers cannot seek back. ZIP64 extra fields and end records
+# are written when sizes, offsets or the number of members need them.
+#
+# JOURNALS
+#
+# Files are written to {name}.part and renamed when complete. While locking split
+# archives, {archive}.journal records the completed splits and the zip entries of the
+# members they hold; a rerun with the same parameters and unchanged files keeps those
+# splits and zips only the remaining members. While unlocking, {archive}.extract.journal
+# records the extracted members, which a rerun skips. Journals are encrypted and removed
+# once the operation completes.
+
+MAGIC = b'RDPS'
+FORMAT_VERSION = 1
+CHUNK_SIZE = 1_048_576
+FILE_HEADER = struct.Struct('>4sBI16s')
+RECORD_HEADER = struct.Struct('>I')
+CHUNK_HEADER = struct.Struct('>16sQ?')
+MANIFEST_VERSION = 1
+STATE_VERSION = 1
+JOURNAL_VERSION = 1
+JOURNAL_INTERVAL = 2.0 # seconds between extraction journal updates
+
+# adaptive compression: already compressed formats are stored, other files are stored
+# if samples of them do not deflate below SAMPLE_RATIO, larger files get faster levels
+STORED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.avi', '.mp4', '.mkv', '.mov', '.zip', '.ezip', '.gz', '.bz2', '.xz', '.7z', '.npz'}
+SAMPLE_SIZE = 65_536
+SAMPLE_RATIO = 0.9
+DEFLATE_LEVELS = [(1_048_576, 9), (67_108_864, 6), (float('inf'), 1)] # (files smaller than, level)
+PRECOMPRESS_LIMIT = 67_108_864 # larger files are compressed while streaming, not in workers
+
+# zip records (little endian) and the limits above which ZIP64 fields are used
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_LIMIT = (1 << 31) - 1 # as zipfile, for readers of signed 32 bit fields
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+class CorruptArchiveError(Exception):
+    pass
+
+class _HashingFile:
+    # write-through file wrapper hashing and counting the bytes written
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _SplitHash:
+    # running sha256 of a split fed by the reads of the _HashingReader files it opens, so
+    # a split is hashed while it is decrypted instead of being read once more for that
+    def __init__(self, path):
+        self.path = path
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+
+    def open(self):
+        return _HashingReader(open(self.path, 'rb'), self)
+
+    def hash_to(self, fileobj, end, block_size=CHUNK_SIZE):
+        # hash the bytes up to end that were not read yet (the position of fileobj is kept)
+        position = fileobj.tell()
+        fileobj.seek(self.hashed)
+        while self.hashed < end:
+            block = fileobj.read(min(block_size, end - self.hashed))
+            if not block:
+                break
+            self.hasher.update(block)
+            self.hashed += len(block)
+        fileobj.seek(position)
+
+    def hexdigest(self):
+        # hash of the whole split (the bytes never read are read now)
+        with open(self.path, 'rb') as f:
+            self.hash_to(f, f.seek(0, io.SEEK_END))
+        return self.hasher.hexdigest()
+
+class _HashingReader:
+    # read-through file wrapper passing the bytes read to a _SplitHash in order (bytes
+    # skipped by a seek are hashed when reading past them)
+    def __init__(self, fileobj, split_hash):
+        self.fileobj = fileobj
+        self.name = fileobj.name
+        self.split_hash = split_hash
+
+    def read(self, size=-1):
+        start = self.fileobj.tell()
+        if start > self.split_hash.hashed:
+            self.split_hash.hash_to(self.fileobj, start)
+        data = self.fileobj.read(size)
+        skip = self.split_hash.hashed - start
+        if 0 <= skip < len(data):
+            self.split_hash.hasher.update(memoryview(data)[skip:])
+            self.split_hash.hashed = start + len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _token_size(plaintext_size):
+    # version + timestamp + iv + padded AES-CBC ciphertext + hmac
+    return 1 + 8 + 16 + (plaintext_size // 16 + 1) * 16 + 32
+
+def _encrypt_chunk(fernet, stream_id, index, final, data):
+    token = fernet.encrypt(CHUNK_HEADER.pack(stream_id, index, final) + bytes(data))
+    return base64.urlsafe_b64decode(token)
+
+def _decrypt_chunk(fernet, raw_token):
+    return fernet.decrypt(base64.urlsafe_b64encode(raw_token))
+
+# picklable versions for worker processes (building a Fernet from the key is cheap)
+def _encrypt_chunk_with_key(key, stream_id, index, final, data):
+    return _encrypt_chunk(Fernet(key), stream_id, index, final, data)
+
+def _decrypt_chunk_with_key(key, raw_token):
+    return _decrypt_chunk(Fernet(key), raw_token)
+
+def _executor(workers):
+    # process pool for chunk encryption/decryption (none for a single worker)
+    if workers is None or workers > 1:
+        return ProcessPoolExecutor(max_workers=workers)
+    return nullcontext()
+
+def _max_pending(executor):
+    # chunks in flight per stream: enough to keep every worker busy
+    return 2 * (executor._max_workers if executor is not None else 1)
+
+class EncryptedWriter(io.RawIOBase):
+    """
+    Write-only file object encrypting everything written to it in the streaming format
+
+    Only one chunk of plaintext is held in memory. tell() reports the plaintext
+    position; the writer cannot seek (zipfile then writes data descriptors).
+
+    With an executor, chunks are encrypted in the worker processes and written in order;
+    at most max_pending chunks are in flight, which bounds the memory used.
+    """
+    def __init__(self, fileobj, key, chunk_size=CHUNK_SIZE, executor=None, max_pending=None):
+        self.fileobj = fileobj
+        self.key = key
+        self.fernet = Fernet(key)
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.max_pending = max_pending if max_pending is not None else _max_pending(executor)
+        self.pending = deque()
+        self.stream_id = os.urandom(16)
+        self.buffer = bytearray()
+        self.index = 0
+        self.position = 0
+        self.fileobj.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION, chunk_size, self.stream_id))
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def _write_record(self, raw_token):
+        self.fileobj.write(RECORD_HEADER.pack(len(raw_token)))
+        self.fileobj.write(raw_token)
+
+    def _emit(self, final, chunk):
+        if self.executor is None:
+            self._write_record(_encrypt_chunk(self.fernet, self.stream_id, self.index, final, chunk))
+        else:
+            self.pending.append(self.executor.submit(_encrypt_chunk_with_key, self.key, self.stream_id, self.index, final, bytes(chunk)))
+            # write finished chunks in order once the window is full
+            while len(self.pending) > self.max_pending or (final and self.pending):
+                self._write_record(self.pending.popleft().result())
+        self.index += 1
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        # keep at least one byte back so the final chunk is never a full chunk written early
+        while len(self.buffer) > self.chunk_size:
+            chunk = self.buffer[:self.chunk_size]
+            del self.buffer[:self.chunk_size]
+            self._emit(False, chunk)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._emit(True, self.buffer)
+            self.buffer = bytearray()
+            self.fileobj.flush()
+        super().close()
+
+class EncryptedReader(io.RawIOBase):
+    """
+    Seekable read-only file object decrypting a streaming format archive
+
+    Chunks are decrypted on demand (one chunk is cached), so reading is done in
+    constant memory and seeking only decrypts the chunks that are actually read.
+
+    With an executor, the chunks following the one being read (up to prefetch of them)
+    are decrypted ahead in the worker processes; a seek outside this window drops them.
+    """
+    def __init__(self, fileobj, key, executor=None, prefetch=None):
+        self.fileobj = fileobj
+        self.name = getattr(fileobj, 'name', 'archive')
+        self.key = key
+        self.fernet = Fernet(key)
+        self.executor = executor
+        self.prefetch = prefetch if prefetch is not None else _max_pending(executor)
+        self.futures = {}
+        header = fileobj.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            raise CorruptArchiveError(f'{self.name}: truncated header')
+        magic, version, self.chunk_size, self.stream_id = FILE_HEADER.unpack(header)
+        if magic != MAGIC:
+            raise CorruptArchiveError(f'{self.name}: not a streaming format archive')
+        if version != FORMAT_VERSION:
+            raise CorruptArchiveError(f'{self.name}: unsupported format version {version}')
+        self.record_size = RECORD_HEADER.size + _token_size(CHUNK_HEADER.size + self.chunk_size)
+        self.end = fileobj.seek(0, io.SEEK_END)
+        body = self.end - FILE_HEADER.size
+        self.n_chunks = max((body + self.record_size - 1) // self.record_size, 1)
+        self.position = 0
+        self.cached_index = None
+        self.cached_chunk = None
+        self._size = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read_chunk(self, index):
+        # decrypt and authenticate chunk index
+        if index == self.cached_index:
+            return self.cached_chunk
+        try:
+            plaintext = self._decrypt(index)
+        except (InvalidToken, ValueError) as e:
+            raise CorruptArchiveError(f'{self.name}: chunk {index} failed authentication') from e
+        stream_id, chunk_index, final = CHUNK_HEADER.unpack_from(plaintext)
+        if stream_id != self.stream_id or chunk_index != index:
+            raise CorruptArchiveError(f'{self.name}: chunk {index} does not belong here')
+        if final != (index == self.n_chunks-1):
+            raise CorruptArchiveError(f'{self.name}: archive is truncated or has trailing data')
+        chunk = memoryview(plaintext)[CHUNK_HEADER.size:]
+        if not final and len(chunk) != self.chunk_size:
+            raise CorruptArchiveError(f'{self.name}: chunk {index} has the wrong size')
+        self.cached_index, self.cached_chunk = index, chunk
+        return chunk
+
+    def _read_token(self, index):
+        self.fileobj.seek(FILE_HEADER.size + index*self.record_size)
+        header = self.fileobj.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            raise CorruptArchiveError(f'{self.name}: chunk {index} is missing')
+        length = RECORD_HEADER.unpack(header)[0]
+        if index == self.n_chunks-1 and self.fileobj.tell() + length != self.end:
+            # the last record must end the file
+            raise CorruptArchiveError(f'{self.name}: archive is truncated or has trailing data')
+        return self.fileobj.read(length)
+
+    def _decrypt(self, index):
+        if self.executor is None:
+            return _decrypt_chunk(self.fernet, self._read_token(index))
+        # drop chunks outside the window (after a seek) and schedule the missing ones
+        last = min(index + self.prefetch, self.n_chunks - 1)
+        for i in [i for i in self.futures if i < index or i > last]:
+            self.futures.pop(i).cancel()
+        for i in range(index, last + 1):
+            if i not in self.futures:
+                self.futures[i] = self.executor.submit(_decrypt_chunk_with_key, self.key, self._read_token(i))
+        return self.futures.pop(index).result()
+
+    @property
+    def size(self):
+        # plaintext size (decrypts the last chunk once)
+        if self._size is None:
+            self._size = (self.n_chunks-1)*self.chunk_size + len(self.read_chunk(self.n_chunks-1))
+        return self._size
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError(f'invalid whence {whence}')
+        if self.position < 0:
+            raise ValueError('negative seek position')
+        return self.position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        written = 0
+        while written < len(view):
+            index, offset = divmod(self.position, self.chunk_size)
+            if index >= self.n_chunks:
+                break
+            chunk = self.read_chunk(index)
+            n = min(len(chunk) - offset, len(view) - written)
+            if n <= 0:
+                break
+            view[written:written+n] = chunk[offset:offset+n]
+            written += n
+            self.position += n
+        return written
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+        self.cached_chunk = None
+        self.fileobj.close()
+        super().close()
+
+def open_encrypted(path, key, executor=None):
+    """
+    Open an encrypted archive (streaming or legacy format) as a seekable file object
+
+    Legacy archives are a single Fernet token and have to be decrypted in memory (and
+    in one piece, so the executor only speeds up streaming format archives). A legacy
+    archive failing authentication raises CorruptArchiveError.
+    """
+    return _open_encrypted_file(open(path, 'rb'), key, executor)
+
+def _open_encrypted_file(fileobj, key, executor=None):
+    # open_encrypted on an open binary file (closed with the returned file object)
+    magic = fileobj.read(len(MAGIC))
+    fileobj.seek(0)
+    if magic == MAGIC:
+        return EncryptedReader(fileobj, key, executor)
+    with fileobj:
+        try:
+            return io.BytesIO(Fernet(key).decrypt(fileobj.read()))
+        except InvalidToken as e:
+            raise CorruptArchiveError(f'{fileobj.name}: failed authentication') from e
+
+def encrypt_file(source, destination, key, chunk_size=CHUNK_SIZE, workers=1):
+    # stream a plaintext file into a streaming format archive
+    with _executor(workers) as executor, open(source, 'rb') as src, open(destination, 'wb') as dst:
+        with EncryptedWriter(dst, key, chunk_size, executor) as writer:
+            shutil.copyfileobj(src, writer, chunk_size)
+
+def decrypt_file(source, destination, key, workers=1):
+    # stream an archive (streaming or legacy format) into a plaintext file
+    with _executor(workers) as executor, open_encrypted(source, key, executor) as src, open(destination, 'wb') as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+class SplitEncryptedWriter(io.RawIOBase):
+    """
+    Write-only file object splitting its plaintext into numbered streaming format archives
+
+    Split i is written to {prefix}{i:03d} and holds split_size_bytes of plaintext (the
+    last one may hold less). Splits are opened lazily, so no empty trailing split is created.
+    The executor is shared by the writers of all splits. splits holds the manifest
+    entry (name, size, sha256, plaintext_size) of every closed split.
+
+    Splits are written to {name}.part and renamed when complete, then on_split (if given)
+    is called with splits. To resume, completed holds the entries of the splits already
+    written: data written for them is dropped, and skip_to jumps ahead within them.
+    """
+    def __init__(self, prefix, key, split_size_bytes, chunk_size=CHUNK_SIZE, executor=None, completed=None, on_split=None):
+        self.prefix = prefix
+        self.key = key
+        self.split_size_bytes = split_size_bytes
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.on_split = on_split
+        self.splits = list(completed or [])
+        self.split_files = [f'{prefix}{i:03d}' for i in range(len(self.splits))]
+        self.completed_size = sum(split['plaintext_size'] for split in self.splits)
+        self.current = None
+        self.current_file = None
+        self.current_size = 0
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def skip_to(self, position):
+        # jump ahead within the completed splits
+        assert self.position <= position <= self.completed_size, "can only skip within the completed splits"
+        self.position = position
+
+    def _close_split(self):
+        if self.current is not None:
+            self.current.close()
+            self.current_file.close()
+            os.replace(f'{self.split_files[-1]}.part', self.split_files[-1])
+            self.splits.append({
+                'name': os.path.basename(self.split_files[-1]),
+                'size': self.current_file.size,
+                'sha256': self.current_file.hasher.hexdigest(),
+                'plaintext_size': self.current_size,
+            })
+            self.current = None
+            if self.on_split is not None:
+                self.on_split(self.splits)
+
+    def _open_split(self):
+        self._close_split()
+        name = f'{self.prefix}{len(self.split_files):03d}'
+        self.split_files.append(name)
+        self.current_file = _HashingFile(open(f'{name}.part', 'wb'))
+        self.current = EncryptedWriter(self.current_file, self.key, self.chunk_size, self.executor)
+        self.current_size = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        # drop data regenerated for the completed splits
+        skipped = min(len(data), max(self.completed_size - self.position, 0))
+        self.position += skipped
+        data = data[skipped:]
+        written = 0
+        while written < len(data):
+            if self.current is None or self.current_size == self.split_size_bytes:
+                self._open_split()
+            n = min(self.split_size_bytes - self.current_size, len(data) - written)
+            self.current.write(data[written:written+n])
+            self.current_size += n
+            written += n
+        self.position += written
+        return skipped + written
+
+    def close(self):
+        if not self.closed:
+            if not self.split_files:
+                self._open_split()
+            self._close_split()
+        super().close()
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            return super().__exit__(exc_type, exc, traceback)
+        # interrupted: leave the split being written as .part (never mark it complete)
+        if self.current is not None:
+            self.current_file.close()
+            self.current = None
+        io.RawIOBase.close(self)
+
+class ConcatReader(io.RawIOBase):
+    """
+    Seekable read-only file object over the concatenation of several seekable parts
+
+    parts is a list of zero-argument callables opening each part. Only one part is open
+    at a time, so legacy splits (decrypted in memory) are held one at a time. Parts are
+    opened to measure them unless their sizes are given.
+    """
+    def __init__(self, parts, sizes=None):
+        self.parts = parts
+        self.sizes = list(sizes) if sizes is not None else []
+        for opener in parts[len(self.sizes):]:
+            with opener() as part:
+                self.sizes.append(part.seek(0, io.SEEK_END))
+        self.offsets = [0]
+        for size in self.sizes:
+            self.offsets.append(self.offsets[-1] + size)
+        self.position = 0
+        self.current_index = None
+        self.current = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.offsets[-1] + offset
+        else:
+            raise ValueError(f'invalid whence {whence}')
+        if self.position < 0:
+            raise ValueError('negative seek position')
+        return self.position
+
+    def _part(self, index):
+        if index != self.current_index:
+            if self.current is not None:
+                self.current.close()
+            self.current = self.parts[index]()
+            self.current_index = index
+        return self.current
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        written = 0
+        while written < len(view) and self.position < self.offsets[-1]:
+            # find the part containing the current position
+            index = next(i for i in range(len(self.sizes)) if self.offsets[i+1] > self.position)
+            part = self._part(index)
+            part.seek(self.position - self.offsets[index])
+            n = part.readinto(view[written:written + min(len(view) - written, self.offsets[index+1] - self.position)])
+            if not n:
+                break
+            written += n
+            self.position += n
+        return written
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        super().close()
+
+def _walk_files(data2zip):
+    # paths of all files in a folder, relative to it
+    rootlen = len(data2zip) + 1 # get number of characters to remove from each file path
+    for folder, subfolders, files in os.walk(f'{data2zip}'): # walk through folders
+        subfolders.sort() # same order on every run (resuming relies on it)
+        for file in sorted(files):
+            yield os.path.join(folder, file)[rootlen:]
+
+def _choose_compression(path, size):
+    # compression method and level of a file (see STORED_EXTENSIONS)
+    if size == 0 or os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED, None
+    if size > 3*SAMPLE_SIZE:
+        # deflate samples from the start, middle and end of the file
+        with open(path, 'rb') as f:
+            sample = b''
+            for offset in (0, size//2, size-SAMPLE_SIZE):
+                f.seek(offset)
+                sample += f.read(SAMPLE_SIZE)
+        if len(zlib.compress(sample, 1)) > SAMPLE_RATIO*len(sample):
+            return zipfile.ZIP_STORED, None
+    level = next(level for limit, level in DEFLATE_LEVELS if size < limit)
+    return zipfile.ZIP_DEFLATED, level
+
+def _deflate_file(path, level):
+    # raw deflate stream, crc and size of a file (runs in worker processes)
+    with open(path, 'rb') as f:
+        data = f.read()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data), len(data)
+
+def _dos_time(date_time):
+    # MS-DOS date and time fields of a (year, month, day, hour, minute, second) tuple
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+class _ZipWriter:
+    # streaming zip writer: members are appended one after the other and the central
+    # directory is written on close (an interrupted stream is left without one); only
+    # write() and tell() of the file object are used, and offsets are its tell() values.
+    # members are ZipInfo records of members already in the stream (written by an
+    # interrupted run), which the central directory lists first
+    def __init__(self, fileobj, members=(), force_zip64=False):
+        self.fileobj = fileobj
+        self.force_zip64 = force_zip64
+        self.members = list(members)
+
+    def infolist(self):
+        return self.members
+
+    def _member(self, path, name, compress_type):
+        zinfo = zipfile.ZipInfo.from_file(path, name)
+        zinfo.compress_type = compress_type
+        zinfo.header_offset = self.fileobj.tell()
+        try:
+            zinfo.filename.encode('ascii')
+            zinfo.flag_bits = 0
+        except UnicodeEncodeError:
+            zinfo.flag_bits = 0x800 # utf-8 file name
+        return zinfo
+
+    def _write_local_header(self, zinfo, zip64):
+        # sizes and crc are zero when a data descriptor follows the data
+        name = zinfo.filename.encode('utf-8' if zinfo.flag_bits & 0x800 else 'ascii')
+        if zip64:
+            extra = struct.pack('<2H2Q', 1, 16, zinfo.file_size, zinfo.compress_size)
+            compress_size = file_size = 0xFFFFFFFF
+        else:
+            extra = b''
+            compress_size, file_size = zinfo.compress_size, zinfo.file_size
+        zinfo.extract_version = zinfo.create_version = 45 if zip64 else 20
+        dostime, dosdate = _dos_time(zinfo.date_time)
+        self.fileobj.write(LOCAL_HEADER.pack(b'PK\x03\x04', zinfo.extract_version, 0, zinfo.flag_bits, zinfo.compress_type,
+                                             dostime, dosdate, zinfo.CRC, compress_size, file_size, len(name), len(extra)))
+        self.fileobj.write(name + extra)
+
+    def write(self, path, name, compress_type=zipfile.ZIP_STORED, level=None, block_size=CHUNK_SIZE):
+        # stream a file into a member (stored, or deflated at level, zlib's default if None)
+        zinfo = self._member(path, name, compress_type)
+        zinfo.flag_bits |= 0x08 # data descriptor
+        zip64 = self.force_zip64 or zinfo.file_size*1.05 > ZIP64_LIMIT
+        zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+        self._write_local_header(zinfo, zip64)
+        compressor = None
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                zinfo.CRC = zlib.crc32(block, zinfo.CRC)
+                zinfo.file_size += len(block)
+                if compressor is not None:
+                    block = compressor.compress(block)
+                self.fileobj.write(block)
+                zinfo.compress_size += len(block)
+        if compressor is not None:
+            block = compressor.flush()
+            self.fileobj.write(block)
+            zinfo.compress_size += len(block)
+        if not zip64 and max(zinfo.file_size, zinfo.compress_size) > ZIP64_LIMIT:
+            raise RuntimeError(f'{path} grew past the ZIP64 limit while being zipped')
+        self.fileobj.write(struct.pack('<4sL2Q' if zip64 else '<4s3L', b'PK\x07\x08', zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+        self.members.append(zinfo)
+
+    def write_compressed(self, path, name, data, crc, size):
+        # append a member whose deflated data, crc and size are known (complete local header)
+        zinfo = self._member(path, name, zipfile.ZIP_DEFLATED)
+        zinfo.CRC, zinfo.file_size, zinfo.compress_size = crc, size, len(data)
+        self._write_local_header(zinfo, self.force_zip64 or max(size, len(data)) > ZIP64_LIMIT)
+        self.fileobj.write(data)
+        self.members.append(zinfo)
+
+    def close(self):
+        # central directory and end records
+        start = self.fileobj.tell()
+        for zinfo in self.members:
+            name = zinfo.filename.encode('utf-8' if zinfo.flag_bits & 0x800 else 'ascii')
+            values = []
+            file_size, compress_size, header_offset = zinfo.file_size, zinfo.compress_size, zinfo.header_offset
+            if self.force_zip64 or max(file_size, compress_size) > ZIP64_LIMIT:
+                values += [file_size, compress_size]
+                file_size = compress_size = 0xFFFFFFFF
+            if self.force_zip64 or header_offset > ZIP64_LIMIT:
+                values.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            extra = struct.pack(f'<2H{len(values)}Q', 1, 8*len(values), *values) if values else b''
+            version = 45 if values else zinfo.create_version
+            dostime, dosdate = _dos_time(zinfo.date_time)
+            self.fileobj.write(CENTRAL_HEADER.pack(b'PK\x01\x02', version, zinfo.create_system, version, 0, zinfo.flag_bits,
+                                                   zinfo.compress_type, dostime, dosdate, zinfo.CRC, compress_size, file_size,
+                                                   len(name), len(extra), 0, 0, zinfo.internal_attr, zinfo.external_attr, header_offset))
+            self.fileobj.write(name + extra)
+        end = self.fileobj.tell()
+        count, size, offset = len(self.members), end - start, start
+        if self.force_zip64 or count >= ZIP_FILECOUNT_LIMIT or size > ZIP64_LIMIT or offset > ZIP64_LIMIT:
+            self.fileobj.write(ZIP64_END_RECORD.pack(b'PK\x06\x06', ZIP64_END_RECORD.size - 12, 45, 45, 0, 0, count, count, size, offset))
+            self.fileobj.write(ZIP64_LOCATOR.pack(b'PK\x06\x07', 0, end, 1))
+            count, size, offset = min(count, ZIP_FILECOUNT_LIMIT), min(size, 0xFFFFFFFF), min(offset, 0xFFFFFFFF)
+        self.fileobj.write(END_RECORD.pack(b'PK\x05\x06', 0, 0, count, count, size, offset, 0))
+
+# fields of a written member that _ZipWriter puts in the central directory
+ZINFO_FIELDS = ['compress_type', 'create_system', 'create_version', 'flag_bits', 'internal_attr', 'external_attr',
+                'header_offset', 'CRC', 'compress_size', 'file_size']
+
+def _zinfo_to_dict(zinfo):
+    # everything the central directory needs about a written member
+    entry = {field: getattr(zinfo, field) for field in ZINFO_FIELDS}
+    entry.update(filename=zinfo.filename, date_time=list(zinfo.date_time))
+    return entry
+
+def _zinfo_from_dict(entry):
+    zinfo = zipfile.ZipInfo(entry['filename'], tuple(entry['date_time']))
+    for field in ZINFO_FIELDS:
+        setattr(zinfo, field, entry[field])
+    return zinfo
+
+def _zip_folder(data2zip, fileobj, files=None, compression='adaptive', executor=None, resume=None, on_file=None):
+    # zip folder (or only the given relative paths) into a file object while preserving directory structure
+    # compression is 'deflate' (every file at the default level) or 'adaptive' (see _choose_compression),
+    # in which case files are deflated ahead in the executor (if any) and written in order
+    # resume ({'offset', 'members'} from a journal) restores members already written before offset,
+    # on_file is called with the _ZipWriter and the relative path of each file before it is read
+    # (when interrupted, the zip is left without a central directory, so a split kept for
+    # resuming does not hold one)
+    members = []
+    if resume is not None:
+        fileobj.skip_to(resume['offset'])
+        members = [_zinfo_from_dict(entry) for entry in resume['members']]
+    fullzip = _ZipWriter(fileobj, members)
+    done = {zinfo.filename for zinfo in members}
+    pending = deque()
+
+    def write_next():
+        file, path, compress_type, level, future = pending.popleft()
+        if future is not None:
+            data, crc, size = future.result()
+            if len(data) < size:
+                fullzip.write_compressed(path, file, data, crc, size)
+                return
+            # did not shrink after all
+            compress_type, level = zipfile.ZIP_STORED, None
+        fullzip.write(path, file, compress_type, level)
+
+    for file in (files if files is not None else _walk_files(data2zip)):
+        if file in done:
+            continue
+        path = os.path.join(data2zip, file)
+        if on_file is not None:
+            on_file(fullzip, file)
+        if compression == 'deflate':
+            compress_type, level = zipfile.ZIP_DEFLATED, None
+        else:
+            size = os.path.getsize(path)
+            compress_type, level = _choose_compression(path, size)
+        future = None
+        if executor is not None and compress_type == zipfile.ZIP_DEFLATED and compression != 'deflate' and size <= PRECOMPRESS_LIMIT:
+            future = executor.submit(_deflate_file, path, level)
+        pending.append((file, path, compress_type, level, future))
+        while len(pending) > _max_pending(executor):
+            write_next()
+    while pending:
+        write_next()
+    fullzip.close()
+    return fullzip.infolist()
+
+def _member_index(infolist, splits, chunk_size=CHUNK_SIZE):
+    # map every zip member to the split and chunk holding its local header
+    offsets = [0]
+    for split in splits:
+        offsets.append(offsets[-1] + split['plaintext_size'])
+    members = []
+    for info in infolist:
+        split = bisect.bisect_right(offsets, info.header_offset) - 1
+        members.append({
+            'name': info.filename,
+            'offset': info.header_offset,
+            'compress_size': info.compress_size,
+            'file_size': info.file_size,
+            'crc': info.CRC,
+            'compress_type': info.compress_type,
+            'split': split,
+            'chunk': (info.header_offset - offsets[split]) // chunk_size,
+        })
+    return members
+
+def _write_json(path, key, document):
+    # encrypt a JSON document, writing then renaming so an interrupted write leaves the previous file intact
+    with open(f'{path}.part', 'wb') as f, EncryptedWriter(f, key) as writer:
+        writer.write(json.dumps(document, indent=1).encode())
+    os.replace(f'{path}.part', path)
+
+def _write_manifest(path, key, splits, members):
+    _write_json(path, key, {'version': MANIFEST_VERSION, 'splits': splits, 'members': members})
+
+def _read_json(path, key, version):
+    with open_encrypted(path, key) as f:
+        try:
+            document = json.loads(f.read())
+        except ValueError as e:
+            raise CorruptArchiveError(f'{path} is not valid JSON') from e
+    if document.get('version') != version:
+        raise CorruptArchiveError(f'{path} has unsupported version {document.get("version")}')
+    return document
+
+def read_manifest(path, key):
+    """
+    Decrypt and parse the manifest of a locked archive
+
+    Raises CorruptArchiveError if the manifest cannot be authenticated or parsed.
+    """
+    return _read_json(path, key, MANIFEST_VERSION)
+
+def read_state(path, key):
+    """
+    Decrypt and parse the state of an incremental archive (see lock_folder_incremental)
+
+    Raises CorruptArchiveError if the state cannot be authenticated or parsed.
+    """
+    return _read_json(path, key, STATE_VERSION)
+
+def _remove(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+def _hash_split(path, block_size=CHUNK_SIZE):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def verify_manifest(manifest, folder, workers=1):
+    """
+    Check that all splits listed in a manifest exist with the right size and hash
+
+    Existence and sizes are checked first (cheap), then the splits are hashed in a
+    thread pool (hashlib releases the GIL), stopping at the first mismatch.
+
+    Returns the paths of the splits in order, raises CorruptArchiveError otherwise.
+    """
+    paths = [os.path.join(folder, split['name']) for split in manifest['splits']]
+    _check_splits(manifest, paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_hash_split, path): (path, split) for path, split in zip(paths, manifest['splits'])}
+        for future in as_completed(futures):
+            path, split = futures[future]
+            if future.result() != split['sha256']:
+                for f in futures:
+                    f.cancel()
+                raise CorruptArchiveError(f'{path} is corrupt (checksum mismatch)')
+    return paths
+
+def _check_splits(manifest, paths):
+    # check that the splits of a manifest exist with the right size (without hashing them)
+    missing = [path for path in paths if not os.path.isfile(path)]
+    if missing:
+        raise CorruptArchiveError(f'missing splits: {", ".join(missing)}')
+    for path, split in zip(paths, manifest['splits']):
+        if os.path.getsize(path) != split['size']:
+            raise CorruptArchiveError(f'{path} has size {os.path.getsize(path)}, expected {split["size"]}')
+
+def _find_splits(first_split):
+    # fallback for archives without a manifest: numbered splits next to the first one, in order
+    folder, name = os.path.split(first_split)
+    pattern = re.compile(re.escape(name[:-3]) + r'(\d{3,})$')
+    numbered = [(int(m.group(1)), file) for file in os.listdir(folder or '.') if (m := pattern.match(file))]
+    return [os.path.join(folder, file) for number, file in sorted(numbered)]
+
+def _load_key(key_dir):
+    # read and check the key (None if missing or invalid)
     try:
         with open(key_dir, "rb") as key_file:
             key = key_file.read()
-        fernet = Fernet(key)
+        Fernet(key)
+        return key
     except:
         print("Key not found, please generate a key using generate_key(), provide an existing key_dir, or locate the key.")
-        return
-    
+
+def _locate_splits(data2unzip, key, multifile, verify=True, workers=1):
+    # splits (in order), their plaintext sizes and the manifest (sizes and manifest are None without one)
+    manifest_path = f'{data2unzip}.manifest'
+    if not os.path.isfile(manifest_path):
+        return (_find_splits(data2unzip) if multifile else [data2unzip]), None, None
+    manifest = read_manifest(manifest_path, key)
+    if verify:
+        split_files = verify_manifest(manifest, os.path.dirname(data2unzip), workers)
+    else:
+        split_files = [os.path.join(os.path.dirname(data2unzip), split['name']) for split in manifest['splits']]
+    return split_files, [split['plaintext_size'] for split in manifest['splits']], manifest
+
+def _open_locked(split_files, sizes, key, executor=None, hashes=None):
+    # seekable view of the zip stream of a locked archive (splits are decrypted lazily,
+    # and hashed while being read if their _SplitHash is given)
+    if hashes is not None:
+        parts = [lambda split_hash=split_hash: _open_encrypted_file(split_hash.open(), key, executor) for split_hash in hashes]
+    else:
+        parts = [lambda split_file=split_file: open_encrypted(split_file, key, executor) for split_file in split_files]
+    return ConcatReader(parts, sizes)
+
+def _check_locked_name(data2unzip, multifile):
     if not multifile:
         # make sure its a ezip file
         assert data2unzip.split(".")[-1] == "ezip", "data2unzip is not a ezip file under RDP standards"
         # make sure its not multifile
         assert len(data2unzip.split('/')[-1].split(".")) == 2, "data2unzip is a multifile ezip file, please set multifile=True"
-        
-        # decrypt file
-        with open(data2unzip, "rb") as file:
-            encrypted_data = file.read()
-        decrypted_data = fernet.decrypt(encrypted_data)
-        with open(data2unzip.replace("ezip","zip"), "wb") as file:
-            file.write(decrypted_data)
-        
-        # unzip all files and folders
-        with zipfile.ZipFile(data2unzip.replace("ezip","zip"), 'r') as zip_ref:
-            zip_ref.extractall(data2unzip[:-5])
-        
-        # delete zip file
-        os.remove(data2unzip.replace("ezip","zip"))
     else:
         # make sure its not singlefile
         assert len(data2unzip.split('/')[-1].split(".")) == 3, "data2unzip is a singlefile ezip file, please set multifile=False"
         # make sure its the first ezip file
         assert data2unzip.split('/')[-1].split(".")[1] == "ezip" and data2unzip.split('/')[-1].split(".")[2] == "000", "data2unzip is not a multisplit ezip file under RDP standards"
-        
-        # get each split file
-        split_files = list(filter(lambda x: x.startswith(data2unzip[:-4]), os.listdir()))
-        
-        # decrypt each split file
-        for split_file in split_files:
-            with open(split_file, 'rb') as file:
-                encrypted = file.read()
-            decrypted = fernet.decrypt(encrypted)
-            with open(split_file.replace('ezip','zip'), 'wb') as decrypted_file:
-                decrypted_file.write(decrypted)
-        
-        # unzip all files and folders
-        with SplitFileReader([files.replace('ezip','zip') for files in split_files]) as sub_zip:
-            with zipfile.ZipFile(sub_zip, 'r') as zip_ref:
-                zip_ref.extractall(data2unzip[:-9])
-        
-        # delete zip files
+
+def _inflate_member(reader, member, write=None, block_size=CHUNK_SIZE):
+    # inflate one indexed member straight from the zip stream (only its chunks are decrypted),
+    # passing the data to write (if given) and checking its size and crc
+    reader.seek(member['offset'])
+    header = reader.read(LOCAL_HEADER.size)
+    fields = LOCAL_HEADER.unpack(header) if len(header) == LOCAL_HEADER.size else None
+    if fields is None or fields[0] != b'PK\x03\x04':
+        raise CorruptArchiveError(f'bad local header for {member["name"]}')
+    reader.read(fields[10] + fields[11]) # file name and extra field
+    if member['compress_type'] == zipfile.ZIP_STORED:
+        decompressor = None
+    elif member['compress_type'] == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    else:
+        raise NotImplementedError(f'compression method {member["compress_type"]} is not supported')
+
+    crc = 0
+    size = 0
+    remaining = member['compress_size']
+    while remaining > 0 or decompressor is not None:
+        if remaining > 0:
+            block = reader.read(min(block_size, remaining))
+            if not block:
+                raise CorruptArchiveError(f'{member["name"]} is truncated')
+            remaining -= len(block)
+            if decompressor is not None:
+                block = decompressor.decompress(block)
+        else:
+            block = decompressor.flush()
+            decompressor = None
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        if write is not None:
+            write(block)
+    if crc != member['crc'] or size != member['file_size']:
+        raise CorruptArchiveError(f'{member["name"]} failed the crc check')
+
+def _extract_member(reader, member, path, block_size=CHUNK_SIZE, commit=True):
+    # inflate one indexed member into path (written to path.part and renamed once checked,
+    # unless commit is False and the caller renames it)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f'{path}.part', 'wb') as f:
+        _inflate_member(reader, member, f.write, block_size)
+    if commit:
+        os.replace(f'{path}.part', path)
+
+def _member_path(output, name):
+    # destination of a member inside output (refusing absolute paths and '..')
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    assert '..' not in parts and not os.path.isabs(name), f"unsafe member name {name}"
+    return os.path.join(output, *parts)
+
+def list_locked_file(data2unzip, key_dir='key.key', multifile=False):
+    """
+    List the members of a locked archive
+
+    Uses the member index of the manifest (nothing is decrypted but the manifest); archives
+    locked without an index are listed from the zip central directory.
+
+    Returns
+    -------
+    members : list
+        One dictionary per member with its name, file_size and compress_size
+    """
+    # check if key exists
+    key = _load_key(key_dir)
+    if key is None:
+        return
+    _check_locked_name(data2unzip, multifile)
+    split_files, sizes, manifest = _locate_splits(data2unzip, key, multifile, verify=False)
+    if manifest is not None and 'members' in manifest:
+        return [{k: member[k] for k in ('name', 'file_size', 'compress_size')} for member in manifest['members']]
+    with _open_locked(split_files, sizes, key) as encrypted_zip, zipfile.ZipFile(encrypted_zip, 'r') as zip_ref:
+        return [{'name': info.filename, 'file_size': info.file_size, 'compress_size': info.compress_size} for info in zip_ref.infolist()]
+
+def extract_from_locked_file(data2unzip, members, key_dir='key.key', multifile=False, output=None, workers=1):
+    """
+    Extract some members of a locked archive, decrypting only the chunks they occupy
+
+    Parameters
+    ----------
+    data2unzip : str
+        Locked archive (data.ezip, or data.ezip.000 if multifile)
+    members : list
+        Member names; a folder name extracts everything below it
+    key_dir : str
+        Path of the key
+    multifile : bool
+        Whether the archive is split
+    output : str, optional
+        Destination folder (default: the folder unlock_and_unzip_file extracts to)
+    workers : int
+        Number of worker processes decrypting chunks
+
+    Returns
+    -------
+    extracted : list
+        Paths of the extracted files
+    """
+    # check if key exists
+    key = _load_key(key_dir)
+    if key is None:
+        return
+    _check_locked_name(data2unzip, multifile)
+    if output is None:
+        output = data2unzip[:-9] if multifile else data2unzip[:-5]
+
+    # splits are not hashed here: that would read the whole archive, and every chunk
+    # read is authenticated anyway
+    split_files, sizes, manifest = _locate_splits(data2unzip, key, multifile, verify=False)
+    extracted = []
+    with _executor(workers) as executor, _open_locked(split_files, sizes, key, executor) as encrypted_zip:
+        if manifest is not None and 'members' in manifest:
+            index = manifest['members']
+            zip_ref = None
+        else:
+            zip_ref = zipfile.ZipFile(encrypted_zip, 'r')
+            index = [{'name': info.filename} for info in zip_ref.infolist()]
+
+        for name in members:
+            folder = name.rstrip('/') + '/'
+            selected = [member for member in index if member['name'] == name or member['name'].startswith(folder)]
+            if not selected:
+                raise KeyError(f'{name} is not in {data2unzip}')
+            for member in selected:
+                if zip_ref is None:
+                    path = _member_path(output, member['name'])
+                    if not member['name'].endswith('/'):
+                        _extract_member(encrypted_zip, member, path)
+                else:
+                    path = zip_ref.extract(member['name'], output)
+                extracted.append(path)
+        if zip_ref is not None:
+            zip_ref.close()
+    return extracted
+
+def _members(reader, manifest):
+    # member index from the manifest, or from the zip central directory for archives without one
+    if manifest is not None and 'members' in manifest:
+        return manifest['members']
+    with zipfile.ZipFile(reader, 'r') as zip_ref:
+        return [{'name': info.filename, 'offset': info.header_offset, 'compress_size': info.compress_size,
+                 'file_size': info.file_size, 'crc': info.CRC, 'compress_type': info.compress_type}
+                for info in zip_ref.infolist()]
+
+def _read_range(reader, start, end, block_size=CHUNK_SIZE):
+    # read (and so authenticate) [start, end) of a stream without keeping it
+    reader.seek(start)
+    while start < end:
+        n = len(reader.read(min(block_size, end - start)))
+        if not n:
+            raise CorruptArchiveError(f'zip stream is truncated at {start}')
+        start += n
+
+def _verify_range(split_files, sizes, key, members, start, end):
+    # authenticate every chunk holding [start, end) of the zip stream and check the crc
+    # of the members starting in it (runs in worker processes); returns the problems found
+    errors = []
+    with _open_locked(split_files, sizes, key) as reader:
+        position = start
+        for member in members:
+            try:
+                if member['offset'] > position:
+                    _read_range(reader, position, member['offset'])
+                _inflate_member(reader, member)
+                position = reader.tell()
+            except (CorruptArchiveError, NotImplementedError, zlib.error) as e:
+                errors.append(str(e) if isinstance(e, CorruptArchiveError) else f'{member["name"]}: {e}')
+                position = max(position, member['offset'])
+        try:
+            _read_range(reader, position, end)
+        except CorruptArchiveError as e:
+            errors.append(str(e))
+    return errors
+
+def verify_locked_file(data2unzip, key_dir='key.key', multifile=None, workers=1):
+    """
+    Check a locked archive without writing any plaintext
+
+    The splits are checked against the manifest (if any), the last chunk of every split is
+    authenticated, and the zip stream is cut at member boundaries into ranges that are read
+    in parallel: every chunk of every split is authenticated and every member is inflated
+    and its size and crc checked. Memory use is constant (one chunk per worker) except for
+    legacy splits, which are decrypted whole.
+
+    Parameters
+    ----------
+    data2unzip : str
+        Locked archive (data.ezip, or data.ezip.000 if multifile)
+    key_dir : str
+        Path of the key
+    multifile : bool, optional
+        Whether the archive is split (default: guessed from the name)
+    workers : int
+        Number of worker processes (and of threads hashing splits)
+
+    Returns
+    -------
+    result : dict
+        Archive, ok, list of errors, size of the zip stream and elapsed time
+    """
+    # check if key exists
+    key = _load_key(key_dir)
+    if key is None:
+        return
+    if multifile is None:
+        multifile = not data2unzip.endswith('.ezip')
+    _check_locked_name(data2unzip, multifile)
+
+    start = time.perf_counter()
+    result = {'archive': data2unzip, 'ok': False, 'errors': [], 'bytes': 0, 'seconds': 0.0}
+    try:
+        split_files, sizes, manifest = _locate_splits(data2unzip, key, multifile, True, workers)
+        if not split_files:
+            raise CorruptArchiveError('no splits found')
+        # the final chunk of a split may hold no data, so it is not read with the stream
         for split_file in split_files:
-            os.remove(split_file.replace('ezip','zip'))
+            with open_encrypted(split_file, key) as part:
+                if isinstance(part, EncryptedReader):
+                    part.read_chunk(part.n_chunks - 1)
+        with _open_locked(split_files, sizes, key) as reader:
+            total = reader.seek(0, io.SEEK_END)
+            members = _members(reader, manifest)
+    except (CorruptArchiveError, zipfile.BadZipFile, OSError) as e:
+        result['errors'].append(str(e))
+        result['seconds'] = time.perf_counter() - start
+        return result
+    result['bytes'] = total
 
+    # cut the stream into contiguous ranges starting at member boundaries (a few per worker)
+    members = sorted(members, key=lambda member: member['offset'])
+    n_ranges = max(min(len(members), 4*workers), 1)
+    groups = {}
+    for member in members:
+        groups.setdefault(min(member['offset'] * n_ranges // max(total, 1), n_ranges - 1), []).append(member)
+    groups = [groups[g] for g in sorted(groups)] or [[]]
+    bounds = [0] + [group[0]['offset'] for group in groups[1:]] + [total]
+    tasks = [(split_files, sizes, key, group, bounds[i], bounds[i+1]) for i, group in enumerate(groups)]
 
-def zip_and_lock_folder(data2zip,key_dir='key.key',multifile=False,split_size_bytes=50_000_000):
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            errors = list(executor.map(_verify_range, *zip(*tasks)))
+    else:
+        errors = [_verify_range(*task) for task in tasks]
+    # ranges sharing a corrupt chunk report it once
+    result['errors'] = list(dict.fromkeys(error for task_errors in errors for error in task_errors))
+    result['ok'] = not result['errors']
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def verify_locked_folder(folder, key_dir='key.key', workers=1, verbose=True):
+    """
+    Check every locked archive (*.ezip and *.ezip.000) below a folder with verify_locked_file
+
+    Returns the list of results.
+    """
+    results = []
+    for root, subfolders, files in os.walk(folder):
+        for file in sorted(files):
+            if file.endswith('.ezip') or file.endswith('.ezip.000'):
+                result = verify_locked_file(os.path.join(root, file), key_dir, workers=workers)
+                if result is None:
+                    return results
+                results.append(result)
+                if verbose:
+                    status = 'ok' if result['ok'] else 'CORRUPT'
+                    print(f"{result['archive']}: {status} ({result['bytes']/1e6:.1f} MB in {result['seconds']:.2f}s)")
+                    for error in result['errors']:
+                        print(f'    {error}')
+    return results
+
+def unlock_and_unzip_file(data2unzip, key_dir='key.key',multifile=False,workers=1,verify=True,resume=True):
     # check if key exists
+    key = _load_key(key_dir)
+    if key is None:
+        return
+
+    _check_locked_name(data2unzip, multifile)
+    output = data2unzip[:-9] if multifile else data2unzip[:-5]
+
+    # get each split file from the manifest (or the numbered files next to the first split),
+    # checking their sizes against the manifest first (archives locked before manifests have
+    # none); with verify, splits are hashed while they are decrypted (each is read once)
+    split_files, sizes, manifest = _locate_splits(data2unzip, key, multifile, verify=False)
+    hashes = None
+    if manifest is not None:
+        _check_splits(manifest, split_files)
+        if verify:
+            hashes = [_SplitHash(split_file) for split_file in split_files]
+
+    # members extracted by an interrupted run of the same archive into the same folder
+    journal_path = f'{data2unzip}.extract.journal'
+    archive = {'splits': [[os.path.basename(f), os.path.getsize(f)] for f in split_files], 'output': os.path.abspath(output)}
+    done = set()
+    if resume and os.path.isfile(journal_path):
+        try:
+            journal = _read_json(journal_path, key, JOURNAL_VERSION)
+            if journal['archive'] == archive:
+                done = set(journal['done'])
+                print(f'Resuming after {len(done)} files.')
+        except (CorruptArchiveError, KeyError) as e:
+            print(f'Not resuming from {journal_path} ({e}), starting over.')
+
+    # decrypt and unzip all files and folders in one pass over the splits (no plaintext zip on disk)
+    with _executor(workers) as executor, _open_locked(split_files, sizes, key, executor, hashes) as encrypted_zip:
+        # with verify, extracted members stay in {path}.part until all the splits holding
+        # them matched the manifest, so a corrupt split fails before they are committed
+        pending = deque() # (end in the zip stream, name, path)
+        verified = 0 # number of leading splits checked against the manifest
+
+        def commit(position):
+            # check the splits ending before position and rename the members they hold
+            nonlocal verified
+            while verified < len(split_files) and encrypted_zip.offsets[verified+1] <= position:
+                if hashes[verified].hexdigest() != manifest['splits'][verified]['sha256']:
+                    raise CorruptArchiveError(f'{split_files[verified]} is corrupt (checksum mismatch)')
+                verified += 1
+            while pending and pending[0][0] <= encrypted_zip.offsets[verified]:
+                _, name, path = pending.popleft()
+                os.replace(f'{path}.part', path)
+                done.add(name)
+
+        last_checkpoint = time.monotonic()
+        try:
+            for member in sorted(_members(encrypted_zip, manifest), key=lambda member: member['offset']):
+                path = _member_path(output, member['name'])
+                if member['name'].endswith('/'):
+                    os.makedirs(path, exist_ok=True)
+                    done.add(member['name'])
+                elif member['name'] in done and os.path.isfile(path) and os.path.getsize(path) == member['file_size']:
+                    pass # extracted by the interrupted run
+                elif hashes is None:
+                    _extract_member(encrypted_zip, member, path)
+                    done.add(member['name'])
+                else:
+                    _extract_member(encrypted_zip, member, path, commit=False)
+                    pending.append((encrypted_zip.tell(), member['name'], path))
+                    commit(encrypted_zip.tell())
+                if time.monotonic() - last_checkpoint > JOURNAL_INTERVAL:
+                    _write_json(journal_path, key, {'version': JOURNAL_VERSION, 'archive': archive, 'done': sorted(done)})
+                    last_checkpoint = time.monotonic()
+            if hashes is not None:
+                commit(encrypted_zip.offsets[-1])
+        except CorruptArchiveError:
+            for _, _, path in pending:
+                _remove(f'{path}.part')
+            raise
+    _remove(journal_path)
+
+
+def _load_lock_journal(journal_path, key, params, data2zip, workers=1):
+    # completed splits and members of an interrupted run (None if it cannot be resumed)
+    if not os.path.isfile(journal_path):
+        return None
     try:
-        with open(key_dir, "rb") as key_file:
-            key = key_file.read()
-            fernet = Fernet(key)
-    except:
-        print("Key not found, please generate a key using generate_key(), provide an existing key_dir, or locate the key.")
-        return 
+        journal = _read_json(journal_path, key, JOURNAL_VERSION)
+        if journal['params'] != params:
+            raise CorruptArchiveError('the parameters changed')
+        for name, (size, mtime_ns) in journal['sources'].items():
+            stat = os.stat(os.path.join(data2zip, name))
+            if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                raise CorruptArchiveError(f'{name} changed')
+        verify_manifest({'splits': journal['splits']}, os.path.dirname(journal_path), workers)
+    except (CorruptArchiveError, OSError, KeyError, ValueError) as e:
+        print(f'Not resuming from {journal_path} ({e}), starting over.')
+        return None
+    print(f"Resuming after {len(journal['splits'])} splits and {len(journal['members'])} files.")
+    return journal
+
+def _lock_checkpoint(journal_path, key, params, fullzip, splits, sources):
+    # record the completed splits and the members they hold entirely (a member ends
+    # where the next one starts); a rerun zips again from the first other member, so
+    # the stats of every file read so far (sources) are recorded: the member straddling
+    # the last split, the one being written and those queued must not change either
+    end = sum(split['plaintext_size'] for split in splits)
+    filelist = fullzip.members if fullzip is not None else []
+    n = sum(filelist[j+1].header_offset <= end for j in range(len(filelist) - 1))
+    _write_json(journal_path, key, {
+        'version': JOURNAL_VERSION,
+        'params': params,
+        'splits': splits,
+        'offset': filelist[n].header_offset if filelist else 0,
+        'members': [_zinfo_to_dict(zinfo) for zinfo in filelist[:n]],
+        'sources': sources,
+    })
+
+def _lock_archive(data2zip, archive, key, multifile=False, split_size_bytes=50_000_000, workers=1, files=None, compression='adaptive', resume=True):
+    # zip a folder (or some of its files) into a locked archive and write its manifest;
+    # returns the path of the archive (its first split if multifile)
+    if not multifile:
+        # zip folder straight into the encrypted archive (no plaintext zip on disk)
+        with _executor(workers) as executor, _HashingFile(open(f'{archive}.part', 'wb')) as encrypted_file:
+            with EncryptedWriter(encrypted_file, key, executor=executor) as encrypted_zip:
+                infolist = _zip_folder(data2zip, encrypted_zip, files, compression, executor)
+                plaintext_size = encrypted_zip.tell()
+        os.replace(f'{archive}.part', archive)
+        splits = [{
+            'name': os.path.basename(archive),
+            'size': encrypted_file.size,
+            'sha256': encrypted_file.hasher.hexdigest(),
+            'plaintext_size': plaintext_size,
+        }]
+    else:
+        # zip folder straight into encrypted splits with at most split_size_bytes of zip data each,
+        # journaling completed splits (the zip stream only matches a previous run with the same parameters)
+        journal_path = f'{archive}.journal'
+        params = {'split_size_bytes': split_size_bytes, 'chunk_size': CHUNK_SIZE, 'compression': compression,
+                  'precompress': workers is None or workers > 1, 'files': files}
+        journal = _load_lock_journal(journal_path, key, params, data2zip, workers) if resume else None
+        opened = {}
+        sources = dict(journal['sources']) if journal is not None else {}
+        def on_file(fullzip, file):
+            opened['zip'] = fullzip
+            if file not in sources:
+                stat = os.stat(os.path.join(data2zip, file))
+                sources[file] = [stat.st_size, stat.st_mtime_ns]
+        def checkpoint(splits):
+            _lock_checkpoint(journal_path, key, params, opened.get('zip'), splits, sources)
+
+        with _executor(workers) as executor:
+            completed = journal['splits'] if journal is not None else None
+            with SplitEncryptedWriter(f'{archive}.', key, split_size_bytes, executor=executor, completed=completed, on_split=checkpoint) as encrypted_zip:
+                infolist = _zip_folder(data2zip, encrypted_zip, files, compression, executor, journal, on_file)
+        splits = encrypted_zip.splits
+
+    # list the splits in order with their sizes and hashes, and index the members
+    first_split = os.path.join(os.path.dirname(archive), splits[0]['name'])
+    _write_manifest(f'{first_split}.manifest', key, splits, _member_index(infolist, splits))
+    if multifile:
+        _remove(journal_path)
+    return first_split
+
+def zip_and_lock_folder(data2zip,key_dir='key.key',multifile=False,split_size_bytes=50_000_000,workers=1,compression='adaptive',resume=True):
+    # check if key exists
+    key = _load_key(key_dir)
+    if key is None:
+        return
     
     # make sure data2zip is a folder
     assert os.path.isdir(data2zip), "data2zip is not a folder"
 
-    if not multifile:
-        # zip folder while preserving directory structure
-        with zipfile.ZipFile(f'{data2zip}.zip', 'w') as fullzip: # create zipfile object
-            rootlen = len(data2zip) + 1 # get number of characters to remove from each file path
-            for folder, subfolders, files in os.walk(f'{data2zip}'): # walk through folders
-                for file in files:
-                    fn = os.path.join(folder, file)
-                    fullzip.write(fn, fn[rootlen:], compress_type = zipfile.ZIP_DEFLATED)
-                for subfolder in subfolders:
-                    fn = os.path.join(folder, subfolder)
-        # encrypt zip file
-        with open(f'{data2zip}.zip', 'rb') as file:
-            original = file.read()
-        encrypted = fernet.encrypt(original)
-        with open(f'{data2zip}.ezip', 'wb') as encrypted_file:
-            encrypted_file.write(encrypted)
-        # delete zip file
-        os.remove(f'{data2zip}.zip')
+    assert compression in ['adaptive', 'deflate'], "compression must be 'adaptive' or 'deflate'."
+
+    _lock_archive(data2zip, f'{data2zip}.ezip', key, multifile, split_size_bytes, workers, compression=compression, resume=resume)
+
+
+def lock_folder_incremental(data2zip, key_dir='key.key', multifile=False, split_size_bytes=50_000_000, workers=1, compression='adaptive'):
+    """
+    Lock only the files of a folder whose content is not archived yet
+
+    The first call writes the base archive {data2zip}-0000.ezip, later calls write a delta
+    archive {data2zip}-NNNN.ezip with the new and modified files (none if nothing changed).
+    Files with unchanged size and mtime are not hashed again, and content already archived
+    under any path (copies, renames) is not packed again. The state {data2zip}.ezstate is
+    only replaced once the delta archive is complete.
+
+    Parameters
+    ----------
+    data2zip : str
+        Folder to lock
+    key_dir : str
+        Path of the key
+    multifile : bool
+        Whether to split the archives
+    split_size_bytes : int
+        Size of each split
+    workers : int
+        Number of threads hashing files and of processes compressing files and encrypting chunks
+    compression : str
+        'adaptive' or 'deflate' (see zip_and_lock_folder)
+
+    Returns
+    -------
+    summary : dict
+        Archive written (None if nothing changed) and number of new, changed, unchanged,
+        deleted and packed files
+    """
+    # check if key exists
+    key = _load_key(key_dir)
+    if key is None:
+        return
+
+    # make sure data2zip is a folder
+    assert os.path.isdir(data2zip), "data2zip is not a folder"
+
+    state_path = f'{data2zip}.ezstate'
+    if os.path.isfile(state_path):
+        state = read_state(state_path, key)
     else:
-        # zip folder while preserving directory structure but split into multiple files of max size split_size_bytes
-        with SplitFileWriter(f'{data2zip}.zip.',split_size_bytes) as sub_zip:
-            with zipfile.ZipFile(sub_zip, 'w') as fullzip:
-                rootlen = len(data2zip) + 1 # get number of characters to remove from each file path
-                for folder, subfolders, files in os.walk(f'{data2zip}'): # walk through folders
-                    for file in files:
-                        fn = os.path.join(folder, file)
-                        fullzip.write(fn, fn[rootlen:], compress_type = zipfile.ZIP_DEFLATED)
-                    for subfolder in subfolders:
-                        fn = os.path.join(folder, subfolder)
-        # encrypt zip file
-        # find all split files
-        split_files = list(filter(lambda x: x.startswith(f'{data2zip}.zip.'), os.listdir()))
-        # encrypt each split file
-        for split_file in split_files:
-            with open(split_file, 'rb') as file:
-                original = file.read()
-            encrypted = fernet.encrypt(original)
-            with open(split_file.replace('zip','ezip'), 'wb') as encrypted_file:
-                encrypted_file.write(encrypted)
-            # delete zip file
-            os.remove(split_file)
+        state = {'version': STATE_VERSION, 'archives': [], 'files': {}, 'contents': {}}
+    previous = state['files']
+
+    # hash new and modified files only (same size and mtime means same content)
+    files = sorted(_walk_files(data2zip))
+    stats = {file: os.stat(os.path.join(data2zip, file)) for file in files}
+    to_hash = [file for file in files if file not in previous
+               or previous[file]['size'] != stats[file].st_size
+               or previous[file]['mtime_ns'] != stats[file].st_mtime_ns]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = dict(zip(to_hash, executor.map(lambda file: _hash_split(os.path.join(data2zip, file)), to_hash)))
+
+    # pack every content not archived yet (once, even if several files share it)
+    current = {}
+    pack = {}
+    for file in files:
+        digest = hashes[file] if file in hashes else previous[file]['sha256']
+        current[file] = {'sha256': digest, 'size': stats[file].st_size, 'mtime_ns': stats[file].st_mtime_ns}
+        if digest not in state['contents'] and digest not in pack:
+            pack[digest] = file
+
+    summary = {
+        'archive': None,
+        'new': sum(file not in previous for file in files),
+        'changed': sum(file in previous and previous[file]['sha256'] != current[file]['sha256'] for file in files),
+        'unchanged': sum(file in previous and previous[file]['sha256'] == current[file]['sha256'] for file in files),
+        'deleted': len(set(previous) - set(current)),
+        'packed': len(pack),
+    }
+    if pack:
+        archive = f'{data2zip}-{len(state["archives"]):04d}.ezip'
+        first_split = _lock_archive(data2zip, archive, key, multifile, split_size_bytes, workers, sorted(pack.values()), compression)
+        name = os.path.basename(first_split)
+        state['archives'].append(name)
+        for digest, file in pack.items():
+            state['contents'][digest] = {'archive': name, 'member': file}
+        summary['archive'] = first_split
+
+    state['files'] = current
+    _write_json(state_path, key, state)
+    return summary
+
+def restore_incremental(state_path, key_dir='key.key', output=None, workers=1, verify=True):
+    """
+    Rebuild a folder locked with lock_folder_incremental from its base and delta archives
+
+    Only the members referenced by the state are decrypted, in archive order.
+
+    Parameters
+    ----------
+    state_path : str
+        State of the incremental archive ({folder}.ezstate)
+    key_dir : str
+        Path of the key
+    output : str, optional
+        Destination folder (default: the locked folder)
+    workers : int
+        Number of worker processes decrypting chunks (and threads verifying splits)
+    verify : bool
+        Check the archives against their manifests first
+
+    Returns
+    -------
+    restored : list
+        Paths of the restored files
+    """
+    # check if key exists
+    key = _load_key(key_dir)
+    if key is None:
+        return
+    assert state_path.endswith('.ezstate'), "state_path is not an incremental archive state"
+
+    state = read_state(state_path, key)
+    if output is None:
+        output = state_path[:-len('.ezstate')]
+
+    # files to restore from each archive
+    targets = {name: [] for name in state['archives']}
+    for file, entry in state['files'].items():
+        content = state['contents'][entry['sha256']]
+        targets[content['archive']].append((file, content['member']))
+
+    restored = []
+    with _executor(workers) as executor:
+        for name in state['archives']:
+            if not targets[name]:
+                continue
+            first_split = os.path.join(os.path.dirname(state_path), name)
+            split_files, sizes, manifest = _locate_splits(first_split, key, not name.endswith('.ezip'), verify, workers)
+            if manifest is None:
+                raise CorruptArchiveError(f'manifest of {first_split} is missing')
+            index = {member['name']: member for member in manifest['members']}
+
+            # read members in stream order so chunks are decrypted sequentially
+            with _open_locked(split_files, sizes, key, executor) as encrypted_zip:
+                for file, member in sorted(targets[name], key=lambda target: index[target[1]]['offset']):
+                    path = _member_path(output, file)
+                    _extract_member(encrypted_zip, index[member], path)
+                    restored.append(path)
+    return restored
 
-    
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Lock and unlock files.')
     parser.add_argument('--encrypt', default='', type=str, help='Folder to encrypt.')
@@ -124,17 +1551,48 @@ if __name__ == "__main__":
     parser.add_argument('--key_dir', default='key.key', type=str, help='Directory of key.')
     parser.add_argument('--multifile', default=False, type=bool, help='Whether to split zip files into multiple files.')
     parser.add_argument('--split_size_bytes', default=50_000_000, type=int, help='Size of each split file in bytes. Default is 50MB.')
+    parser.add_argument('--compression', default='adaptive', type=str, help="'adaptive' (store incompressible files, deflate level by size) or 'deflate' (every file at the default level).")
+    parser.add_argument('--incremental', action='store_true', help='Lock only new and changed files into a delta archive, or restore (from the .ezstate file to decrypt) base and deltas.')
+    parser.add_argument('--list', action='store_true', help='List the members of the file to decrypt.')
+    parser.add_argument('--extract', default=[], type=str, action='append', help='Member (or folder) of the file to decrypt to extract. Can be repeated.')
+    parser.add_argument('--output', default=None, type=str, help='Folder to extract members to.')
+    parser.add_argument('--verify', action='store_true', help='Only check the file to decrypt (or all locked files in a folder), writing nothing.')
+    parser.add_argument('--restart', action='store_true', help='Ignore the journal of an interrupted run and start over.')
+    parser.add_argument('--no_verify', action='store_true', help='Do not check the splits against the manifest before decrypting.')
+    parser.add_argument('--workers', default=1, type=int, help='Number of worker processes encrypting/decrypting chunks. Default is 1 (no pool).')
     args = parser.parse_args()
 
     assert args.encrypt != '' or args.decrypt != '', "Insufficient arguments provided. Please provide a file or folder to encrypt or decrypt."
     assert os.path.isfile(args.key_dir), "Key not found, please generate a key using generate_key(), provide an existing key_dir, or locate the key."
     assert args.split_size_bytes > 0, "split_size_bytes must be greater than 0."
     assert args.split_size_bytes < 100_000_000, "split_size_bytes must be less than 100MB."
-    assert os.path.isdir(args.encrypt) or os.path.isfile(args.decrypt), "Please provide an existing file to decrypt or an existing folder to encrypt."
+    assert os.path.isdir(args.encrypt) or os.path.isfile(args.decrypt) or (args.verify and os.path.isdir(args.decrypt)), "Please provide an existing file to decrypt or an existing folder to encrypt."
     assert type(args.multifile) == bool, "multifile must be a boolean."
+    assert args.workers > 0, "workers must be greater than 0."
+    assert args.compression in ['adaptive', 'deflate'], "compression must be 'adaptive' or 'deflate'."
     assert not (args.encrypt != '' and args.decrypt != ''), "Please either encrypt or decrypt, not both."
     
-    if args.encrypt != '':
-        zip_and_lock_folder(args.encrypt, args.key_dir, args.multifile, args.split_size_bytes)
+    assert not ((args.list or args.extract) and args.decrypt == ''), "--list and --extract need a file to decrypt."
+
+    if args.encrypt != '' and args.incremental:
+        print(lock_folder_incremental(args.encrypt, args.key_dir, args.multifile, args.split_size_bytes, args.workers, args.compression))
+    elif args.encrypt != '':
+        zip_and_lock_folder(args.encrypt, args.key_dir, args.multifile, args.split_size_bytes, args.workers, args.compression, not args.restart)
+    elif args.verify:
+        if os.path.isdir(args.decrypt):
+            results = verify_locked_folder(args.decrypt, args.key_dir, args.workers)
+        else:
+            results = [verify_locked_file(args.decrypt, args.key_dir, args.multifile or None, args.workers)]
+            print(results[0])
+        if not all(result is not None and result['ok'] for result in results):
+            exit(1)
+    elif args.incremental:
+        print(f"Restored {len(restore_incremental(args.decrypt, args.key_dir, args.output, args.workers, not args.no_verify))} files")
+    elif args.list:
+        for member in list_locked_file(args.decrypt, args.key_dir, args.multifile):
+            print(f"{member['file_size']:>14,d}  {member['name']}")
+    elif args.extract:
+        for path in extract_from_locked_file(args.decrypt, args.extract, args.key_dir, args.multifile, args.output, args.workers):
+            print(path)
     else:
-        unlock_and_unzip_file(args.decrypt, args.key_dir, args.multifile)
+        unlock_and_unzip_file(args.decrypt, args.key_dir, args.multifile, args.workers, not args.no_verify, not args.restart)
@@ -0,0 +1,242 @@
+# Description: Batch rendering of trajectory figures for all sessions
+
+import os
+import time
+import json
+import shutil
+import struct
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import matplotlib
+from matplotlib.colors import LinearSegmentedColormap
+
+# default colormaps (same as the analysis notebook)
+blnv = LinearSegmentedColormap.from_list('blnv', ['lightskyblue', 'royalblue'], N=256)
+pkor = LinearSegmentedColormap.from_list('pkor', ['pink', 'crimson'], N=256)
+
+# key of the PNG text chunk holding the hash of the inputs of a figure
+HASH_KEY = 'flytrailvr-hash'
+
+def _use_agg():
+    # render without a display (also used as the process pool initializer)
+    matplotlib.use('Agg')
+
+def _hash_file(path, hasher, block_size=1 << 20):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+
+def figure_hash(folder, params):
+    """
+    Hash the inputs of a trajectory figure
+
+    Parameters
+    ----------
+    folder : str
+        Session folder (log file and config.py are hashed)
+    params : dict
+        Keyword arguments passed to plot_trajectory (colormaps are hashed by their colours)
+
+    Returns
+    -------
+    digest : str
+        Hex digest changing whenever the data, the config, the plotting parameters or
+        the plotting code change
+    """
+    hasher = hashlib.sha256()
+    for file in sorted(os.listdir(folder)):
+        if file.endswith('.log') or file == 'config.py':
+            hasher.update(file.encode())
+            _hash_file(os.path.join(folder, file), hasher)
+
+    # colormaps are not serializable, hash their lookup tables instead
+    params = dict(params)
+    colormaps = params.pop('colormaps', [])
+    for cmap in colormaps:
+        hasher.update(np.ascontiguousarray(matplotlib.colormaps.get_cmap(cmap)(np.linspace(0, 1, 256))).tobytes())
+    hasher.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+    # changes to the plotting code invalidate all figures
+    _hash_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'utils.py'), hasher)
+    return hasher.hexdigest()
+
+def read_png_text(path):
+    """
+    Read the text chunks of a PNG file without decoding the image
+
+    Returns an empty dictionary if the file does not exist or is not a PNG.
+    """
+    text = {}
+    try:
+        with open(path, 'rb') as f:
+            if f.read(8) != b'\x89PNG\r\n\x1a\n':
+                return text
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                length, chunk_type = struct.unpack('>I4s', header)
+                if chunk_type == b'IDAT' or chunk_type == b'IEND':
+                    # matplotlib writes text chunks before the image data
+                    break
+                data = f.read(length)
+                f.seek(4, os.SEEK_CUR) # skip crc
+                if chunk_type == b'tEXt':
+                    key, value = data.split(b'\x00', 1)
+                    text[key.decode('latin-1')] = value.decode('latin-1')
+    except OSError:
+        pass
+    return text
+
+def render_session(folder, save, params, digest=None, force=False):
+    """
+    Render the trajectory figure of one session
+
+    The figure is rendered once (to the first path in save) and copied to the other paths.
+    Rendering is skipped if all outputs exist and were rendered from inputs with the same hash.
+
+    Parameters
+    ----------
+    folder : str
+        Session folder
+    save : list
+        Output paths
+    params : dict
+        Keyword arguments passed to plot_trajectory
+    digest : str, optional
+        Precomputed figure_hash of the session
+    force : bool
+        Render even if the outputs are up to date
+
+    Returns
+    -------
+    result : dict
+        Session name, status ('rendered', 'up-to-date' or 'error'), elapsed time and error message
+    """
+    start = time.perf_counter()
+    result = {'session': os.path.basename(os.path.normpath(folder)), 'status': 'rendered', 'seconds': 0.0, 'error': None}
+    try:
+        if digest is None:
+            digest = figure_hash(folder, params)
+
+        # check if the figures are up to date
+        if not force and all(read_png_text(s).get(HASH_KEY) == digest for s in save):
+            result['status'] = 'up-to-date'
+        else:
+            import matplotlib.pyplot as plt
+            from .utils import extract_data, plot_trajectory
+
+            df, config, logic, comments = extract_data(folder)
+            plt.rcParams.update({'font.size': params.get('font_size', 15)})
+            plot_params = {k: v for k, v in params.items() if k != 'font_size'}
+
+            # render once and tag the figure with the input hash
+            os.makedirs(os.path.dirname(os.path.abspath(save[0])), exist_ok=True)
+            plot_trajectory(df, config, show=False, save=save[0], metadata={HASH_KEY: digest}, **plot_params)
+            for s in save[1:]:
+                os.makedirs(os.path.dirname(os.path.abspath(s)), exist_ok=True)
+                shutil.copyfile(save[0], s)
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter()-start
+    return result
+
+def render_figures(
+        data_folder,
+        figures_folder=None,
+        workers=None,
+        force=False,
+        scale_factor=7,
+        colormaps=[blnv, pkor],
+        black_background=True,
+        backend='scatter',
+        font_size=15,
+        verbose=True
+):
+    """
+    Render the trajectory figures of all sessions in parallel
+
+    Every session folder gets a trajectory.png (and a copy named after the session in
+    figures_folder). Sessions with 'orco' in their name are coloured by LED, others by odor.
+
+    Parameters
+    ----------
+    data_folder : str
+        Folder containing the session folders
+    figures_folder : str, optional
+        Additional folder to copy the figures to
+    workers : int, optional
+        Number of worker processes (default: number of CPUs)
+    force : bool
+        Re-render figures even if they are up to date
+    scale_factor, colormaps, black_background, backend
+        Passed to plot_trajectory
+    font_size : int
+        Matplotlib font size
+    verbose : bool
+        Print per-session timings
+
+    Returns
+    -------
+    results : list
+        One result dictionary per session (see render_session)
+    """
+    sessions = sorted(filter(lambda x: os.path.isdir(os.path.join(data_folder, x)), os.listdir(data_folder)))
+    jobs = []
+    for session in sessions:
+        folder = os.path.join(data_folder, session)
+        if not any(file.endswith('.log') for file in os.listdir(folder)):
+            continue
+        save = [os.path.join(folder, 'trajectory.png')]
+        if figures_folder is not None:
+            save.append(os.path.join(figures_folder, session+'.png'))
+        params = {
+            'scale_factor': scale_factor,
+            'colormaps': colormaps,
+            'odor_or_led': 'led' if 'orco' in session else 'odor',
+            'black_background': black_background,
+            'backend': backend,
+            'font_size': font_size,
+        }
+        jobs.append((folder, save, params))
+
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_use_agg) as executor:
+        futures = [executor.submit(render_session, folder, save, params, None, force) for folder, save, params in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if verbose:
+                message = f'{result["session"]}: {result["status"]} in {result["seconds"]:.2f}s'
+                if result['error'] is not None:
+                    message += f' ({result["error"]})'
+                print(message)
+    if verbose:
+        rendered = sum(r['status'] == 'rendered' for r in results)
+        print(f'Rendered {rendered}/{len(results)} sessions in {time.perf_counter()-start:.2f}s')
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Render trajectory figures for all sessions.')
+    parser.add_argument('data_folder', type=str, help='Folder containing the session folders.')
+    parser.add_argument('--figures_folder', default=None, type=str, help='Additional folder to copy the figures to.')
+    parser.add_argument('--workers', default=None, type=int, help='Number of worker processes. Default is the number of CPUs.')
+    parser.add_argument('--force', action='store_true', help='Re-render figures even if they are up to date.')
+    parser.add_argument('--scale_factor', default=7, type=float, help='Figure scale factor.')
+    parser.add_argument('--backend', default='scatter', type=str, help="Trajectory backend, 'scatter' or 'raster'.")
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.data_folder), "data_folder is not a folder"
+    assert args.backend in ['scatter', 'raster'], "backend must be 'scatter' or 'raster'."
+
+    _use_agg()
+    results = render_figures(args.data_folder, args.figures_folder, args.workers, args.force, args.scale_factor, backend=args.backend)
+    if any(r['status'] == 'error' for r in results):
+        exit(1)
+
+if __name__ == "__main__":
+    main()
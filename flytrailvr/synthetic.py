@@ -0,0 +1,273 @@
+# Description: Synthetic rig logs (FicTrac trajectories and setpoints) for scale testing
+
+import os
+import math
+import argparse
+import datetime
+import numpy as np
+from .closed_loop import config_value
+from .harness import FTData
+from .logic import StripLogic
+
+# header of the rig logs (see extract_data)
+LOG_COLUMNS = ['motor_step_command', 'mfc1_stpt', 'mfc2_stpt', 'mfc3_stpt', 'led1_stpt', 'led2_stpt', 'sig_status',
+               'ft_posx', 'ft_posy', 'ft_frame', 'ft_error', 'ft_roll', 'ft_pitch', 'ft_yaw', 'ft_heading',
+               'adapted_center', 'instrip', 'mode', 'strip_thresh']
+LOG_HEADER = 'timestamp -- ' + ','.join(LOG_COLUMNS) + '\n'
+
+# one log line (the date is formatted once per day)
+LINE_FORMAT = '%s-%02d:%02d:%02d.%06d -- %d,%r,%r,%r,%r,%r,%d,%r,%r,%d,%r,%r,%r,%r,%r,%r,%s,live,%r\n'
+
+AGENTS = ['random_walk', 'edge_tracking']
+
+# default config of a synthetic session (same keys as the rig config.py)
+DEFAULT_CONFIG = {
+    'strip_angle': 0,
+    'strip_direction': 'right',
+    'strip_width': 10,
+    'periodic_boundary': True,
+    'period_width': 100,
+    'flowrate': 300,
+    'flowrate_high': 300,
+    'flowrate_low': 20,
+    'alternation_time': 120,
+    'percent_odor': 20,
+    'pre_onset_time': 60,
+    'led_intensity': 100,
+    'pulse_period': 10.0,
+}
+
+class Agent:
+    """
+    Simulated fly walking on the ball
+
+    The heading relaxes towards a target heading with time constant tau (plus angular
+    diffusion) and the speed follows an Ornstein-Uhlenbeck process. The random walk agent
+    has a fixed random target; the edge tracking agent heads upwind (+y) in the strip and
+    turns back towards the strip when it leaves it.
+
+    Parameters
+    ----------
+    kind : str
+        'random_walk' or 'edge_tracking'
+    rng : numpy.random.Generator
+        Random number generator
+    speed : float
+        Mean walking speed (mm/s)
+    turn_noise : float
+        Angular diffusion (rad/sqrt(s))
+    tau : float
+        Heading time constant (s)
+    """
+    def __init__(self, kind, rng, speed=8.0, turn_noise=1.0, tau=0.5):
+        assert kind in AGENTS, f"kind must be in {AGENTS}."
+        self.kind = kind
+        self.rng = rng
+        self.mean_speed = speed
+        self.turn_noise = turn_noise
+        self.tau = tau
+        self.x, self.y = 0.0, 0.0
+        self.heading = rng.uniform(0, 2*math.pi)
+        self.speed = speed
+        self.target = self.heading
+
+    def target_heading(self, instrip, side):
+        if self.kind == 'edge_tracking' and side is not None:
+            # upwind in the strip, cast back towards the strip outside of it
+            if instrip:
+                return math.pi/2
+            return math.pi/2 + (math.pi/4 if side > 0 else -math.pi/4)
+        return self.target
+
+    def step(self, dt, noise, instrip=False, side=None):
+        """
+        Advance by dt with standard normal noise (3 values), side is the sign of the offset to the strip center
+        """
+        target = self.target_heading(instrip, side)
+        error = math.atan2(math.sin(target - self.heading), math.cos(target - self.heading))
+        self.heading += error*dt/self.tau + self.turn_noise*math.sqrt(dt)*noise[0]
+        self.speed += (self.mean_speed - self.speed)*dt + 2.0*math.sqrt(dt)*noise[1]
+        self.speed = max(self.speed, 0.0)
+        if self.kind == 'random_walk' and noise[2] > 2.5:
+            self.target = self.rng.uniform(0, 2*math.pi)
+        self.x += self.speed*math.cos(self.heading)*dt
+        self.y += self.speed*math.sin(self.heading)*dt
+
+def generate_log(
+        path,
+        duration,
+        fps=30.0,
+        agent='edge_tracking',
+        config=None,
+        stimulus='led',
+        seed=0,
+        start=None,
+        chunk_frames=100_000,
+        verbose=False
+):
+    """
+    Write a synthetic rig log in the exact format of the rig (streamed in chunks)
+
+    The setpoints of every frame are decided by StripLogic (the experiment_logic of the
+    strip sessions): a pre-onset period, then the strip geometry and the (optionally
+    alternated) flowrate of the config.
+
+    Parameters
+    ----------
+    path : str
+        Log file to write
+    duration : float
+        Duration of the session (seconds, 48 h is 172800)
+    fps : float
+        Frame rate of the logged frames
+    agent : str
+        'random_walk' or 'edge_tracking'
+    config : dict, optional
+        Session config (default: DEFAULT_CONFIG, keys missing in config are taken from it)
+    stimulus : str
+        'led' or 'odor' in the strip
+    seed : int
+        Seed of the random number generator
+    start : datetime.datetime, optional
+        Timestamp of the first frame (default: now)
+    chunk_frames : int
+        Number of frames formatted and written at a time
+    verbose : bool
+        Print the progress
+
+    Returns
+    -------
+    frames : int
+        Number of frames written
+    """
+    assert stimulus in ['led', 'odor'], "stimulus must be 'led' or 'odor'."
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    # without alternation in the config the schedule keeps flowrate
+    logic = StripLogic(config, stimulus, alternated=True)
+    ft = FTData()
+    rng = np.random.default_rng(seed)
+    fly = Agent(agent, rng)
+    start = start or datetime.datetime.now().replace(microsecond=0)
+    start_us = (start - start.replace(hour=0, minute=0, second=0, microsecond=0))//datetime.timedelta(microseconds=1)
+
+    n_frames = int(duration*fps)
+    dt = 1.0/fps
+    pulse_period = config_value(config, 'pulse_period') or 0
+    instrip, side = False, None
+    motor = 800000
+    dates = {}
+
+    with open(path, 'w', buffering=1 << 20) as f:
+        f.write(LOG_HEADER)
+        for first in range(0, n_frames, chunk_frames):
+            count = min(chunk_frames, n_frames - first)
+            noise = rng.standard_normal((count, 3)).tolist()
+            jitter = rng.normal(0, 5e-4, count).tolist()
+            extra = rng.normal(0, 0.02, (count, 3)).tolist()
+            errors = rng.uniform(3000, 8000, count).tolist()
+            lines = []
+            for i in range(count):
+                frame = first + i
+                t = frame*dt
+
+                # fly position and the closed-loop decision of this frame
+                fly.step(dt, noise[i], instrip, side)
+                ft.posx, ft.posy = fly.x, fly.y
+                *setpoints, log_vals = logic.experiment_logic(t, None, ft)
+                instrip = log_vals['instrip']
+                if not logic.pre and t > logic.t0:
+                    # side of the strip center the fly is on (for the edge tracking agent)
+                    x = fly.x - logic.x0
+                    center = logic.geometry.classify(x, fly.y - logic.y0)[1]
+                    side = 1 if logic.geometry.wrap(x) > center else -1
+                motor += int(noise[i][0]*3)
+
+                # timestamp (a new date string once per day)
+                us = start_us + int(round((t + jitter[i])*1e6))
+                day, us = divmod(us, 86_400_000_000)
+                if day not in dates:
+                    dates[day] = (start + datetime.timedelta(days=day)).strftime('%m/%d/%Y')
+                seconds, us = divmod(us, 1_000_000)
+                minutes, seconds = divmod(seconds, 60)
+                hours, minutes = divmod(minutes, 60)
+
+                lines.append(LINE_FORMAT % (
+                    dates[day], hours, minutes, seconds, us,
+                    motor, *setpoints, int(pulse_period > 0 and t % pulse_period < dt),
+                    fly.x, fly.y, 2*frame + 120, errors[i], extra[i][0], extra[i][1], extra[i][2], fly.heading % (2*math.pi),
+                    log_vals['adapted_center'], instrip, log_vals['strip_thresh'],
+                ))
+            f.write(''.join(lines))
+            if verbose:
+                print(f'{first + count}/{n_frames} frames', end='\r')
+    if verbose:
+        print()
+    return n_frames
+
+def write_config(path, config):
+    """
+    Write a session config.py (one 'key = value' line per entry)
+    """
+    with open(path, 'w') as f:
+        f.write("log_dir = '.'\n")
+        for key, value in config.items():
+            f.write(f'{key} = {value!r}\n')
+
+def generate_session(folder, duration, logic=None, start=None, **kwargs):
+    """
+    Write a synthetic session folder (config.py and log, named like the rig names them)
+
+    Parameters
+    ----------
+    folder : str
+        Session folder
+    duration : float
+        Duration (seconds)
+    logic : str, optional
+        experiment_logic.py to copy into the session
+    start : datetime.datetime, optional
+        Timestamp of the first frame (default: now)
+    **kwargs
+        Passed to generate_log
+
+    Returns
+    -------
+    log : str
+        Path of the log
+    """
+    os.makedirs(folder, exist_ok=True)
+    start = start or datetime.datetime.now().replace(microsecond=0)
+    config = dict(DEFAULT_CONFIG, **(kwargs.pop('config', None) or {}))
+    write_config(os.path.join(folder, 'config.py'), config)
+    if logic is not None:
+        with open(logic) as src, open(os.path.join(folder, 'experiment_logic.py'), 'w') as dst:
+            dst.write(src.read())
+    log = os.path.join(folder, start.strftime('%m%d%Y-%H%M%S') + '.log')
+    generate_log(log, duration, config=config, start=start, **kwargs)
+    return log
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic rig sessions for scale testing.')
+    parser.add_argument('folder', type=str, help='Folder to write the session folders to.')
+    parser.add_argument('--sessions', default=1, type=int, help='Number of sessions.')
+    parser.add_argument('--duration', default=3600, type=float, help='Duration of each session in seconds (48 h is 172800).')
+    parser.add_argument('--fps', default=30.0, type=float, help='Frame rate of the logs.')
+    parser.add_argument('--agent', default='edge_tracking', type=str, help=f'One of {AGENTS}.')
+    parser.add_argument('--stimulus', default='led', type=str, help="'led' or 'odor'.")
+    parser.add_argument('--period_width', default=100, type=float, help='Period of the strips in mm (0 for a single strip).')
+    parser.add_argument('--alternation_time', default=120, type=float, help='Flowrate alternation time in seconds (0 for a constant flowrate).')
+    parser.add_argument('--logic', default=None, type=str, help='experiment_logic.py to copy into the sessions.')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the first session.')
+    args = parser.parse_args()
+
+    assert args.agent in AGENTS, f"agent must be in {AGENTS}."
+    config = {'periodic_boundary': args.period_width > 0, 'period_width': args.period_width or 100, 'alternation_time': args.alternation_time or None}
+    start = datetime.datetime.now().replace(microsecond=0)
+    for i in range(args.sessions):
+        folder = os.path.join(args.folder, f'synthetic_{args.agent}_{i:04d}')
+        log = generate_session(folder, args.duration, logic=args.logic, start=start + datetime.timedelta(seconds=i),
+                               fps=args.fps, agent=args.agent, config=config, stimulus=args.stimulus, seed=args.seed + i, verbose=True)
+        print(f'Wrote {log} ({os.path.getsize(log)/1e6:.1f} MB)')
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import Normalize
 
 def extract_data(folder):
     '''
@@ -162,6 +164,64 @@ def config_to_title(
         title += suffix
         return title
 
+def rasterize_trajectory(x, y, colorvar, flowrate, unique_flow_rates, colormaps, width, height):
+    """
+    Rasterize a trajectory into an RGBA pixel canvas
+
+    Every sample is binned into a width x height canvas spanning the trajectory and
+    the colours of all samples falling into a pixel are averaged. Colours are taken
+    from the colormap of the sample's flowrate, normalised per flowrate exactly like
+    the scatter backend of plot_trajectory, so both backends look the same.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        Positions of the samples
+    colorvar : numpy.ndarray
+        Variable used for colouring (odor or led)
+    flowrate : numpy.ndarray
+        Flowrate of every sample
+    unique_flow_rates : numpy.ndarray
+        Sorted unique flowrates, one colormap each
+    colormaps : list
+        Colormaps for the unique flowrates
+    width, height : int
+        Size of the canvas in pixels
+
+    Returns
+    -------
+    canvas : numpy.ndarray
+        (height, width, 4) float RGBA image with transparent empty pixels (origin at the bottom)
+    extent : tuple
+        (left, right, bottom, top) of the canvas in data coordinates
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    colorvar = np.asarray(colorvar, dtype=float)
+    flowrate = np.asarray(flowrate)
+
+    # colour every sample with the colormap of its flowrate
+    colors = np.zeros((x.size, 4))
+    for i, flow_rate in enumerate(unique_flow_rates):
+        idx = flowrate == flow_rate
+        colors[idx] = plt.get_cmap(colormaps[i])(Normalize()(colorvar[idx]))
+
+    # bin the samples into pixels
+    extent = (x.min(), x.max(), y.min(), y.max())
+    col = ((x-extent[0])/max(extent[1]-extent[0], np.finfo(float).eps)*width).astype(int)
+    row = ((y-extent[2])/max(extent[3]-extent[2], np.finfo(float).eps)*height).astype(int)
+    pixel = np.clip(row, 0, height-1)*width + np.clip(col, 0, width-1)
+
+    # average the colours per pixel
+    counts = np.bincount(pixel, minlength=width*height)
+    canvas = np.zeros((width*height, 4))
+    for channel in range(4):
+        canvas[:, channel] = np.bincount(pixel, weights=colors[:, channel], minlength=width*height)
+    filled = counts > 0
+    canvas[filled] /= counts[filled, None]
+
+    return canvas.reshape(height, width, 4), extent
+
 def plot_trajectory(
         df,
         config,
@@ -171,7 +231,10 @@ def plot_trajectory(
         config_title=True,
         colormaps=[],
         odor_or_led='odor',
-        black_background=False
+        black_background=False,
+        backend='scatter',
+        raster_dpi=100,
+        metadata=None
 ):
     # process the important variables
     processed_data = process_important_variables(df, config)
@@ -209,9 +272,15 @@ def plot_trajectory(
     
     
     # plot the trajectory (different colors for different flow rates)
-    for i, flow_rate in enumerate(unique_flow_rates):
-        idx = flowrate == flow_rate
-        ax.scatter(x[idx], y[idx], c=colorvar[idx], cmap=colormaps[i], s=0.5)
+    if backend == 'scatter':
+        for i, flow_rate in enumerate(unique_flow_rates):
+            idx = flowrate == flow_rate
+            ax.scatter(x[idx], y[idx], c=colorvar[idx], cmap=colormaps[i], s=0.5)
+    elif backend == 'raster':
+        # the canvas is composited after the layout is known (see below), only reserve its extent here
+        ax.update_datalim([(x.min(), y.min()), (x.max(), y.max())])
+    else:
+        raise ValueError("backend should be 'scatter' or 'raster'")
 
 
     # mark the start
@@ -219,19 +288,25 @@ def plot_trajectory(
     ax.text(x[0], y[0], '  start', fontsize=10, color='black')
 
 
-    # add the odor lines
+    # add the odor lines (all strips as a single collection)
+    strip_width = config['strip_width']/1000
     if config['periodic_boundary']:
         period_width = config['period_width']/1000
-        strip_width = config['strip_width']/1000
         max_x = int(x.max()//period_width)
         min_x = int(x.min()//period_width)
-        for i in range(min_x, max_x+1, 1):
-            start_x = i*period_width-strip_width/2
-            end_x = i*period_width+strip_width/2
-            ax.fill_betweenx([y.min(), y.max()], start_x, end_x, color='grey', alpha=0.2)
+        centers = np.arange(min_x, max_x+1)*period_width
     else:
-        strip_width = config['strip_width']/1000
-        ax.fill_betweenx([y.min(), y.max()], -strip_width/2, strip_width/2, color='grey', alpha=0.2)
+        centers = np.zeros(1)
+    starts = centers-strip_width/2
+    ends = centers+strip_width/2
+    strips = np.stack([
+        np.stack([starts, np.full_like(starts, y.min())], axis=1),
+        np.stack([ends, np.full_like(starts, y.min())], axis=1),
+        np.stack([ends, np.full_like(starts, y.max())], axis=1),
+        np.stack([starts, np.full_like(starts, y.max())], axis=1),
+    ], axis=1)
+    ax.add_collection(PolyCollection(strips, facecolors='grey', edgecolors='none', alpha=0.2))
+    ax.autoscale_view()
         
     # set axis properties
     ax.set_aspect('equal')
@@ -246,13 +321,27 @@ def plot_trajectory(
         spine.set_visible(False)
     plt.tight_layout()
 
+    if backend == 'raster':
+        # size the canvas so that one pixel is 1/raster_dpi inch on the final axes
+        # (roughly one scatter marker at the default raster_dpi)
+        ax.apply_aspect()
+        ax_width = ax.get_position().width*fig.get_figwidth()
+        data_per_inch = (ax.get_xlim()[1]-ax.get_xlim()[0])/ax_width
+        width = max(int(np.ceil((x.max()-x.min())/data_per_inch*raster_dpi)), 1)
+        height = max(int(np.ceil((y.max()-y.min())/data_per_inch*raster_dpi)), 1)
+        canvas, extent = rasterize_trajectory(
+            x.values, y.values, colorvar, flowrate, unique_flow_rates, colormaps, width, height
+            )
+        ax.set_autoscale_on(False)
+        ax.imshow(canvas, extent=extent, origin='lower', interpolation='nearest', aspect='equal', zorder=0.5)
+
 
     if save is not None:
         if type(save) == str:
-            plt.savefig(save, dpi=300)
+            plt.savefig(save, dpi=300, metadata=metadata)
         elif type(save) == list:
             for s in save:
-                plt.savefig(s, dpi=300)
+                plt.savefig(s, dpi=300, metadata=metadata)
         else:
             raise ValueError('save should be a string or a list of strings')
 
@@ -0,0 +1,582 @@
+# Description: Fast rendering of trajectory videos for the flytrailvr package
+
+import io
+import os
+import time
+import queue
+import struct
+import shutil
+import tempfile
+import warnings
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+import imageio
+from PIL import Image
+from tqdm import tqdm
+
+# colors of the video (BGR)
+STRIP_COLOR = (0, 0, 63)
+ODOR_COLOR = (0, 0, 255)
+AIR_COLOR = (255, 255, 255)
+
+# every frame is drawn with these colors only (no antialiasing), so they form a fixed
+# palette for GIF export (RGB, padded to a power of two)
+PALETTE = np.array([(0, 0, 0), STRIP_COLOR[::-1], ODOR_COLOR[::-1], AIR_COLOR[::-1]], np.uint8)
+
+# default codecs for the supported containers
+FOURCC = {
+    'mp4': 'mp4v',
+    'avi': 'MJPG',
+}
+
+class TrajectoryRenderer:
+    """
+    Render the frames of a fly-centered trajectory video
+
+    The fly is drawn at the center of the frame facing its heading, with its path over
+    the last past_window seconds (red in odor, white outside) and the odor region as a
+    dark red band. All per-frame lookups are precomputed: the window of every frame is
+    found with searchsorted and positions are stored as plain arrays.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Dataframe returned by extract_data (or a slice of it)
+    past_window : float
+        Length of the drawn path in seconds
+    scale_factor : float
+        Pixels per mm
+    size : int
+        Width and height of the frame in pixels
+    odor_range : tuple, optional
+        (min, max) of mfc2_stpt used to normalise the odor (default: from df)
+    odor_bounds : tuple, optional
+        (min_x, max_x) of the odor region in mm (default: positions where the odor is on in df)
+    """
+    def __init__(self, df, past_window=15, scale_factor=256/20, size=512, odor_range=None, odor_bounds=None):
+        time = (df['timestamp']-df['timestamp'].iloc[0]).dt.total_seconds().values
+        self.time = time
+        self.x = df['ft_posx'].values.astype(float)
+        self.y = df['ft_posy'].values.astype(float)
+        self.heading = df['ft_heading'].values.astype(float)
+        self.scale_factor = scale_factor
+        self.size = size
+        self.center = size//2
+        self.frame_rate = 1/np.mean(np.diff(time))
+
+        # normalise the odor and mark the samples in odor
+        odor = df['mfc2_stpt'].values.astype(float)
+        if odor_range is None:
+            odor_range = (odor.min(), odor.max())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            odor = (odor - odor_range[0]) / (odor_range[1] - odor_range[0])
+        self.instrip = odor != 0
+
+        # find odor boundaries
+        if odor_bounds is None:
+            odor_on = odor > 0.5
+            odor_bounds = (self.x[odor_on].min(), self.x[odor_on].max()) if odor_on.any() else None
+        self.odor_bounds = odor_bounds
+
+        # samples in (time - past_window, time] for every frame
+        self.window_start = np.searchsorted(time, time - past_window, side='right')
+        self.window_stop = np.searchsorted(time, time, side='right')
+
+        # fly ellipse
+        self.fly_size = (int(2 * scale_factor), int(1 * scale_factor))
+
+    def __len__(self):
+        return len(self.time)
+
+    def new_frame(self):
+        """Allocate an empty frame."""
+        return np.zeros((self.size, self.size, 3), np.uint8)
+
+    def render(self, i, frame=None):
+        """
+        Render frame i
+
+        Parameters
+        ----------
+        i : int
+            Frame index
+        frame : numpy.ndarray, optional
+            Preallocated (size, size, 3) uint8 buffer to draw into
+
+        Returns
+        -------
+        frame : numpy.ndarray
+            The rendered frame (BGR)
+        """
+        if frame is None:
+            frame = self.new_frame()
+        else:
+            frame.fill(0)
+        start, stop = self.window_start[i], self.window_stop[i]
+        last = stop-1
+        center = self.center
+
+        # draw odor regions
+        if self.odor_bounds is not None:
+            start_x = center - (self.odor_bounds[0] - self.x[last]) * self.scale_factor
+            end_x = center - (self.odor_bounds[1] - self.x[last]) * self.scale_factor
+            cv2.rectangle(frame, (int(start_x), 0), (int(end_x), self.size), STRIP_COLOR, -1)
+
+        # plot the trajectory, one polyline per run of segments with the same color
+        # (segment j is colored by the odor state at its end point)
+        px = (center - (self.x[start:stop] - self.x[last]) * self.scale_factor).astype(np.int32)
+        py = (center - (self.y[start:stop] - self.y[last]) * self.scale_factor).astype(np.int32)
+        points = np.stack([px, py], axis=1)
+        colors = self.instrip[start+1:stop]
+        if colors.size > 0:
+            breaks = np.flatnonzero(colors[1:] != colors[:-1]) + 1
+            run_starts = np.concatenate([[0], breaks])
+            run_stops = np.concatenate([breaks, [colors.size]])
+            for run_start, run_stop in zip(run_starts, run_stops):
+                color = ODOR_COLOR if colors[run_start] else AIR_COLOR
+                cv2.polylines(frame, [points[run_start:run_stop+1]], False, color, 2)
+
+        # draw the fly as an ellipsoid at the center of the image
+        heading = (360-(np.rad2deg(self.heading[last])%360)-90)%360
+        color = ODOR_COLOR if self.instrip[last] else AIR_COLOR
+        cv2.ellipse(frame, (center, center), self.fly_size, heading, 0, 360, color, -1)
+        return frame
+
+class _BackgroundWriter:
+    """
+    Write frames to a cv2.VideoWriter from a background thread
+
+    Frames are drawn into a fixed pool of buffers; a buffer is handed back for reuse once
+    it has been encoded, so memory stays constant and drawing overlaps with encoding.
+    """
+    def __init__(self, writer, renderer, buffers=4):
+        self.writer = writer
+        self.free = queue.Queue()
+        for _ in range(buffers):
+            self.free.put(renderer.new_frame())
+        self.pending = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            frame = self.pending.get()
+            if frame is None:
+                break
+            try:
+                if self.error is None:
+                    self.writer.write(frame)
+            except Exception as e:
+                self.error = e
+            self.free.put(frame)
+
+    def get_buffer(self):
+        if self.error is not None:
+            raise self.error
+        return self.free.get()
+
+    def write(self, frame):
+        self.pending.put(frame)
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        self.writer.release()
+        if self.error is not None:
+            raise self.error
+
+def open_video_writer(output, fps, size, fourcc=None):
+    """
+    Open a cv2.VideoWriter for a square video
+
+    The codec is chosen from the extension of output unless fourcc is given.
+    """
+    if fourcc is None:
+        extension = output.split('.')[-1].lower()
+        assert extension in FOURCC, f'Unsupported video format {extension}, please provide fourcc'
+        fourcc = FOURCC[extension]
+    writer = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*fourcc), fps, (size, size))
+    assert writer.isOpened(), f'Could not open video writer for {output}'
+    return writer
+
+def find_ffmpeg():
+    """
+    Find an ffmpeg executable (on the PATH or bundled with imageio-ffmpeg)
+
+    Returns None if ffmpeg is not available.
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        try:
+            import imageio_ffmpeg
+            ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+        except (ImportError, RuntimeError):
+            ffmpeg = None
+    return ffmpeg
+
+def concatenate_videos(segments, output, ffmpeg=None):
+    """
+    Losslessly concatenate video segments with the same codec (ffmpeg concat demuxer, stream copy)
+    """
+    if ffmpeg is None:
+        ffmpeg = find_ffmpeg()
+    assert ffmpeg is not None, 'ffmpeg not found, please install ffmpeg or imageio-ffmpeg'
+    list_file = output + '.segments.txt'
+    with open(list_file, 'w') as f:
+        for segment in segments:
+            path = os.path.abspath(segment).replace("'", "'\\''")
+            f.write(f"file '{path}'\n")
+    try:
+        subprocess.run(
+            [ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', output],
+            check=True
+            )
+    finally:
+        os.remove(list_file)
+
+def _render_frames(renderer, writer, start, stop, buffers, progress=False):
+    # render frames [start, stop) through a background writer
+    writer = _BackgroundWriter(writer, renderer, buffers)
+    try:
+        for i in tqdm(range(start, stop), disable=not progress):
+            frame = writer.get_buffer()
+            renderer.render(i, frame)
+            writer.write(frame)
+    finally:
+        writer.close()
+
+def _render_chunk(renderer, start, stop, output, fps, fourcc, buffers):
+    # worker: render and encode one chunk of the timeline into its own segment
+    # (the renderer holds the whole session, so the first frames of a chunk get
+    # their full past_window history)
+    _render_frames(renderer, open_video_writer(output, fps, renderer.size, fourcc), start, stop, buffers)
+    return stop-start
+
+def write_trajectory_video(
+        df,
+        output,
+        past_window=15,
+        scale_factor=256/20,
+        size=512,
+        fps=None,
+        odor_range=None,
+        odor_bounds=None,
+        fourcc=None,
+        buffers=4,
+        progress=True,
+        workers=1,
+        chunks=None
+):
+    """
+    Render a fly-centered trajectory video
+
+    With workers > 1 the timeline is split into chunks that are rendered and encoded
+    by worker processes and then concatenated without re-encoding (requires ffmpeg,
+    falls back to a single process otherwise).
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Dataframe returned by extract_data (or a slice of it)
+    output : str
+        Path of the video (.mp4 or .avi unless fourcc is given)
+    past_window, scale_factor, size, odor_range, odor_bounds
+        See TrajectoryRenderer
+    fps : float, optional
+        Frames per second of the video (default: twice the frame rate of the data)
+    fourcc : str, optional
+        Codec of the video
+    buffers : int
+        Number of frame buffers shared with the encoder thread
+    progress : bool
+        Show a progress bar (single process) and print the throughput
+    workers : int
+        Number of worker processes
+    chunks : int, optional
+        Number of chunks the timeline is split into (default: workers)
+
+    Returns
+    -------
+    stats : dict
+        Number of frames, workers, elapsed seconds and rendered frames per second
+    """
+    start = time.perf_counter()
+    renderer = TrajectoryRenderer(df, past_window, scale_factor, size, odor_range, odor_bounds)
+    if fps is None:
+        fps = 2*renderer.frame_rate
+    n_frames = len(renderer)
+
+    ffmpeg = find_ffmpeg() if workers > 1 else None
+    if workers > 1 and ffmpeg is None:
+        warnings.warn('ffmpeg not found, rendering the video in a single process')
+        workers = 1
+
+    if workers == 1:
+        _render_frames(renderer, open_video_writer(output, fps, size, fourcc), 0, n_frames, buffers, progress)
+    else:
+        # split the timeline into contiguous chunks
+        if chunks is None:
+            chunks = workers
+        bounds = np.linspace(0, n_frames, min(chunks, n_frames)+1).astype(int)
+        extension = output.split('.')[-1]
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output))) as tmp:
+            segments = [os.path.join(tmp, f'segment_{i:04d}.{extension}') for i in range(len(bounds)-1)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(_render_chunk, renderer, bounds[i], bounds[i+1], segments[i], fps, fourcc, buffers)
+                    for i in range(len(segments))
+                    ]
+                for future in futures:
+                    future.result()
+            concatenate_videos(segments, output, ffmpeg)
+
+    elapsed = time.perf_counter()-start
+    stats = {'frames': n_frames, 'workers': workers, 'seconds': elapsed, 'fps': n_frames/elapsed}
+    if progress:
+        print(f'Rendered {n_frames} frames with {workers} worker(s) in {elapsed:.2f}s ({stats["fps"]:.1f} frames/s)')
+    return stats
+
+def benchmark_video_scaling(df, output_folder, workers=None, extension='mp4', **kwargs):
+    """
+    Measure the throughput of write_trajectory_video for different numbers of workers
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Dataframe returned by extract_data
+    output_folder : str
+        Folder for the benchmark videos
+    workers : list, optional
+        Numbers of workers to test (default: 1, 2, 4, ... up to the number of CPUs)
+    extension : str
+        Video format
+    kwargs
+        Passed to write_trajectory_video
+
+    Returns
+    -------
+    results : list
+        Stats of write_trajectory_video for every number of workers
+    """
+    if workers is None:
+        workers = [2**i for i in range(int(np.log2(os.cpu_count() or 1))+1)]
+    results = []
+    for n in workers:
+        output = os.path.join(output_folder, f'benchmark_{n}.{extension}')
+        results.append(write_trajectory_video(df, output, workers=n, progress=False, **kwargs))
+        print(f'{n} worker(s): {results[-1]["fps"]:.1f} frames/s')
+    return results
+
+def _gif_blocks(data):
+    # split a GIF file into its logical screen descriptor, global color table and the
+    # blocks of each image (descriptor, local color table and LZW data), as laid out in
+    # the GIF89a specification (extension blocks are skipped)
+    screen = data[6:13]
+    position = 13
+    table_size = 3 << ((screen[4] & 0x07) + 1) if screen[4] & 0x80 else 0
+    color_table = data[position:position+table_size]
+    position += table_size
+    images = []
+    while data[position] != 0x3B:
+        start = position
+        if data[position] == 0x21:
+            position += 2
+        else:
+            assert data[position] == 0x2C, 'unexpected GIF block'
+            packed = data[position+9]
+            position += 10 + (3 << ((packed & 0x07) + 1) if packed & 0x80 else 0) + 1
+        while data[position]:
+            position += data[position] + 1
+        position += 1
+        if data[start] == 0x2C:
+            images.append(data[start:position])
+    return screen, color_table, images
+
+class GifWriter:
+    """
+    Streaming animated GIF writer with a fixed palette
+
+    Same interface as an imageio writer (append_data/close). Every frame is mapped onto
+    the fixed palette, encoded on its own with pillow and its image data is appended to
+    the file immediately, unlike the pillow-based imageio GIF writers which keep all
+    frames in memory until closing. Colors that are not in the palette are written as
+    the first palette color.
+
+    Parameters
+    ----------
+    path : str
+        Path of the GIF
+    fps : float
+        Frames per second (GIF delays are rounded to 10 ms)
+    palette : numpy.ndarray
+        (n, 3) uint8 RGB palette (default: PALETTE)
+    loop : int
+        Number of loops (0 loops forever)
+    """
+    def __init__(self, path, fps, palette=PALETTE, loop=0):
+        self.fp = open(path, 'wb')
+        self.palette = np.asarray(palette, np.uint8)
+        self.palette_bytes = self.palette.tobytes()
+        self.duration = int(round(1000/fps))
+        self.loop = loop
+        self.color_table = None
+        keys = (self.palette[:, 0].astype(np.uint32) << 16) | (self.palette[:, 1].astype(np.uint32) << 8) | self.palette[:, 2]
+        self.order = np.argsort(keys).astype(np.uint8)
+        self.sorted_keys = keys[self.order]
+        # graphic control extension of every frame (do not dispose, delay in 1/100 s)
+        self.control = b'!\xf9\x04\x04' + struct.pack('<H', self.duration // 10) + b'\x00\x00'
+
+    def _to_image(self, frame):
+        # map the RGB frame onto the palette indices through packed 24 bit color keys
+        frame = np.asarray(frame)
+        key = (frame[..., 0].astype(np.uint32) << 16) | (frame[..., 1].astype(np.uint32) << 8) | frame[..., 2]
+        position = np.clip(np.searchsorted(self.sorted_keys, key), 0, len(self.sorted_keys)-1)
+        index = np.where(self.sorted_keys[position] == key, self.order[position], 0).astype(np.uint8)
+        image = Image.frombuffer('P', (frame.shape[1], frame.shape[0]), index, 'raw', 'P', 0, 1)
+        image.putpalette(self.palette_bytes)
+        return image
+
+    def append_data(self, frame, meta=None):
+        buffer = io.BytesIO()
+        self._to_image(frame).save(buffer, format='GIF', optimize=False)
+        screen, color_table, images = _gif_blocks(buffer.getvalue())
+        if self.color_table is None:
+            # header, logical screen and global color table of the first frame, then the
+            # NETSCAPE2.0 application extension with the number of loops
+            self.fp.write(b'GIF89a' + screen + color_table)
+            self.fp.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', self.loop) + b'\x00')
+            self.color_table = color_table
+        assert color_table == self.color_table, 'frame was not encoded with the fixed palette'
+        for image in images:
+            self.fp.write(self.control + image)
+
+    def close(self):
+        if self.color_table is not None:
+            self.fp.write(b';') # GIF trailer
+        self.fp.close()
+
+def export_trajectory_animation(
+        df,
+        output,
+        step=1,
+        max_frames=None,
+        speed=2,
+        past_window=15,
+        scale_factor=256/20,
+        size=512,
+        odor_range=None,
+        odor_bounds=None,
+        progress=True
+):
+    """
+    Stream a trajectory animation to a GIF or MP4 file with imageio
+
+    Frames are rendered one at a time and handed directly to the imageio writer, so
+    memory does not grow with the length of the session. MP4s are written with the
+    imageio ffmpeg writer and GIFs with GifWriter using the fixed PALETTE of the
+    renderer (no per-frame quantization).
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Dataframe returned by extract_data (or a slice of it)
+    output : str
+        Path of the animation (.gif or .mp4, MP4 requires imageio-ffmpeg)
+    step : int
+        Render every step-th frame (decimation for previews)
+    max_frames : int, optional
+        Maximum number of frames to write
+    speed : float
+        Playback speed relative to real time
+    past_window, scale_factor, size, odor_range, odor_bounds
+        See TrajectoryRenderer
+    progress : bool
+        Show a progress bar
+
+    Returns
+    -------
+    stats : dict
+        Number of frames, elapsed seconds and rendered frames per second
+    """
+    start = time.perf_counter()
+    renderer = TrajectoryRenderer(df, past_window, scale_factor, size, odor_range, odor_bounds)
+    frames = range(0, len(renderer), step)
+    if max_frames is not None:
+        frames = frames[:max_frames]
+    fps = speed*renderer.frame_rate/step
+
+    extension = output.split('.')[-1].lower()
+    if extension == 'gif':
+        writer = GifWriter(output, fps)
+    elif extension == 'mp4':
+        writer = imageio.get_writer(output, format='FFMPEG', mode='I', fps=fps, codec='libx264', pixelformat='yuv420p')
+    else:
+        raise ValueError('output should be a .gif or .mp4 file')
+
+    frame = renderer.new_frame()
+    rgb = renderer.new_frame()
+    try:
+        for i in tqdm(frames, disable=not progress):
+            renderer.render(i, frame)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb)
+            writer.append_data(rgb)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter()-start
+    return {'frames': len(frames), 'seconds': elapsed, 'fps': len(frames)/elapsed}
+
+def _export_preview(folder, output, kwargs):
+    # worker: export the preview of one session
+    from .utils import extract_data
+    start = time.perf_counter()
+    result = {'session': os.path.basename(os.path.normpath(folder)), 'output': output, 'seconds': 0.0, 'error': None}
+    try:
+        df, config, logic, comments = extract_data(folder)
+        export_trajectory_animation(df, output, progress=False, **kwargs)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter()-start
+    return result
+
+def export_previews(data_folder, output_folder, extension='gif', workers=None, step=10, max_frames=1000, size=256, scale_factor=128/20, **kwargs):
+    """
+    Export lightweight trajectory previews for all sessions in parallel
+
+    Parameters
+    ----------
+    data_folder : str
+        Folder containing the session folders (sessions without a log file are skipped)
+    output_folder : str
+        Folder for the previews (named after the sessions)
+    extension : str
+        'gif' or 'mp4'
+    workers : int, optional
+        Number of worker processes (default: number of CPUs)
+    step, max_frames, size, scale_factor, kwargs
+        Passed to export_trajectory_animation
+
+    Returns
+    -------
+    results : list
+        Session, output path, elapsed seconds and error message (None on success) per session
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    kwargs.update({'step': step, 'max_frames': max_frames, 'size': size, 'scale_factor': scale_factor})
+    jobs = []
+    for session in sorted(os.listdir(data_folder)):
+        folder = os.path.join(data_folder, session)
+        if os.path.isdir(folder) and any(file.endswith('.log') for file in os.listdir(folder)):
+            jobs.append((folder, os.path.join(output_folder, f'{session}.{extension}')))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_export_preview, folder, output, kwargs) for folder, output in jobs]
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            print(f'{result["session"]}: ' + (f'done in {result["seconds"]:.2f}s' if result['error'] is None else result['error']))
+    return results
@@ -0,0 +1,248 @@
+# Description: Throughput benchmark of locking/unlocking archives with rdp_client
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import multiprocessing as mp
+import numpy as np
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from flytrailvr import rdp_client
+
+# synthetic dataset profiles: sessions x (log size, number of small files, png size)
+PROFILES = {
+    'many_small': {'sessions': 200, 'log_bytes': 50_000, 'small_files': 10, 'png_bytes': 20_000},
+    'few_large': {'sessions': 4, 'log_bytes': 50_000_000, 'small_files': 2, 'png_bytes': 500_000},
+}
+
+LOG_HEADER = 'timestamp -- motor_step_command,mfc1_stpt,mfc2_stpt,mfc3_stpt,led1_stpt,led2_stpt,sig_status,ft_posx,ft_posy,ft_frame,ft_error,ft_roll,ft_pitch,ft_yaw,ft_heading,adapted_center,instrip,mode,strip_thresh\n'
+
+def _write_log(path, size, rng):
+    # FicTrac-like log lines (compress like the real logs)
+    with open(path, 'w') as f:
+        f.write(LOG_HEADER)
+        written, frame = len(LOG_HEADER), 0
+        x, y = 0.0, 0.0
+        while written < size:
+            lines = []
+            for step in rng.normal(0, 0.5, size=(1000, 2)):
+                x, y, frame = x + step[0], y + abs(step[1]), frame + 1
+                lines.append(f'03/26/2024-14:40:{frame/60%60:09.6f} -- 0,0.8,0.0,0.0,1,1,1,{x:.6f},{y:.6f},{frame},0.01,0.001,0.002,0.003,{rng.uniform(0, 6.28):.6f},0.0,{int(abs(x) < 5)},1,5.0\n')
+            block = ''.join(lines)
+            f.write(block)
+            written += len(block)
+
+def generate_dataset(folder, profile, seed=0, scale=1.0):
+    """
+    Write a synthetic dataset of session folders
+
+    Every session has a config.py, a FicTrac-like log, small text files and an
+    incompressible trajectory.png (random bytes). scale multiplies the number of
+    sessions of many_small profiles and the log sizes of few_large profiles.
+
+    Returns the total size in bytes.
+    """
+    rng = np.random.default_rng(seed)
+    spec = dict(PROFILES[profile])
+    if spec['sessions'] > 10:
+        spec['sessions'] = max(int(spec['sessions'] * scale), 1)
+    else:
+        spec['log_bytes'] = int(spec['log_bytes'] * scale)
+    for i in range(spec['sessions']):
+        session = os.path.join(folder, f'synthetic_{i:04d}')
+        os.makedirs(session, exist_ok=True)
+        with open(os.path.join(session, 'config.py'), 'w') as f:
+            f.write('strip_width = 10 # mm\nstrip_angle = 0 # deg\nflowrate = 0.8 # L/min\n')
+        _write_log(os.path.join(session, f'0326{2024 + i % 3}-{i:06d}.log'), spec['log_bytes'], rng)
+        for j in range(spec['small_files']):
+            with open(os.path.join(session, f'notes_{j:02d}.txt'), 'w') as f:
+                f.write(f'session {i} note {j}\n' * int(rng.integers(1, 50)))
+        with open(os.path.join(session, 'trajectory.png'), 'wb') as f:
+            f.write(rng.bytes(spec['png_bytes']))
+    return _disk_usage(folder)[0]
+
+# temporary files of rdp_client (files being written and journals)
+TEMP_SUFFIXES = ('.part', '.journal')
+
+def _disk_usage(folder):
+    # bytes of all files and of the temporary files in folder
+    total, temp = 0, 0
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            try:
+                size = os.path.getsize(os.path.join(root, file))
+            except OSError:
+                continue # removed while walking
+            total += size
+            if file.endswith(TEMP_SUFFIXES):
+                temp += size
+    return total, temp
+
+def _run_case(operation, kwargs, workdir, queue):
+    # run one operation in a fresh process, sampling the disk usage of workdir: the growth
+    # of all files (archives or extracted files included) and the temporary files alone
+    baseline = _disk_usage(workdir)[0]
+    peak = [0, 0]
+    done = threading.Event()
+    def update():
+        total, temp = _disk_usage(workdir)
+        peak[0] = max(peak[0], total - baseline)
+        peak[1] = max(peak[1], temp)
+    def sample():
+        while not done.is_set():
+            update()
+            done.wait(0.05)
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    os.chdir(workdir)
+    start = time.perf_counter()
+    getattr(rdp_client, operation)(**kwargs)
+    seconds = time.perf_counter() - start
+    done.set()
+    sampler.join()
+    update()
+    # ru_maxrss is in KiB on Linux (bytes on macOS)
+    scale = 1 if sys.platform == 'darwin' else 1024
+    queue.put({
+        'seconds': seconds,
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'peak_children_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+        'peak_disk_bytes': peak[0],
+        'peak_temp_disk_bytes': peak[1],
+    })
+
+def measure(operation, kwargs, workdir):
+    queue = mp.get_context('spawn').Queue()
+    process = mp.get_context('spawn').Process(target=_run_case, args=(operation, kwargs, workdir, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def benchmark(output_folder, profiles=('many_small', 'few_large'), split_sizes=(10_000_000, 50_000_000), workers=(1,), compression='adaptive', scale=1.0, verbose=True):
+    """
+    Lock and unlock synthetic datasets in single and multifile modes
+
+    Parameters
+    ----------
+    output_folder : str
+        Scratch folder (datasets and archives are written here and removed)
+    profiles : tuple
+        Dataset profiles (see PROFILES)
+    split_sizes : tuple
+        split_size_bytes values of the multifile runs
+    workers : tuple
+        Numbers of workers to run
+    compression : str
+        Compression of zip_and_lock_folder
+    scale : float
+        Dataset scale (see generate_dataset)
+
+    Returns
+    -------
+    results : list
+        One dictionary per case with the timings, throughput (MB/s of dataset), peak RSS
+        (benchmark process and worker processes), peak disk usage (growth of all files, so
+        the archive or the extracted files) and peak temporary disk usage (.part files and
+        journals only), and archive size
+    """
+    results = []
+    for profile in profiles:
+        workdir = tempfile.mkdtemp(prefix=f'rdp_{profile}_', dir=output_folder)
+        data = os.path.join(workdir, 'data')
+        size = generate_dataset(data, profile, scale=scale)
+        with open(os.path.join(workdir, 'key.key'), 'wb') as f:
+            f.write(Fernet.generate_key())
+        n_files = sum(len(files) for _, _, files in os.walk(data))
+
+        modes = [(False, None)] + [(True, split_size) for split_size in split_sizes]
+        for multifile, split_size in modes:
+            for n_workers in workers:
+                case = {'profile': profile, 'dataset_bytes': size, 'files': n_files, 'multifile': multifile,
+                        'split_size_bytes': split_size, 'workers': n_workers, 'compression': compression}
+                lock_kwargs = {'data2zip': 'data', 'multifile': multifile, 'workers': n_workers, 'compression': compression}
+                if multifile:
+                    lock_kwargs['split_size_bytes'] = split_size
+                lock = measure('zip_and_lock_folder', lock_kwargs, workdir)
+                archives = [file for file in os.listdir(workdir) if file.startswith('data.ezip')]
+                archive_bytes = sum(os.path.getsize(os.path.join(workdir, file)) for file in archives)
+
+                # unlock into a fresh folder
+                os.rename(data, data + '_original')
+                unlock = measure('unlock_and_unzip_file', {'data2unzip': 'data.ezip.000' if multifile else 'data.ezip', 'multifile': multifile, 'workers': n_workers}, workdir)
+                shutil.rmtree(data)
+                os.rename(data + '_original', data)
+                for file in archives:
+                    os.remove(os.path.join(workdir, file))
+
+                for name, result in [('lock', lock), ('unlock', unlock)]:
+                    case[name] = dict(result, mb_per_s=size / 1e6 / result['seconds'])
+                case['archive_bytes'] = archive_bytes
+                results.append(case)
+                if verbose:
+                    print(f"{profile:>10} {'multi ' + str(split_size) if multifile else 'single':>15} workers={n_workers}: "
+                          f"lock {case['lock']['mb_per_s']:.1f} MB/s, unlock {case['unlock']['mb_per_s']:.1f} MB/s, "
+                          f"peak RSS {max(lock['peak_rss_bytes'], unlock['peak_rss_bytes'])/1e6:.0f} MB, "
+                          f"peak temp disk {max(lock['peak_temp_disk_bytes'], unlock['peak_temp_disk_bytes'])/1e6:.0f} MB")
+        shutil.rmtree(workdir)
+    return results
+
+def _case_key(case):
+    return (case['profile'], case['multifile'], case['split_size_bytes'], case['workers'], case['compression'])
+
+def compare(results, previous):
+    # print throughput ratios against a previous results file
+    reference = {_case_key(case): case for case in previous['results']}
+    for case in results:
+        if _case_key(case) in reference:
+            old = reference[_case_key(case)]
+            ratios = ', '.join(f"{name} x{case[name]['mb_per_s']/old[name]['mb_per_s']:.2f}" for name in ['lock', 'unlock'])
+            print(f'{_case_key(case)}: {ratios}')
+
+def _version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark locking/unlocking synthetic datasets with rdp_client.')
+    parser.add_argument('--output', default='rdp_benchmark.json', type=str, help='JSON file to save the results to.')
+    parser.add_argument('--scratch', default=None, type=str, help='Scratch folder for datasets and archives. Default is the system temp folder.')
+    parser.add_argument('--profiles', default=list(PROFILES), nargs='+', type=str, help='Dataset profiles to run.')
+    parser.add_argument('--split_sizes', default=[10_000_000, 50_000_000], nargs='+', type=int, help='split_size_bytes values of the multifile runs.')
+    parser.add_argument('--workers', default=[1], nargs='+', type=int, help='Numbers of workers to run.')
+    parser.add_argument('--compression', default='adaptive', type=str, help="'adaptive' or 'deflate'.")
+    parser.add_argument('--scale', default=1.0, type=float, help='Dataset scale (1 is about 200 MB per profile).')
+    parser.add_argument('--compare', default=None, type=str, help='Previous results file to compare throughput against.')
+    args = parser.parse_args()
+
+    assert all(profile in PROFILES for profile in args.profiles), f"profiles must be in {list(PROFILES)}."
+
+    results = benchmark(args.scratch, args.profiles, args.split_sizes, args.workers, args.compression, args.scale)
+    report = {
+        'version': _version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': args.scale,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved results to {args.output}')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
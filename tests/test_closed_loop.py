@@ -0,0 +1,253 @@
+import json
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from flytrailvr.logic import StripLogic
+from flytrailvr.closed_loop import StripGeometry, FrameLogger, StreamingHistogram, LatencyMonitor, ReplayScheduler, SetpointDispatcher, FlowrateSchedule
+
+GEOMETRIES = [
+    StripGeometry(10),
+    StripGeometry(10, 30, 'left'),
+    StripGeometry(20, -20, 'right', y_limit=500),
+    StripGeometry(10, 0, 'right', True, 100),
+    StripGeometry(15, 45, 'left', True, 60),
+]
+
+def test_wrap_at_period_edges():
+    geometry = StripGeometry(10, 0, 'right', True, 100)
+    # periods are [-50, 50) + k*100
+    assert geometry.wrap(-50.0) == -50.0
+    assert geometry.wrap(50.0) == -50.0
+    assert geometry.wrap(49.5) == 49.5
+    assert geometry.wrap(150.0) == -50.0
+    assert geometry.wrap(-150.0) == -50.0
+    assert geometry.wrap(-50.5) == 49.5
+    assert geometry.wrap(230.0) == 30.0
+    # the strip repeats every period, up to its edges
+    assert geometry.classify(100.0, 0.0)[0]
+    assert geometry.classify(205.0, 0.0)[0] and geometry.classify(-105.0, 0.0)[0]
+    assert not geometry.classify(206.0, 0.0)[0] and not geometry.classify(-106.0, 0.0)[0]
+    # without periodic_boundary nothing wraps
+    assert StripGeometry(10).wrap(150.0) == 150.0
+    assert not StripGeometry(10).classify(100.0, 0.0)[0]
+
+def test_classify_strip_edges():
+    geometry = StripGeometry(10, 0, 'right', y_limit=100)
+    assert geometry.classify(5.0, 0.0) == (True, 0.0, 5.0)
+    assert not geometry.classify(5.5, 0.0)[0]
+    assert not geometry.classify(0.0, 100.0)[0] and not geometry.classify(0.0, -100.0)[0]
+    # tilted strips: the center moves with y, to the right or to the left
+    right = StripGeometry(10, 45, 'right')
+    left = StripGeometry(10, 45, 'left')
+    assert right.classify(0.0, 20.0)[1] == pytest.approx(20.0)
+    assert left.classify(0.0, 20.0)[1] == pytest.approx(-20.0)
+    assert right.strip_thresh == pytest.approx(5/np.cos(np.deg2rad(45)))
+
+@pytest.mark.parametrize('geometry', GEOMETRIES, ids=repr)
+def test_classify_array_matches_classify(geometry):
+    rng = np.random.default_rng(0)
+    x = np.concatenate([rng.uniform(-300, 300, 2000), [-50.0, 50.0, 30.0, -30.0, 5.0, -5.0]])
+    y = np.concatenate([rng.uniform(-700, 700, 2000), [0.0, 0.0, 0.0, 0.0, 500.0, -500.0]])
+    instrip, center, thresh = geometry.classify_array(x, y)
+    expected = [geometry.classify(float(a), float(b)) for a, b in zip(x, y)]
+    assert instrip.tolist() == [e[0] for e in expected]
+    assert np.allclose(center, [e[1] for e in expected])
+    assert thresh == geometry.strip_thresh
+    assert instrip.any() and not instrip.all()
+
+def test_from_config():
+    config = {'strip_width': 10, 'strip_angle': 30, 'strip_direction': 'left', 'periodic_boundary': True, 'period_width': 100}
+    geometry = StripGeometry.from_config(config)
+    assert repr(geometry) == repr(StripGeometry(10, 30, 'left', True, 100))
+    with pytest.raises(AssertionError):
+        StripGeometry(10, 90)
+    with pytest.raises(AssertionError):
+        StripGeometry(10, 0, 'right', True)
+
+def test_frame_logger_drops_when_full():
+    summaries = []
+    logger = FrameLogger(fields=('time', 'x'), capacity=4, console=summaries.append)
+    # no consumer: the buffer fills up and the next records are dropped, not blocked on
+    assert [logger.log(i, 2*i) for i in range(6)] == [True]*4 + [False]*2
+    assert logger.dropped == 2
+    logger.close()
+    assert logger.written == 4
+    assert summaries == ['time=3 | x=6 | frames=4 | dropped=2']
+    # drained: there is room again
+    assert logger.log(6, 12)
+
+def test_frame_logger_close_drains(tmp_path):
+    path = str(tmp_path / 'frames.csv')
+    summaries = []
+    # the background thread never wakes up before close(): close() writes everything queued
+    logger = FrameLogger(path, fields=('time', 'x', 'instrip'), capacity=8192, console_interval=3600,
+                         drain_interval=3600, console=summaries.append)
+    with logger:
+        assert all([logger.log(i, i/2, i % 3 == 0) for i in range(5000)])
+        assert logger.written == 0
+    assert logger._thread is None and logger._file is None
+    assert logger.written == 5000 and logger.dropped == 0
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'time,x,instrip'
+    assert lines[1:] == [f'{i},{i/2},{i % 3 == 0}' for i in range(5000)]
+    # console summaries are rate limited
+    assert len(summaries) == 1
+
+def test_streaming_histogram_quantiles():
+    histogram = StreamingHistogram(min_value=1, max_value=1e6)
+    for value in range(1, 10001):
+        histogram.add(value)
+    assert (histogram.count, histogram.min, histogram.max) == (10000, 1, 10000)
+    # quantiles are exact up to the bin width (50 bins per decade: under 5%)
+    for q in [0.1, 0.5, 0.9, 0.99]:
+        assert histogram.quantile(q) == pytest.approx(q*10000, rel=0.05)
+    assert StreamingHistogram().quantile(0.5) is None
+
+def test_latency_monitor_counts_misses():
+    monitor = LatencyMonitor(fps=1000)
+    @monitor.wrap
+    def callback(delay):
+        time.sleep(delay)
+        return delay
+    assert callback.__name__ == 'callback'
+    for delay in [0, 0.003, 0, 0.003, 0]:
+        assert callback(delay) == delay
+    report = monitor.report()
+    assert report['frames'] == 5
+    # a 3 ms call misses its 1 ms deadline and makes the next frame late
+    assert report['deadline_misses'] == 2 and report['deadline_miss_rate'] == 0.4
+    assert report['late_frames'] >= 2
+    assert report['latency_ms']['max'] >= 3
+
+def test_latency_monitor_write_report(tmp_path):
+    monitor = LatencyMonitor()
+    timed = monitor.wrap(lambda: None)
+    for _ in range(10):
+        timed()
+    # next to the FicTrac log
+    path = monitor.write_report(str(tmp_path / 'fictrac-20240101_120000.log'))
+    assert path == str(tmp_path / 'fictrac-20240101_120000.timing.json')
+    with open(path) as f:
+        report = json.load(f)
+    assert report['frames'] == 10 and report['latency_ms']['count'] == 10
+    assert set(report) == set(monitor.report())
+    # any other path is used as is
+    assert monitor.write_report(str(tmp_path / 'timing.json')) == str(tmp_path / 'timing.json')
+    assert not (tmp_path / 'fictrac-20240101_120000.log').exists()
+
+TIMES = [0.0, 1.0, 2.0, 3.0]
+SETPOINTS = [[0.5, 0.0, 0.0], [0.25, 0.25, 0.0], [0.0, 0.5, 0.0], [0.5, 0.0, 0.0]]
+
+def test_replay_tolerance_boundary():
+    # the next entry is played early only strictly within tolerance
+    for time, index in [(-1.0, 0), (0.5, 0), (0.75, 0), (0.76, 1), (1.0, 1), (1.74, 1), (1.76, 2), (3.0, 3), (3.25, 3)]:
+        scheduler = ReplayScheduler(TIMES, SETPOINTS, tolerance=0.25)
+        assert scheduler.setpoint(time) == tuple(SETPOINTS[index]), time
+        assert scheduler.index == index
+    # after the end of the timeline (last entry + tolerance)
+    scheduler = ReplayScheduler(TIMES, SETPOINTS, tolerance=0.25)
+    assert scheduler.setpoint(3.0) is not None and not scheduler.done
+    assert scheduler.setpoint(3.26) is None and scheduler.done
+
+def test_replay_skipped_entries():
+    scheduler = ReplayScheduler(TIMES, SETPOINTS, tolerance=0.25)
+    assert scheduler.setpoint(0.0) == tuple(SETPOINTS[0])
+    # a frame late by more than a period jumps over entry 1 without playing it
+    assert scheduler.setpoint(2.5) == tuple(SETPOINTS[2])
+    assert scheduler.skipped == 1
+    assert scheduler.setpoint(2.9) == tuple(SETPOINTS[3])
+    report = scheduler.report()
+    assert (report['frames'], report['entries'], report['skipped_entries']) == (3, 4, 1)
+    assert report['max_error_ms'] == pytest.approx(500)
+    scheduler.reset()
+    assert scheduler.skipped == 0 and scheduler.index == -1
+
+def test_replay_setpoints_at_matches_setpoint():
+    rng = np.random.default_rng(1)
+    times = np.sort(rng.uniform(0, 10, 50))
+    setpoints = rng.uniform(0, 1, (50, 3))
+    frames = np.concatenate([[-1.0], np.sort(rng.uniform(-0.5, 11, 3000)), times, times + 0.05, times - 0.05])
+    frames.sort()
+    scheduler = ReplayScheduler(times, setpoints, tolerance=0.05)
+    expected = [scheduler.setpoint(float(t)) for t in frames]
+    expected = np.array([row if row is not None else [np.nan]*3 for row in expected])
+    assert np.array_equal(scheduler.setpoints_at(frames), expected, equal_nan=True)
+
+def test_dispatcher_writes_changes_and_keepalive():
+    writes = []
+    dispatcher = SetpointDispatcher(lambda t, channel, value: writes.append((t, channel, value)), keepalive=1.0)
+    # first frame: every device
+    assert dispatcher.dispatch(0.0, (0.5, 0.0, 0.0)) == 3
+    assert dispatcher.dispatch(0.25, (0.5, 0.0, 0.0)) == 0
+    # only the changed setpoint
+    assert dispatcher.dispatch(0.5, (0.5, 0.5, 0.0)) == 1
+    assert writes[-1] == (0.5, 1, 0.5)
+    assert dispatcher.dispatch(0.75, (0.5, 0.5, 0.0)) == 0
+    # keep-alive: the devices last written at 0 are refreshed, not the one written at 0.5
+    assert dispatcher.dispatch(1.0, (0.5, 0.5, 0.0)) == 2
+    assert writes[-2:] == [(1.0, 0, 0.5), (1.0, 2, 0.0)]
+    assert dispatcher.dispatch(1.5, (0.5, 0.5, 0.0)) == 1
+    assert writes[-1] == (1.5, 1, 0.5)
+    assert len(writes) == 7
+    report = dispatcher.report()
+    assert (report['frames'], report['writes'], report['refreshes'], report['suppressed']) == (6, 7, 3, 11)
+    assert report['suppressed_fraction'] == 11/18
+    # reset: everything is written again
+    dispatcher.reset()
+    assert dispatcher.dispatch(1.75, (0.5, 0.5, 0.0)) == 3
+
+def test_dispatcher_tolerance_without_keepalive():
+    writes = []
+    dispatcher = SetpointDispatcher(lambda t, channel, value: writes.append((t, channel, value)), keepalive=None, tolerance=0.01)
+    dispatcher.dispatch(0.0, (1.0, 0.0))
+    assert dispatcher.dispatch(0.5, (1.005, 0.0)) == 0
+    assert dispatcher.dispatch(100.0, (1.0, 0.0)) == 0
+    assert dispatcher.dispatch(100.5, (1.02, 0.0)) == 1
+    assert writes == [(0.0, 0, 1.0), (0.0, 1, 0.0), (100.5, 0, 1.02)]
+    # the number of channels changed: every setpoint is written
+    assert dispatcher.dispatch(101.0, (1.02, 0.0, 0.0)) == 3
+
+CONFIG = {
+    'strip_width': 50, 'strip_angle': 0, 'led_intensity': 60, 'pre_onset_time': 1.0,
+    'flowrate': 500, 'flowrate_high': 800, 'flowrate_low': 200, 'alternation_time': 2.0,
+}
+
+def test_flowrate_schedule_phases():
+    schedule = FlowrateSchedule.from_config(CONFIG)
+    assert schedule.alternated
+    for t, phase, flowrate in [(0.0, 0, 800), (1.99, 0, 800), (2.0, 1, 200), (3.99, 1, 200), (4.0, 0, 800), (6.5, 1, 200)]:
+        assert schedule.phase(t) == phase
+        assert schedule.flowrate_at(t) == flowrate
+        assert schedule.air_sp(t) == flowrate/1000.
+    assert schedule.pre_onset_air == 0.5
+    times = np.arange(-1, 10, 0.1)
+    assert np.array_equal(schedule.timeline(times + 1.0), [schedule.flowrate_at(t) if t >= 0 else 500 for t in times])
+    # without alternation (or without one of the flowrates) the flowrate is constant
+    for constant in [FlowrateSchedule(500), FlowrateSchedule(500, 800, None, 2.0), FlowrateSchedule(500, 800, 200, None)]:
+        assert not constant.alternated
+        assert constant.flowrate_at(1e6) == 500
+        assert np.all(constant.timeline(times) == 500)
+
+def test_log_timeline_matches_strip_logic():
+    # the onset frame gets flowrate (not flowrate_high), the alternation starts at the next frame
+    schedule = FlowrateSchedule.from_config(CONFIG)
+    logic = StripLogic(CONFIG, 'led', alternated=True)
+    frame = type('Frame', (), {'posx': 0.0, 'posy': 0.0})()
+    for t0 in [0.0, 0.1]:
+        logic.reset()
+        t = np.arange(t0, 10, 0.25)
+        expected = []
+        for time in t:
+            # outside the strip after the onset: the total flow is the air setpoint
+            frame.posx = 0.0 if time <= CONFIG['pre_onset_time'] else 100.0
+            air_sp, odor1_sp = logic.experiment_logic(time, None, frame)[:2]
+            expected.append(1000*(air_sp + odor1_sp))
+        flowrate = schedule.log_timeline(pd.DataFrame({'t': t}))
+        assert np.allclose(flowrate, expected)
+        onset = np.nonzero(t >= CONFIG['pre_onset_time'])[0][0]
+        assert flowrate[onset] == 500 and flowrate[onset + 1] == 800
+        assert set(flowrate[:onset]) == {500}
+    # no onset in the log
+    assert np.all(schedule.log_timeline(pd.DataFrame({'t': [0.0, 0.5, 0.75]})) == 500)
@@ -0,0 +1,122 @@
+import os
+import sys
+import shutil
+import datetime
+import numpy as np
+import pytest
+from flytrailvr import harness, logic, synthetic
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'charlie_rig_rishika')
+REPLAY_COPIES = {
+    'odor_strip_replay': os.path.join(DATA, 'low_wind_thin_20240319-150617', 'experiment_logic.py'),
+    'odor_led_strip_replay': os.path.join(DATA, 'orco_thinstrip_with_odor_20240320-164441', 'experiment_logic.py'),
+}
+START = datetime.datetime(2024, 3, 19, 15, 6, 17)
+
+@pytest.fixture
+def session(tmp_path):
+    # 40 s session (the replayed timeline) and 100 s of frames to run on it
+    def make(name, include_pre_air=True):
+        folder = str(tmp_path / name)
+        config = {'pre_onset_time': 10, 'include_pre_air': include_pre_air}
+        log = synthetic.generate_session(folder, 40, logic=REPLAY_COPIES[name], start=START, config=config, stimulus='odor', seed=1)
+        frames_log = str(tmp_path / f'{name}_frames.log')
+        synthetic.generate_log(frames_log, 100, config=config, stimulus='odor', start=START, seed=2)
+        return folder, log, list(harness.frames_from_log(harness.read_log(frames_log)))
+    return make
+
+@pytest.mark.parametrize('name', sorted(REPLAY_COPIES))
+@pytest.mark.parametrize('include_pre_air', [True, False])
+def test_replay_matches_copy(session, tmp_path, name, include_pre_air):
+    folder, log, frames = session(name, include_pre_air)
+    template = logic.get_template(name)
+    assert logic.identify_logic(REPLAY_COPIES[name]) is template
+    stub = str(tmp_path / 'stub.py')
+    with open(stub, 'w') as f:
+        f.write(template.stub())
+
+    copy = harness.run_session(folder, log=log, frames=frames, replay_at=30)
+    built = harness.run_session(folder, log=log, frames=frames, template=template, replay_at=30)
+    stubbed = harness.run_session(folder, log=log, frames=frames, logic_path=stub, replay_at=30)
+    assert stubbed['mode'] == built['mode']
+    np.testing.assert_array_equal(stubbed['setpoints'], built['setpoints'])
+
+    # the copy sleeps until (and pops) every recorded entry while the template plays the
+    # nearest one, so the last entry may be held for up to the tolerance
+    times = np.array([t for t, ft in frames])
+    replays = []
+    for result in [copy, built]:
+        mode = np.array(result['mode'])
+        replay = np.nonzero(mode == 'replay')[0]
+        assert len(replay) > 0 and (mode[replay[0]:replay[-1] + 1] == 'replay').all()
+        assert (mode[replay[-1] + 1:] == 'live').all() and replay[-1] + 1 < len(mode)
+        assert (result['setpoints'][replay][:, 3:] == 0.0).all()
+        np.testing.assert_array_equal(result['setpoints'][replay[-1] + 1], [0.0, 0.0, 0.0, 0.0, 0.0])
+        replays.append(replay)
+    assert replays[0][0] == replays[1][0]
+    np.testing.assert_array_equal(built['setpoints'][:replays[0][0]], copy['setpoints'][:replays[0][0]])
+    assert abs(times[replays[0][-1]] - times[replays[1][-1]]) <= 0.05
+    both = np.intersect1d(*replays)
+    np.testing.assert_array_equal(built['setpoints'][both], copy['setpoints'][both])
+
+def test_stub_shares_live(tmp_path):
+    config_path = str(tmp_path / 'config.py')
+    synthetic.write_config(config_path, synthetic.DEFAULT_CONFIG)
+    stub = str(tmp_path / 'stub.py')
+    with open(stub, 'w') as f:
+        f.write(logic.ODOR_STRIP_REPLAY.stub())
+    module = harness.load_logic(stub, harness.load_config(config_path))
+    assert module.live and module.logic.live
+    module.live = False
+    assert not module.logic.live
+    module.logic.live = True
+    assert module.live
+
+def test_live_only_template_never_replays(tmp_path):
+    folder = str(tmp_path / 'session')
+    log = synthetic.generate_session(folder, 40, start=START, config={'pre_onset_time': 10}, seed=1)
+    live = harness.run_session(folder, log=log, template='led_strip')
+    flipped = harness.run_session(folder, log=log, template='led_strip', replay_at=20)
+    assert set(flipped['mode']) == {'live'}
+    assert live['comparison']['all'] == 1.0
+
+def test_load_logic_writes_no_bytecode(tmp_path, monkeypatch):
+    # even where python writes bytecode (PYTHONDONTWRITEBYTECODE unset)
+    monkeypatch.setattr(sys, 'dont_write_bytecode', False)
+    folder = tmp_path / 'session'
+    os.mkdir(folder)
+    for name in ['config.py', 'experiment_logic.py']:
+        shutil.copy(os.path.join(os.path.dirname(REPLAY_COPIES['odor_strip_replay']), name), folder / name)
+    config = harness.load_config(str(folder / 'config.py'))
+    module = harness.load_logic(str(folder / 'experiment_logic.py'), config)
+    assert module.__file__ == str(folder / 'experiment_logic.py')
+    assert callable(module.experiment_logic)
+    log = str(tmp_path / 'frames.log')
+    synthetic.generate_log(log, 5, start=START, stimulus='odor', seed=1)
+    harness.run_session(str(folder), log=log)
+    assert sorted(os.listdir(folder)) == ['config.py', 'experiment_logic.py']
+
+@pytest.mark.parametrize('stimulus', ['led', 'odor'])
+def test_generate_log_follows_strip_logic(tmp_path, stimulus):
+    # every logged frame is the decision of StripLogic at the logged position (on the frame clock)
+    config = dict(synthetic.DEFAULT_CONFIG, pre_onset_time=10, alternation_time=30, strip_angle=20)
+    path = str(tmp_path / 'session.log')
+    n_frames = synthetic.generate_log(path, 200, config=config, stimulus=stimulus, start=START, seed=3, chunk_frames=1000)
+    df = harness.read_log(path)
+    assert len(df) == n_frames == 6000
+
+    strip = logic.StripLogic(config, stimulus, alternated=True)
+    ft = harness.FTData()
+    setpoints, instrip, centers = [], [], []
+    for frame, (posx, posy) in enumerate(zip(df['ft_posx'].values.tolist(), df['ft_posy'].values.tolist())):
+        ft.posx, ft.posy = posx, posy
+        *values, log_vals = strip.experiment_logic(frame*(1.0/30.0), None, ft)
+        setpoints.append(values)
+        instrip.append(log_vals['instrip'])
+        centers.append(log_vals['adapted_center'])
+    assert harness.compare_setpoints(np.array(setpoints), df)['all'] == 1.0
+    assert instrip == df['instrip'].tolist()
+    np.testing.assert_allclose(centers, df['adapted_center'].values, rtol=1e-12)
+    # the session goes through both flowrates and into the strip
+    assert set(np.round(1000*(df['mfc1_stpt'] + df['mfc2_stpt']))) == {300, 20}
+    assert df['instrip'].any()
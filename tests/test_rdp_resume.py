@@ -0,0 +1,85 @@
+import io
+import os
+import glob
+import zipfile
+import filecmp
+import pytest
+from cryptography.fernet import Fernet
+from flytrailvr import rdp_client
+
+SPLIT_SIZE = 1_000_000
+
+@pytest.fixture
+def folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('key.key', 'wb') as f:
+        f.write(Fernet.generate_key())
+    os.mkdir('data')
+    for i in range(6):
+        with open(os.path.join('data', f'f{i}.bin'), 'wb') as f:
+            f.write(os.urandom(700_000))
+    return tmp_path
+
+def interrupt_after(monkeypatch, count):
+    # raise once the journal holds count splits
+    checkpoint = rdp_client._lock_checkpoint
+    def interrupted(journal_path, key, params, fullzip, splits, sources):
+        checkpoint(journal_path, key, params, fullzip, splits, sources)
+        if len(splits) == count:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(rdp_client, '_lock_checkpoint', interrupted)
+
+def zip_stream():
+    # plaintext zip stream of the locked splits
+    with open('key.key', 'rb') as f:
+        key = f.read()
+    splits = sorted(glob.glob('data.ezip.[0-9][0-9][0-9]'))
+    with rdp_client.ConcatReader([lambda split=split: rdp_client.open_encrypted(split, key) for split in splits]) as reader:
+        return reader.read()
+
+def unlock_and_compare():
+    assert rdp_client.verify_locked_file('data.ezip.000', 'key.key', multifile=True)['ok']
+    os.rename('data', 'orig')
+    rdp_client.unlock_and_unzip_file('data.ezip.000', 'key.key', multifile=True)
+    assert sorted(os.listdir('data')) == sorted(os.listdir('orig'))
+    _, mismatch, errors = filecmp.cmpfiles('orig', 'data', os.listdir('orig'), shallow=False)
+    assert not mismatch and not errors
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_resume(folder, monkeypatch, capsys, workers):
+    with monkeypatch.context() as m:
+        interrupt_after(m, 2)
+        with pytest.raises(KeyboardInterrupt):
+            rdp_client.zip_and_lock_folder('data', 'key.key', multifile=True, split_size_bytes=SPLIT_SIZE, workers=workers)
+    assert os.path.isfile('data.ezip.journal')
+    rdp_client.zip_and_lock_folder('data', 'key.key', multifile=True, split_size_bytes=SPLIT_SIZE, workers=workers)
+    assert 'Resuming after 2 splits' in capsys.readouterr().out
+    assert not os.path.exists('data.ezip.journal')
+
+    # the resumed zip stream is a valid zip, identical to the one of an uninterrupted run
+    resumed = zip_stream()
+    with zipfile.ZipFile(io.BytesIO(resumed)) as fullzip:
+        assert fullzip.testzip() is None
+    for split in glob.glob('data.ezip.*'):
+        os.remove(split)
+    rdp_client.zip_and_lock_folder('data', 'key.key', multifile=True, split_size_bytes=SPLIT_SIZE, workers=workers)
+    assert zip_stream() == resumed
+    unlock_and_compare()
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_resume_after_modified_member(folder, monkeypatch, capsys, workers):
+    with monkeypatch.context() as m:
+        interrupt_after(m, 2)
+        with pytest.raises(KeyboardInterrupt):
+            rdp_client.zip_and_lock_folder('data', 'key.key', multifile=True, split_size_bytes=SPLIT_SIZE, workers=workers)
+
+    # f1.bin lies in the completed splits but is zipped again from its header on resume
+    path = os.path.join('data', 'f1.bin')
+    stat = os.stat(path)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(700_000))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    rdp_client.zip_and_lock_folder('data', 'key.key', multifile=True, split_size_bytes=SPLIT_SIZE, workers=workers)
+    assert 'f1.bin changed' in capsys.readouterr().out
+    unlock_and_compare()
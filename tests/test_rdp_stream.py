@@ -0,0 +1,176 @@
+import io
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+from cryptography.fernet import Fernet
+from flytrailvr import rdp_client
+from flytrailvr.rdp_client import (ConcatReader, CorruptArchiveError, EncryptedReader, EncryptedWriter,
+                                   SplitEncryptedWriter, open_encrypted)
+
+CHUNK = 64
+
+@pytest.fixture(scope='module')
+def key():
+    return Fernet.generate_key()
+
+@pytest.fixture(scope='module')
+def executor():
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        yield executor
+
+def encrypt(data, key, chunk_size=CHUNK, executor=None, max_pending=None):
+    buffer = io.BytesIO()
+    with EncryptedWriter(buffer, key, chunk_size, executor, max_pending) as writer:
+        # uneven writes crossing chunk boundaries
+        for start in range(0, len(data), 37):
+            writer.write(data[start:start+37])
+    return buffer.getvalue()
+
+def decrypt(archive, key, executor=None):
+    with EncryptedReader(io.BytesIO(archive), key, executor) as reader:
+        return reader.read()
+
+def records(archive):
+    # raw records of a streaming format archive (header excluded)
+    body = archive[rdp_client.FILE_HEADER.size:]
+    found = []
+    while body:
+        length = rdp_client.RECORD_HEADER.unpack_from(body)[0] + rdp_client.RECORD_HEADER.size
+        found.append(body[:length])
+        body = body[length:]
+    return found
+
+@pytest.mark.parametrize('size', [0, 1, CHUNK - 1, CHUNK, CHUNK + 1, 3*CHUNK])
+def test_round_trip(key, size):
+    data = os.urandom(size)
+    archive = encrypt(data, key)
+    # the final chunk may be full (or empty for no data)
+    assert len(records(archive)) == max(-(-size // CHUNK), 1)
+    assert decrypt(archive, key) == data
+    with EncryptedReader(io.BytesIO(archive), key) as reader:
+        assert reader.size == size
+        assert reader.seek(0, io.SEEK_END) == size
+
+def test_seek(key):
+    data = os.urandom(5*CHUNK + 10)
+    with EncryptedReader(io.BytesIO(encrypt(data, key)), key) as reader:
+        for start, length in [(0, 10), (CHUNK - 3, 7), (2*CHUNK, CHUNK), (5*CHUNK + 5, 100), (len(data), 10)]:
+            reader.seek(start)
+            assert reader.read(length) == data[start:start+length]
+
+@pytest.mark.parametrize('size', [0, CHUNK, 20*CHUNK + 3])
+def test_workers_keep_order(key, executor, size):
+    data = os.urandom(size)
+    archive = encrypt(data, key, executor=executor, max_pending=3)
+    assert decrypt(archive, key) == data
+    assert decrypt(archive, key, executor) == data
+    with EncryptedReader(io.BytesIO(archive), key, executor, prefetch=4) as reader:
+        for start in [size - 1, 3, size // 2, 0]:
+            reader.seek(max(start, 0))
+            assert reader.read(2*CHUNK) == data[max(start, 0):max(start, 0) + 2*CHUNK]
+
+def test_truncated_at_record_boundary(key):
+    archive = encrypt(os.urandom(3*CHUNK + 5), key)
+    truncated = archive[:len(archive) - len(records(archive)[-1])]
+    with pytest.raises(CorruptArchiveError, match='truncated'):
+        decrypt(truncated, key)
+    with pytest.raises(CorruptArchiveError, match='truncated header'):
+        decrypt(archive[:10], key)
+
+def test_truncated_within_record(key):
+    archive = encrypt(os.urandom(3*CHUNK + 5), key)
+    with pytest.raises(CorruptArchiveError):
+        decrypt(archive[:-1], key)
+
+def test_swapped_records(key):
+    archive = encrypt(os.urandom(3*CHUNK + 5), key)
+    parts = records(archive)
+    swapped = archive[:rdp_client.FILE_HEADER.size] + parts[1] + parts[0] + b''.join(parts[2:])
+    with pytest.raises(CorruptArchiveError, match='does not belong here'):
+        decrypt(swapped, key)
+
+def test_appended_data(key):
+    data = os.urandom(2*CHUNK + 5)
+    archive = encrypt(data, key)
+    with pytest.raises(CorruptArchiveError, match='trailing data'):
+        decrypt(archive + os.urandom(20), key)
+    with pytest.raises(CorruptArchiveError):
+        decrypt(archive + os.urandom(500), key)
+    # a record of another stream (same key, same size) does not belong to this one
+    other = records(encrypt(os.urandom(3*CHUNK), key))
+    with pytest.raises(CorruptArchiveError):
+        decrypt(archive[:-len(records(archive)[-1])] + other[2] + records(archive)[-1], key)
+
+def test_wrong_key(key):
+    archive = encrypt(os.urandom(10), key)
+    with pytest.raises(CorruptArchiveError, match='failed authentication'):
+        decrypt(archive, Fernet.generate_key())
+
+def test_legacy_archive(key, tmp_path):
+    data = os.urandom(1000)
+    path = str(tmp_path / 'legacy.ezip')
+    with open(path, 'wb') as f:
+        f.write(Fernet(key).encrypt(data))
+    with open_encrypted(path, key) as f:
+        assert f.read() == data
+    rdp_client.decrypt_file(path, str(tmp_path / 'legacy.bin'), key)
+    with open(tmp_path / 'legacy.bin', 'rb') as f:
+        assert f.read() == data
+
+def test_concat_reader():
+    parts = [os.urandom(size) for size in [10, 0, 25, 1, 40]]
+    data = b''.join(parts)
+    openers = [lambda part=part: io.BytesIO(part) for part in parts]
+    for sizes in [None, [len(part) for part in parts]]:
+        with ConcatReader(openers, sizes) as reader:
+            assert reader.read() == data
+            for start, length in [(5, 10), (9, 3), (34, 30), (70, 10), (len(data), 5)]:
+                reader.seek(start)
+                assert reader.read(length) == data[start:start+length]
+            assert reader.seek(-4, io.SEEK_END) == len(data) - 4
+            assert reader.read() == data[-4:]
+
+@pytest.mark.parametrize('size', [0, 100, 250, 300])
+@pytest.mark.parametrize('workers', [1, 2])
+def test_split_writer(key, executor, tmp_path, size, workers):
+    data = os.urandom(size)
+    prefix = str(tmp_path / 'data.ezip.')
+    with SplitEncryptedWriter(prefix, key, 100, CHUNK, executor if workers > 1 else None) as writer:
+        for start in range(0, size, 33):
+            writer.write(data[start:start+33])
+    # no empty trailing split, but at least one split
+    assert [split['plaintext_size'] for split in writer.splits] == [100]*(size // 100) + ([size % 100] if size % 100 or not size else [])
+    assert sorted(os.listdir(tmp_path)) == [split['name'] for split in writer.splits]
+    for split in writer.splits:
+        assert os.path.getsize(tmp_path / split['name']) == split['size']
+    openers = [lambda name=split['name']: open_encrypted(str(tmp_path / name), key) for split in writer.splits]
+    with ConcatReader(openers) as reader:
+        assert reader.read() == data
+
+def test_baseline_splits(key, tmp_path, monkeypatch):
+    # splits of a zip stream each encrypted as a single token, as locked before the streaming format
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('data')
+    files = {f'f{i}.txt': (f'line {i}\n'*2000).encode() for i in range(3)}
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as fullzip:
+        for name, content in files.items():
+            fullzip.writestr(name, content, compress_type=zipfile.ZIP_DEFLATED)
+    stream = buffer.getvalue()
+    parts = [stream[start:start+100] for start in range(0, len(stream), 100)]
+    for i, part in enumerate(parts):
+        with open(f'data.ezip.{i:03d}', 'wb') as f:
+            f.write(Fernet(key).encrypt(part))
+    with open('key.key', 'wb') as f:
+        f.write(key)
+
+    openers = [lambda i=i: open_encrypted(f'data.ezip.{i:03d}', key) for i in range(len(parts))]
+    with ConcatReader(openers) as reader:
+        assert reader.read() == stream
+    assert rdp_client.verify_locked_file('data.ezip.000', 'key.key', multifile=True)['ok']
+    os.rmdir('data')
+    rdp_client.unlock_and_unzip_file('data.ezip.000', 'key.key', multifile=True)
+    for name, content in files.items():
+        with open(os.path.join('data', name), 'rb') as f:
+            assert f.read() == content
@@ -0,0 +1,75 @@
+import io
+import os
+import shutil
+import filecmp
+from collections import Counter
+import pytest
+from cryptography.fernet import Fernet
+from flytrailvr import rdp_client
+
+SPLIT_SIZE = 1_000_000
+
+@pytest.fixture
+def folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('key.key', 'wb') as f:
+        f.write(Fernet.generate_key())
+    os.mkdir('data')
+    for i in range(6):
+        with open(os.path.join('data', f'f{i}.bin'), 'wb') as f:
+            f.write(os.urandom(700_000))
+    rdp_client.zip_and_lock_folder('data', 'key.key', multifile=True, split_size_bytes=SPLIT_SIZE)
+    os.rename('data', 'orig')
+    return tmp_path
+
+def count_reads(monkeypatch):
+    # bytes read by rdp_client from each file it opens for reading
+    reads = Counter()
+    class CountingReader(io.BufferedReader):
+        def read(self, size=-1):
+            data = super().read(size)
+            reads[os.path.basename(self.name)] += len(data)
+            return data
+    def counting_open(path, mode='r', *args, **kwargs):
+        if mode == 'rb':
+            return CountingReader(io.FileIO(path, 'rb'))
+        return open(path, mode, *args, **kwargs)
+    monkeypatch.setattr(rdp_client, 'open', counting_open, raising=False)
+    return reads
+
+def assert_unlocked():
+    assert sorted(os.listdir('data')) == sorted(os.listdir('orig'))
+    _, mismatch, errors = filecmp.cmpfiles('orig', 'data', os.listdir('orig'), shallow=False)
+    assert not mismatch and not errors
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_unlock_reads_splits_once(folder, monkeypatch, workers):
+    splits = sorted(name for name in os.listdir() if name.startswith('data.ezip.') and not name.endswith('.manifest'))
+    assert len(splits) > 2
+    reads = count_reads(monkeypatch)
+    rdp_client.unlock_and_unzip_file('data.ezip.000', 'key.key', multifile=True, workers=workers)
+    assert_unlocked()
+    for split in splits:
+        # hashed while decrypting (only the format header is read twice)
+        assert os.path.getsize(split) <= reads[split] <= os.path.getsize(split) + rdp_client.FILE_HEADER.size
+
+def test_unlock_rejects_split_of_another_archive(folder):
+    # the same folder locked again: every split decrypts to the same zip data, so only
+    # the manifest hash tells the split of the other archive apart
+    os.mkdir('other')
+    shutil.copytree('orig', os.path.join('other', 'data'))
+    shutil.copy('key.key', 'other')
+    os.chdir('other')
+    rdp_client.zip_and_lock_folder('data', 'key.key', multifile=True, split_size_bytes=SPLIT_SIZE)
+    os.chdir('..')
+    shutil.copy(os.path.join('other', 'data.ezip.001'), 'data.ezip.001')
+
+    with pytest.raises(rdp_client.CorruptArchiveError, match='data.ezip.001 is corrupt'):
+        rdp_client.unlock_and_unzip_file('data.ezip.000', 'key.key', multifile=True)
+    # only the member held by the first split was committed, nothing is left in .part files
+    assert os.listdir('data') == ['f0.bin']
+    assert filecmp.cmp(os.path.join('orig', 'f0.bin'), os.path.join('data', 'f0.bin'), shallow=False)
+
+    shutil.rmtree('data')
+    rdp_client.unlock_and_unzip_file('data.ezip.000', 'key.key', multifile=True, verify=False, resume=False)
+    assert_unlocked()
@@ -0,0 +1,68 @@
+import io
+import os
+import zipfile
+import pytest
+from cryptography.fernet import Fernet
+from flytrailvr import rdp_client
+
+@pytest.fixture
+def key(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    key = Fernet.generate_key()
+    with open('key.key', 'wb') as f:
+        f.write(key)
+    return key
+
+def make_folder(name, sizes):
+    os.mkdir(name)
+    for i, size in enumerate(sizes):
+        with open(os.path.join(name, f'f{i}.bin'), 'wb') as f:
+            f.write(os.urandom(size))
+
+def corrupt(path, offset):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0x01]))
+
+def lock_legacy(folder, key):
+    # single Fernet token archive (as locked before the streaming format)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as fullzip:
+        for file in sorted(os.listdir(folder)):
+            fullzip.write(os.path.join(folder, file), file, compress_type=zipfile.ZIP_DEFLATED)
+    with open(f'{folder}.ezip', 'wb') as f:
+        f.write(Fernet(key).encrypt(buffer.getvalue()))
+
+def test_corrupt_legacy_archive(key):
+    make_folder('data', [1000])
+    lock_legacy('data', key)
+    assert rdp_client.verify_locked_file('data.ezip', 'key.key')['ok']
+
+    corrupt('data.ezip', 100)
+    with pytest.raises(rdp_client.CorruptArchiveError):
+        rdp_client.open_encrypted('data.ezip', key)
+    result = rdp_client.verify_locked_file('data.ezip', 'key.key')
+    assert not result['ok']
+    assert result['errors'] == ['data.ezip: failed authentication']
+
+def test_verify_folder_continues_past_corrupt_archive(key):
+    os.mkdir('sessions')
+    for name in ['a', 'b']:
+        make_folder(os.path.join('sessions', name), [1000, 2000])
+        lock_legacy(os.path.join('sessions', name), key)
+    corrupt(os.path.join('sessions', 'a.ezip'), 100)
+    results = rdp_client.verify_locked_folder('sessions', 'key.key', verbose=False)
+    assert [result['ok'] for result in results] == [False, True]
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_corrupt_chunk_reported_once(key, workers):
+    # several members (and ranges) in the corrupt chunk, central directory in a later one
+    make_folder('data', [300_000, 300_000, 300_000, 900_000])
+    rdp_client.zip_and_lock_folder('data', 'key.key')
+    os.remove('data.ezip.manifest')
+    corrupt('data.ezip', 1000)
+    result = rdp_client.verify_locked_file('data.ezip', 'key.key', workers=workers)
+    assert not result['ok']
+    assert result['errors'] == ['data.ezip: chunk 0 failed authentication']
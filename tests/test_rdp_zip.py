@@ -0,0 +1,74 @@
+import io
+import os
+import zipfile
+import pytest
+from cryptography.fernet import Fernet
+from flytrailvr import rdp_client
+
+class Sink:
+    # write-only stream (no seek), like the encrypted writers
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def tell(self):
+        return self.buffer.tell()
+
+@pytest.fixture
+def files(tmp_path):
+    contents = {
+        'empty.txt': b'',
+        'text.txt': b'flytrailvr\n'*5000,
+        'random.bin': os.urandom(200_000),
+        'sub/précompressé.txt': b'odor strip\n'*3000,
+        'sub/deeper/data.csv': b'1,2,3\n'*10000,
+    }
+    for name, content in contents.items():
+        os.makedirs(os.path.dirname(tmp_path / name), exist_ok=True)
+        with open(tmp_path / name, 'wb') as f:
+            f.write(content)
+    return tmp_path, contents
+
+@pytest.mark.parametrize('force_zip64', [False, True])
+def test_zip_writer_round_trip(files, force_zip64):
+    folder, contents = files
+    sink = Sink()
+    writer = rdp_client._ZipWriter(sink, force_zip64=force_zip64)
+    writer.write(str(folder / 'empty.txt'), 'empty.txt')
+    writer.write(str(folder / 'text.txt'), 'text.txt', zipfile.ZIP_DEFLATED)
+    writer.write(str(folder / 'random.bin'), 'random.bin', zipfile.ZIP_STORED)
+    data, crc, size = rdp_client._deflate_file(str(folder / 'sub/précompressé.txt'), 9)
+    writer.write_compressed(str(folder / 'sub/précompressé.txt'), 'sub/précompressé.txt', data, crc, size)
+    writer.write(str(folder / 'sub/deeper/data.csv'), 'sub/deeper/data.csv', zipfile.ZIP_DEFLATED, 1)
+    writer.close()
+    archive = sink.buffer.getvalue()
+
+    assert (b'PK\x06\x06' in archive) == force_zip64
+    with zipfile.ZipFile(io.BytesIO(archive)) as fullzip:
+        assert fullzip.testzip() is None
+        assert fullzip.namelist() == list(contents)
+        for info, zinfo in zip(fullzip.infolist(), writer.infolist()):
+            assert (info.header_offset, info.CRC, info.file_size, info.compress_size, info.compress_type) == \
+                   (zinfo.header_offset, zinfo.CRC, zinfo.file_size, zinfo.compress_size, zinfo.compress_type)
+            assert fullzip.read(info) == contents[info.filename]
+            # DOS timestamps have a two second resolution
+            year, month, day, hour, minute, second = zipfile.ZipInfo.from_file(str(folder / info.filename)).date_time
+            assert info.date_time == (year, month, day, hour, minute, second - second % 2)
+        assert fullzip.getinfo('random.bin').compress_type == zipfile.ZIP_STORED
+        assert fullzip.getinfo('sub/précompressé.txt').flag_bits & 0x800
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_locked_zip_stream(files, monkeypatch, workers):
+    # adaptive compression (members deflated ahead in workers with 2 workers) gives a valid zip
+    folder, contents = files
+    monkeypatch.chdir(folder.parent)
+    key = Fernet.generate_key()
+    with open('key.key', 'wb') as f:
+        f.write(key)
+    rdp_client.zip_and_lock_folder(folder.name, 'key.key', workers=workers)
+    with rdp_client.open_encrypted(f'{folder.name}.ezip', key) as stream, zipfile.ZipFile(stream) as fullzip:
+        assert fullzip.testzip() is None
+        assert sorted(fullzip.namelist()) == sorted(contents)
+        assert fullzip.getinfo('text.txt').compress_type == zipfile.ZIP_DEFLATED
@@ -0,0 +1,53 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+from flytrailvr.utils import extract_data
+from flytrailvr.video import TrajectoryRenderer, export_trajectory_animation, write_trajectory_video
+
+SESSION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'charlie_rig_rishika', 'orco_thinstrip_20240321-112203')
+
+@pytest.fixture(scope='module')
+def df():
+    df, _, _, _ = extract_data(SESSION)
+    return df.iloc[:300].reset_index(drop=True)
+
+def read_frames(path):
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append(frame)
+    capture.release()
+    return frames
+
+def test_parallel_video_matches_single_process(df, tmp_path):
+    single = str(tmp_path / 'single.avi')
+    parallel = str(tmp_path / 'parallel.avi')
+    write_trajectory_video(df, single, size=128, progress=False)
+    stats = write_trajectory_video(df, parallel, size=128, progress=False, workers=2, chunks=5)
+    assert stats['workers'] == 2
+    expected, frames = read_frames(single), read_frames(parallel)
+    assert len(expected) == len(df)
+    assert len(frames) == len(expected)
+    assert all(np.array_equal(a, b) for a, b in zip(expected, frames))
+
+def test_gif_matches_renderer(df, tmp_path):
+    output = str(tmp_path / 'animation.gif')
+    stats = export_trajectory_animation(df, output, step=7, max_frames=20, size=96, progress=False)
+    renderer = TrajectoryRenderer(df, size=96)
+    with Image.open(output) as gif:
+        assert gif.info['loop'] == 0
+        frames, durations = [], []
+        for frame in ImageSequence.Iterator(gif):
+            frames.append(np.asarray(frame.convert('RGB')))
+            durations.append(frame.info['duration'])
+    assert len(frames) == stats['frames'] == 20
+    assert durations == [10*(round(1000*7/(2*renderer.frame_rate))//10)]*20
+    assert len(np.unique(frames[-1].reshape(-1, 3), axis=0)) > 1
+    for n, frame in enumerate(frames):
+        expected = cv2.cvtColor(renderer.render(7*n), cv2.COLOR_BGR2RGB)
+        assert np.array_equal(frame, expected)